@@ -0,0 +1,362 @@
+"""
+Benchmarks of the megafile and JHU pipelines on synthetic data.
+
+Inputs are generated in a temporary directory (see synthetic.py) and megafile.py is pointed at them, so a run
+never reads remote data nor writes to public/data. The following are timed:
+- megafile.get_jhu (reading the wide JHU CSVs);
+- jhu.load_standardized and shared.standard_export (skipped if jhu.py can't be imported, e.g. if the Slack
+  client is not installed);
+- megafile.generate_megafile, with the time of each of its stages (loaders, join, every exporter…).
+
+Results are stored as JSON (by default in scripts/output/benchmarks/<commit>.json), so that runs can be compared
+across commits:
+
+    python run_benchmarks.py run --locations 200 --days 700 --repeat 3
+    python run_benchmarks.py compare ../output/benchmarks/<before>.json ../output/benchmarks/<after>.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+CURRENT_DIR = os.path.abspath(os.path.dirname(__file__))
+SCRIPTS_DIR = os.path.abspath(os.path.join(CURRENT_DIR, "..", "scripts"))
+sys.path.append(SCRIPTS_DIR)
+
+import megafile
+from cowidev.megafile.profiling import StageProfiler
+from cowidev.utils.memory import get_peak_rss
+from synthetic import generate_inputs
+
+OUTPUT_DIR = os.path.abspath(os.path.join(CURRENT_DIR, "..", "output", "benchmarks"))
+
+
+@contextmanager
+def relocated(paths: dict, cache_dir: str):
+    """Point megafile at the synthetic inputs (and at an empty cache of parsed inputs) within the context.
+
+    Args:
+        paths (dict): Value of each megafile constant, as returned by `synthetic.generate_inputs`.
+        cache_dir (str): Directory of the cache of parsed inputs.
+    """
+    data_dir = paths["DATA_DIR"]
+    constants = {
+        **paths,
+        "BUILD_REPORT_PATH": os.path.join(
+            paths["TIMESTAMP_DIR"], "owid-covid-data-build-report.json"
+        ),
+        "COMPLETE_DATASET_PARQUET": os.path.join(data_dir, "owid-covid-data.parquet"),
+        "README_FILE": os.path.join(data_dir, "README.md"),
+    }
+    previous = {name: getattr(megafile, name) for name in constants}
+    previous_cache_dir = megafile.INPUT_CACHE.cache_dir
+    for name, value in constants.items():
+        setattr(megafile, name, value)
+    megafile.INPUT_CACHE.cache_dir = cache_dir
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(megafile, name, value)
+        megafile.INPUT_CACHE.cache_dir = previous_cache_dir
+
+
+def summarize(times: list) -> dict:
+    return {
+        "min": round(min(times), 4),
+        "median": round(statistics.median(times), 4),
+        "max": round(max(times), 4),
+        "runs": [round(t, 4) for t in times],
+    }
+
+
+def timeit(func, repeat: int = 1, setup=None):
+    """Time `repeat` calls to `func`, calling `setup` (untimed) before each of them.
+
+    Returns:
+        The value returned by the last call, and the summary of the wall times (in seconds).
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return result, summarize(times)
+
+
+def import_jhu():
+    """Import jhu.py, or return None if its dependencies (Slack client, database imports) are missing."""
+    try:
+        import jhu
+    except ImportError as e:
+        print(f"<!> Skipping JHU benchmarks, jhu.py can't be imported ({e})")
+        return None
+    return jhu
+
+
+def bench_jhu(jhu, jhu_merged, output_dir, repeat):
+    import shared
+
+    results = {}
+    testing_locations = set(megafile.get_testing()["location"])
+    df_standardized, results["load_standardized"] = timeit(
+        lambda: jhu.load_standardized(jhu_merged.copy(), testing_locations), repeat
+    )
+    os.makedirs(output_dir, exist_ok=True)
+    _, results["standard_export"] = timeit(
+        lambda: shared.standard_export(df_standardized, output_dir, jhu.DATASET_NAME),
+        repeat,
+    )
+    return results
+
+
+def clear_caches():
+    """Empty the cache of parsed inputs, on disk and in memory."""
+    megafile.INPUT_CACHE.clear()
+    megafile._read_testing_once.cache_clear()
+
+
+def bench_megafile(repeat, warm_cache):
+    """Time complete builds of the megafile, and each of their stages."""
+    profilers = []
+
+    def build():
+        profiler = StageProfiler()
+        profilers.append(profiler)
+        megafile.generate_megafile(profiler=profiler)
+
+    # With a warm cache, parsed inputs are cached by an untimed build. Otherwise, the cache is emptied before each
+    # build.
+    if warm_cache:
+        build()
+        profilers.clear()
+    _, results = timeit(build, repeat, setup=None if warm_cache else clear_caches)
+
+    stages = {}
+    for profiler in profilers:
+        for record in profiler.records:
+            stages.setdefault(record.name, []).append(record.wall_time)
+    last = profilers[-1].records
+    return results, {
+        name: {
+            **summarize(times),
+            "rows_out": next(r.rows_out for r in last if r.name == name),
+        }
+        for name, times in stages.items()
+    }
+
+
+def get_commit():
+    """Get the current commit (with a "-dirty" suffix if there are uncommitted changes), or None outside git."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=CURRENT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=CURRENT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{commit}-dirty" if dirty else commit
+
+
+def run(args):
+    commit = get_commit()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="cowidev-benchmarks-")
+    try:
+        print(f"Generating synthetic inputs in {workdir}…")
+        paths, jhu_merged = generate_inputs(
+            workdir, args.locations, args.days, args.extra_columns, args.seed
+        )
+        results = {
+            "commit": commit,
+            "created": datetime.utcnow().replace(microsecond=0).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "packages": {
+                "pandas": pd.__version__,
+                "numpy": np.__version__,
+                "pyarrow": pa.__version__,
+            },
+            "scale": {
+                "locations": jhu_merged.location.nunique() - 1,
+                "days": args.days,
+                "extra_columns": args.extra_columns,
+                "seed": args.seed,
+            },
+            "repeat": args.repeat,
+            "warm_cache": args.warm_cache,
+            "export_workers": args.export_workers,
+            "export_threads": args.export_threads,
+            "benchmarks": {},
+            "stages": {},
+        }
+        megafile.EXPORT_MAX_WORKERS = args.export_workers
+        megafile.EXPORT_PROCESSES = not args.export_threads
+        with relocated(paths, os.path.join(workdir, "cache")):
+            _, results["benchmarks"]["get_jhu"] = timeit(megafile.get_jhu, args.repeat)
+            jhu = import_jhu()
+            if jhu is not None:
+                results["benchmarks"].update(
+                    bench_jhu(
+                        jhu,
+                        jhu_merged,
+                        os.path.join(workdir, "jhu-export"),
+                        args.repeat,
+                    )
+                )
+            (
+                results["benchmarks"]["generate_megafile"],
+                results["stages"],
+            ) = bench_megafile(args.repeat, args.warm_cache)
+        results["peak_rss"] = round(get_peak_rss(), 1)
+    finally:
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output_path = args.output or os.path.join(OUTPUT_DIR, f"{commit or 'results'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print_results(results)
+    print(f"\nResults written to {output_path}")
+
+
+def _timings(results: dict) -> dict:
+    """Median time of each benchmark and megafile stage."""
+    timings = {name: t["median"] for name, t in results["benchmarks"].items()}
+    timings.update(
+        {f"megafile/{name}": t["median"] for name, t in results["stages"].items()}
+    )
+    return timings
+
+
+def print_results(results: dict):
+    print(f"\nCommit {results['commit']}, scale {results['scale']}:")
+    for name, median in _timings(results).items():
+        print(f"{name:<50} {median:>10.3f}s")
+    print(f"Peak RSS: {results['peak_rss']} MiB")
+
+
+def compare(args):
+    with open(args.before, "r") as f:
+        before = json.load(f)
+    with open(args.after, "r") as f:
+        after = json.load(f)
+    if before["scale"] != after["scale"]:
+        print(f"<!> Runs have different scales: {before['scale']} != {after['scale']}")
+
+    timings_before, timings_after = _timings(before), _timings(after)
+    print(f"{'':<50} {before['commit']:>12} {after['commit']:>12} {'change':>8}")
+    regressions = []
+    for name in list(timings_before) + [
+        name for name in timings_after if name not in timings_before
+    ]:
+        t_before, t_after = timings_before.get(name), timings_after.get(name)
+        if t_before is None or t_after is None:
+            change = ""
+        else:
+            pct = 100 * (t_after - t_before) / t_before if t_before else 0
+            change = f"{pct:+.1f}%"
+            if args.threshold is not None and pct > args.threshold:
+                regressions.append(name)
+        print(
+            f"{name:<50} {_format_time(t_before):>12} {_format_time(t_after):>12} {change:>8}"
+        )
+    print(f"{'Peak RSS (MiB)':<50} {before['peak_rss']:>12} {after['peak_rss']:>12}")
+    if regressions:
+        print(f"\n<!> Slower by more than {args.threshold}%: {regressions}")
+        sys.exit(1)
+
+
+def _format_time(t):
+    return "-" if t is None else f"{t:.3f}s"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the megafile and JHU pipelines on synthetic data"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_run = subparsers.add_parser("run", help="Run the benchmarks")
+    parser_run.add_argument(
+        "--locations", type=int, default=100, help="Number of countries"
+    )
+    parser_run.add_argument("--days", type=int, default=365, help="Number of days")
+    parser_run.add_argument(
+        "--extra-columns",
+        type=int,
+        default=0,
+        help="Number of unused columns added to each input",
+    )
+    parser_run.add_argument("--seed", type=int, default=0)
+    parser_run.add_argument(
+        "--repeat", type=int, default=1, help="Number of runs of each benchmark"
+    )
+    parser_run.add_argument(
+        "--warm-cache",
+        action="store_true",
+        help="Time builds with the parsed inputs already cached (by default, the cache is emptied before each build)",
+    )
+    parser_run.add_argument(
+        "--export-workers",
+        type=int,
+        help="Number of workers of the export stages (defaults to one per writer, up to the number of CPUs)",
+    )
+    parser_run.add_argument(
+        "--export-threads",
+        action="store_true",
+        help="Run export writers in threads instead of worker processes (with 1 worker: sequentially, in-process)",
+    )
+    parser_run.add_argument(
+        "--output",
+        help="Path to the JSON results (defaults to scripts/output/benchmarks/<commit>.json)",
+    )
+    parser_run.add_argument(
+        "--workdir",
+        help="Directory where to generate the inputs (defaults to a temporary directory, removed afterwards)",
+    )
+    parser_run.add_argument(
+        "--keep",
+        action="store_true",
+        help="Keep the temporary directory with the inputs and outputs",
+    )
+
+    parser_compare = subparsers.add_parser("compare", help="Compare two runs")
+    parser_compare.add_argument("before", help="JSON results of the reference run")
+    parser_compare.add_argument("after", help="JSON results of the new run")
+    parser_compare.add_argument(
+        "--threshold",
+        type=float,
+        help="Exit with an error if any timing is slower by more than this percentage",
+    )
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        compare(args)
@@ -0,0 +1,331 @@
+"""
+Synthetic inputs for the megafile and JHU benchmarks.
+
+Generates a tree with the same layout as the repository (public/data/..., scripts/input/..., scripts/grapher/...)
+holding all the files read by megafile.py: JHU wide CSVs, testing, vaccinations, hospital, OxCGRT, reproduction rate
+and excess mortality data. Remote inputs (reproduction rate) are written as local fixtures, so that a benchmark
+never needs network access.
+
+Location names are real (taken from the ISO codes file, the population file and the mapping files in scripts/input),
+so that ISO codes, continents, macro variables and OWID aggregates can be looked up as in production. Values are
+random but plausible (cumulative series are non-decreasing, per-capita series are consistent with population).
+"""
+
+import os
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+
+CURRENT_DIR = os.path.abspath(os.path.dirname(__file__))
+INPUT_DIR = os.path.abspath(os.path.join(CURRENT_DIR, "..", "input"))
+ZERO_DAY = "2020-01-21"
+JHU_MEASURES = ["cases", "deaths"]
+
+
+def get_locations(n: int, seed: int = 0) -> pd.DataFrame:
+    """Pick `n` countries with an ISO code and a population figure.
+
+    Returns:
+        pd.DataFrame: Table with columns [location, iso_code, population], sorted by location. There are fewer than
+                      `n` rows if not enough countries are available.
+    """
+    iso_codes = pd.read_csv(os.path.join(INPUT_DIR, "iso/iso3166_1_alpha_3_codes.csv"))
+    population = pd.read_csv(
+        os.path.join(INPUT_DIR, "un/population_2020.csv"),
+        usecols=["iso_code", "population"],
+    )
+    countries = iso_codes[~iso_codes.iso_code.str.startswith("OWID_")].merge(
+        population, on="iso_code"
+    )
+    countries = countries.drop_duplicates(subset="location")
+    rng = np.random.default_rng(seed)
+    n = min(n, len(countries))
+    countries = countries.iloc[np.sort(rng.choice(len(countries), n, replace=False))]
+    return countries.sort_values("location", ignore_index=True)
+
+
+def get_dates(days: int) -> pd.DatetimeIndex:
+    """Get the last `days` dates up to yesterday (data from the current day is dropped by the megafile)."""
+    end = date.today() - timedelta(days=1)
+    return pd.date_range(end=end, periods=days, freq="D")
+
+
+def _long_frame(locations, dates) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "location": np.repeat(np.asarray(locations, dtype=object), len(dates)),
+            "date": np.tile(dates.strftime("%Y-%m-%d").to_numpy(), len(locations)),
+        }
+    )
+
+
+def _cumulative(rng, n_locations, n_days, scale):
+    """Random daily counts of shape (n_locations, n_days), and their cumulative sums."""
+    rates = rng.gamma(2, scale, size=(n_locations, 1))
+    daily = rng.poisson(rates * rng.random((n_locations, n_days)) * 2)
+    return daily, daily.cumsum(axis=1)
+
+
+def _sample_locations(rng, locations, fraction):
+    locations = np.asarray(locations, dtype=object)
+    n = max(1, int(round(len(locations) * fraction)))
+    return np.sort(rng.choice(locations, n, replace=False))
+
+
+def _add_extra_columns(df, rng, extra_columns):
+    """Add `extra_columns` numeric columns that are not used by the pipelines (wider inputs)."""
+    for i in range(extra_columns):
+        df[f"extra_{i}"] = rng.random(len(df)).round(3)
+    return df
+
+
+def generate_jhu(countries: pd.DataFrame, dates, seed: int = 0) -> pd.DataFrame:
+    """Generate JHU cases and deaths for each country, as merged by jhu.py before standardization.
+
+    Returns:
+        pd.DataFrame: Table with columns [date, Country/Region, location, total_cases, new_cases, total_deaths,
+                      new_deaths]. Dates are `datetime.date` objects, as in jhu.py.
+    """
+    rng = np.random.default_rng(seed)
+    locations = list(countries.location) + ["International"]
+    df = _long_frame(locations, dates)
+    for measure, scale in zip(JHU_MEASURES, [500, 10]):
+        daily, total = _cumulative(rng, len(locations), len(dates), scale)
+        df[f"total_{measure}"] = total.ravel().astype(float)
+        df[f"new_{measure}"] = daily.ravel().astype(float)
+        # Series start with a missing daily value, as with the diff in jhu.py
+        df.loc[df.date == df.date.min(), f"new_{measure}"] = np.nan
+    df["date"] = pd.to_datetime(df["date"]).dt.date
+    df.insert(1, "Country/Region", df["location"])
+    return df
+
+
+def write_jhu_csvs(jhu: pd.DataFrame, countries: pd.DataFrame, output_dir: str):
+    """Write the wide JHU CSVs read by megafile.get_jhu (1 file per variable, 1 column per location)."""
+    os.makedirs(output_dir, exist_ok=True)
+    df = jhu.drop(columns="Country/Region").copy()
+    df["date"] = df["date"].astype(str)
+    population = countries.set_index("location")["population"]
+    for measure in JHU_MEASURES:
+        df[f"weekly_{measure}"] = (
+            df.groupby("location")[f"new_{measure}"]
+            .rolling(7, min_periods=7)
+            .sum()
+            .reset_index(level=0, drop=True)
+        )
+    measures = [
+        f"{prefix}_{measure}"
+        for prefix in ["total", "new", "weekly"]
+        for measure in JHU_MEASURES
+    ]
+    # World is the sum of all locations
+    world = df.groupby("date", as_index=False)[measures].sum(min_count=1)
+    world["location"] = "World"
+    df = pd.concat([df, world], ignore_index=True)
+    population = population.reindex(df.location).to_numpy()
+    population[df.location.to_numpy() == "World"] = countries.population.sum()
+    for measure in measures:
+        df[f"{measure}_per_million"] = (df[measure] / (population / 1e6)).round(3)
+    for col in measures + [f"{measure}_per_million" for measure in measures]:
+        wide = df.pivot(index="date", columns="location", values=col)
+        # World is the first column, as in the files exported by jhu.py
+        cols = wide.columns.tolist()
+        cols.insert(0, cols.pop(cols.index("World")))
+        wide[cols].to_csv(os.path.join(output_dir, f"{col}.csv"))
+
+
+def write_testing(path, countries, dates, rng, extra_columns=0):
+    locations = _sample_locations(rng, countries.location, 0.7)
+    iso_codes = countries.set_index("location").iso_code
+    population = countries.set_index("location").population
+    df = _long_frame(locations, dates)
+    daily, total = _cumulative(rng, len(locations), len(dates), 5000)
+    thousands = population.reindex(df.location).to_numpy() / 1e3
+    df["Entity"] = df.location + " - tests performed"
+    df["ISO code"] = iso_codes.reindex(df.location).to_numpy()
+    df["Date"] = df.date
+    df["Cumulative total"] = total.ravel().astype(float)
+    df["Daily change in cumulative total"] = daily.ravel().astype(float)
+    df["7-day smoothed daily change"] = (
+        df.groupby("location")["Daily change in cumulative total"]
+        .transform(lambda s: s.rolling(7, min_periods=1).mean())
+        .round()
+    )
+    df["Cumulative total per thousand"] = df["Cumulative total"] / thousands
+    df["Daily change in cumulative total per thousand"] = (
+        df["Daily change in cumulative total"] / thousands
+    )
+    df["7-day smoothed daily change per thousand"] = (
+        df["7-day smoothed daily change"] / thousands
+    )
+    df["Short-term positive rate"] = rng.random(len(df)) * 0.3
+    df["Short-term tests per case"] = 1 / np.maximum(
+        df["Short-term positive rate"], 1e-3
+    )
+    df = _add_extra_columns(df.drop(columns=["location", "date"]), rng, extra_columns)
+    df.round(6).to_csv(path, index=False)
+
+
+def write_vaccinations(path, countries, dates, rng, extra_columns=0):
+    locations = list(_sample_locations(rng, countries.location, 0.9)) + ["World"]
+    population = countries.set_index("location").population.copy()
+    population["World"] = countries.population.sum()
+    df = _long_frame(locations, dates)
+    df.insert(
+        1,
+        "iso_code",
+        countries.set_index("location").iso_code.reindex(df.location).to_numpy(),
+    )
+    df.loc[df.location == "World", "iso_code"] = "OWID_WRL"
+    hundreds = population.reindex(df.location).to_numpy() / 100
+    millions = hundreds / 1e4
+    daily, total = _cumulative(rng, len(locations), len(dates), 20000)
+    df["total_vaccinations"] = total.ravel().astype(float)
+    df["people_vaccinated"] = (df.total_vaccinations * 0.6).round()
+    df["people_fully_vaccinated"] = (df.total_vaccinations * 0.35).round()
+    df["total_boosters"] = (df.total_vaccinations * 0.05).round()
+    df["daily_vaccinations_raw"] = daily.ravel().astype(float)
+    df["daily_vaccinations"] = (
+        df.groupby("location")["daily_vaccinations_raw"]
+        .transform(lambda s: s.rolling(7, min_periods=1).mean())
+        .round()
+    )
+    for col in [
+        "total_vaccinations",
+        "people_vaccinated",
+        "people_fully_vaccinated",
+        "total_boosters",
+    ]:
+        df[f"{col}_per_hundred"] = (df[col] / hundreds).round(2)
+    df["daily_vaccinations_per_million"] = (df.daily_vaccinations / millions).round()
+    # Vaccination data is sparse: some days are not reported
+    missing = rng.random(len(df)) < 0.2
+    df.loc[missing, ["total_vaccinations", "daily_vaccinations_raw"]] = np.nan
+    df = _add_extra_columns(df, rng, extra_columns)
+    df.to_csv(path, index=False)
+
+
+def write_hospital(path, countries, dates, rng, extra_columns=0):
+    locations = _sample_locations(rng, countries.location, 0.4)
+    millions = countries.set_index("location").population / 1e6
+    df = _long_frame(locations, dates)
+    df["Country"] = df.location
+    df["Year"] = (pd.to_datetime(df.date) - pd.Timestamp(ZERO_DAY)).dt.days
+    millions = millions.reindex(df.location).to_numpy()
+    for name, scale in [
+        ("Daily ICU occupancy", 200),
+        ("Daily hospital occupancy", 2000),
+        ("Weekly new ICU admissions", 100),
+        ("Weekly new hospital admissions", 1000),
+    ]:
+        values = rng.gamma(2, scale, size=len(df)).round()
+        values[rng.random(len(df)) < 0.3] = np.nan
+        df[name] = values
+        df[f"{name} per million"] = (values / millions).round(3)
+    df = _add_extra_columns(df.drop(columns=["location", "date"]), rng, extra_columns)
+    df.to_csv(path, index=False)
+
+
+def write_oxcgrt(path, countries, dates, rng, extra_columns=0):
+    """Write OxCGRT data (national rows only, with BSG country names) for the countries in the BSG mapping."""
+    mapping = pd.read_csv(os.path.join(INPUT_DIR, "bsg/bsg_country_standardised.csv"))
+    mapping = mapping[mapping.Country.isin(countries.location)].drop_duplicates(
+        subset="Country"
+    )
+    df = _long_frame(mapping.CountryName, dates)
+    df = df.rename(columns={"location": "CountryName"})
+    df["RegionName"] = np.nan
+    df["RegionCode"] = np.nan
+    df["Date"] = pd.to_datetime(df.date).dt.strftime("%Y%m%d")
+    df["StringencyIndex"] = (rng.random(len(df)) * 100).round(2)
+    df = _add_extra_columns(df.drop(columns="date"), rng, extra_columns)
+    df.to_csv(path, index=False)
+
+
+def write_reproduction_rate(path, countries, dates, rng, extra_columns=0):
+    """Write a local copy of the TrackingR estimates (both 5 and 7 days infectious), with TrackingR names."""
+    mapping = pd.read_csv(
+        os.path.join(INPUT_DIR, "reproduction/reprod_country_standardized.csv")
+    )
+    locations = countries.location.replace(dict(zip(mapping.owid, mapping.reprod)))
+    df = pd.concat(
+        [_long_frame(locations, dates).assign(days_infectious=days) for days in [5, 7]],
+        ignore_index=True,
+    )
+    df = df.rename(columns={"location": "Country/Region", "date": "Date"})
+    df["R"] = rng.normal(1, 0.2, size=len(df)).round(4)
+    df = _add_extra_columns(df, rng, extra_columns)
+    df.to_csv(path, index=False)
+
+
+def write_excess_mortality(path, countries, dates, rng, extra_columns=0):
+    """Write weekly excess mortality (P-scores) for some of the countries."""
+    locations = _sample_locations(rng, countries.location, 0.3)
+    df = _long_frame(locations, dates[::7])
+    df["p_scores_all_ages"] = rng.normal(10, 15, size=len(df)).round(2)
+    df = _add_extra_columns(df, rng, extra_columns)
+    df.to_csv(path, index=False)
+
+
+def generate_inputs(
+    root: str, locations: int = 100, days: int = 365, extra_columns: int = 0, seed=0
+):
+    """Write all the inputs of the megafile under `root`.
+
+    Args:
+        root (str): Directory where the tree of inputs is created.
+        locations (int, optional): Number of countries. Defaults to 100.
+        days (int, optional): Number of days of data, up to yesterday. Defaults to 365.
+        extra_columns (int, optional): Number of unused columns added to each long-format input. Defaults to 0.
+        seed (int, optional): Seed of the random generator. Defaults to 0.
+
+    Returns:
+        dict: Path to each input (and output directory), keyed by the name of the corresponding constant in
+              megafile.py.
+        pd.DataFrame: JHU data as merged by jhu.py, the input of `jhu.load_standardized`.
+    """
+    data_dir = os.path.join(root, "public", "data")
+    scripts_dir = os.path.join(root, "scripts")
+    paths = {
+        "DATA_DIR": data_dir,
+        "TIMESTAMP_DIR": os.path.join(data_dir, "internal", "timestamp"),
+        "VACCINATIONS_CSV": os.path.join(data_dir, "vaccinations", "vaccinations.csv"),
+        "TESTING_CSV": os.path.join(
+            data_dir, "testing", "covid-testing-all-observations.csv"
+        ),
+        "CASES_CSV": os.path.join(data_dir, "jhu", "total_cases.csv"),
+        "DEATHS_CSV": os.path.join(data_dir, "jhu", "total_deaths.csv"),
+        "HOSP_CSV": os.path.join(
+            scripts_dir, "grapher", "COVID-2019 - Hospital & ICU.csv"
+        ),
+        "EXCESS_MORTALITY_CSV": os.path.join(
+            data_dir, "excess_mortality", "excess_mortality.csv"
+        ),
+        "REPR_CSV": os.path.join(scripts_dir, "input", "reproduction", "database.csv"),
+        "POL_CSV": os.path.join(scripts_dir, "input", "bsg", "latest.csv"),
+        "FINGERPRINTS_PATH": os.path.join(
+            scripts_dir, "output", "megafile", "fingerprints.json"
+        ),
+    }
+    os.makedirs(paths["TIMESTAMP_DIR"], exist_ok=True)
+    for name, path in paths.items():
+        if not name.endswith("_DIR"):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    countries = get_locations(locations, seed)
+    dates = get_dates(days)
+
+    jhu = generate_jhu(countries, dates, seed)
+    write_jhu_csvs(jhu, countries, os.path.join(data_dir, "jhu"))
+    write_testing(paths["TESTING_CSV"], countries, dates, rng, extra_columns)
+    write_vaccinations(paths["VACCINATIONS_CSV"], countries, dates, rng, extra_columns)
+    write_hospital(paths["HOSP_CSV"], countries, dates, rng, extra_columns)
+    write_oxcgrt(paths["POL_CSV"], countries, dates, rng, extra_columns)
+    write_reproduction_rate(paths["REPR_CSV"], countries, dates, rng, extra_columns)
+    write_excess_mortality(
+        paths["EXCESS_MORTALITY_CSV"], countries, dates, rng, extra_columns
+    )
+    return paths, jhu
@@ -7,6 +7,7 @@ import sys
 import numpy as np
 import pandas as pd
 import pytz
+from cowidev.utils.grapher_dates import dates_to_days
 
 
 CURRENT_DIR = os.path.dirname(__file__)
@@ -361,9 +362,7 @@ def owid_format(df):
 
 
 def date_to_owid_year(df):
-    df.loc[:, "date"] = (
-        pd.to_datetime(df.date, format="%Y-%m-%d") - datetime.datetime(2020, 1, 21)
-    ).dt.days
+    df.loc[:, "date"] = dates_to_days(df.date, ZERO_DAY, format="%Y-%m-%d")
     df = df.rename(columns={"date": "Year"})
     return df
 
@@ -11,6 +11,8 @@ from termcolor import colored
 CURRENT_DIR = os.path.dirname(__file__)
 sys.path.append(CURRENT_DIR)
 
+from cowidev.utils.rolling import GroupedWindows
+
 import megafile
 from shared import (
     load_population,
@@ -24,8 +26,10 @@ from shared import (
     inject_rolling_avg,
     inject_exemplars,
     inject_doubling_days,
+    blank_zero_totals,
     inject_weekly_growth,
     inject_biweekly_growth,
+    exclude_custom_aggregates,
     standard_export,
     ZERO_DAY,
 )
@@ -253,16 +257,19 @@ def patch_ireland(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
-def load_standardized(df):
+def load_standardized(df, testing_locations):
     df = df[
         ["date", "location", "new_cases", "new_deaths", "total_cases", "total_deaths"]
     ]
     # df = patch_ireland(df)
     df = discard_rows(df)
     df = inject_owid_aggregates(df)
-    df = inject_weekly_growth(df)
-    df = inject_biweekly_growth(df)
-    df = inject_doubling_days(df)
+    # The next steps keep the rows (and their order), so they share the same windows
+    windows = GroupedWindows(df, by="location", order_by="date")
+    df = inject_weekly_growth(df, windows)
+    df = inject_biweekly_growth(df, windows)
+    df = inject_doubling_days(df, windows)
+    df = blank_zero_totals(df)
     df = inject_per_million(
         df,
         [
@@ -276,14 +283,14 @@ def load_standardized(df):
             "biweekly_deaths",
         ],
     )
-    df = inject_rolling_avg(df)
+    df = inject_rolling_avg(df, windows)
     df = inject_cfr(df)
     df = inject_days_since(df)
-    df = inject_exemplars(df)
+    df = inject_exemplars(df, testing_locations)
     return df.sort_values(by=["location", "date"])
 
 
-def export(df_merged):
+def export(df_merged, df_standardized, compression=None):
     df_loc = df_merged[["Country/Region", "location"]].drop_duplicates()
     df_loc = df_loc.merge(load_owid_continents(), on="location", how="left")
     df_loc = inject_population(df_loc)
@@ -292,10 +299,10 @@ def export(df_merged):
     df_loc = df_loc.sort_values("location")
     df_loc.to_csv(os.path.join(OUTPUT_PATH, "locations.csv"), index=False)
     # The rest of the CSVs
-    return standard_export(load_standardized(df_merged), OUTPUT_PATH, DATASET_NAME)
+    return standard_export(df_standardized, OUTPUT_PATH, DATASET_NAME, compression)
 
 
-def main(skip_download=False):
+def main(skip_download=False, compression=None):
 
     if not skip_download:
         print("\nAttempting to download latest CSV files...")
@@ -309,7 +316,10 @@ def main(skip_download=False):
         print_err("Data correctness check %s.\n" % colored("failed", "red"))
         sys.exit(1)
 
-    if export(df_merged):
+    testing_locations = set(megafile.get_testing()["location"])
+    df_standardized = load_standardized(df_merged, testing_locations)
+
+    if export(df_merged, df_standardized, compression):
         print(
             "Successfully exported CSVs to %s\n"
             % colored(os.path.abspath(OUTPUT_PATH), "magenta")
@@ -319,7 +329,10 @@ def main(skip_download=False):
         sys.exit(1)
 
     print("Generating megafile…")
-    megafile.generate_megafile()
+    # Hand over the exported table in memory instead of reading the CSVs back
+    megafile.generate_megafile(
+        jhu_table=exclude_custom_aggregates(df_standardized), compression=compression
+    )
     print("Megafile is ready.")
 
     send_success(channel="corona-data-updates", title="Updated JHU GitHub exports")
@@ -349,5 +362,19 @@ if __name__ == "__main__":
         action="store_true",
         help="Skip downloading files from the JHU repository",
     )
+    parser.add_argument(
+        "--compress",
+        nargs="+",
+        choices=["gz", "zst"],
+        help="Also write compressed variants of the JHU CSVs and megafile CSV/JSON",
+    )
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        help="Compression level of the variants (defaults to 6 for gz, 3 for zst)",
+    )
     args = parser.parse_args()
-    main(skip_download=args.skip_download)
+    main(
+        skip_download=args.skip_download,
+        compression=dict.fromkeys(args.compress or [], args.compression_level),
+    )
@@ -1,19 +1,39 @@
 """
 Merges all COVID-19 data into a 'megafile';
 - Follows a long format of 1 row per country & date, and variables as columns;
-- Published in CSV, XLSX, and JSON formats;
+- Published in CSV, XLSX, JSON, Parquet and Arrow IPC (Feather) formats;
 - Includes derived variables that can't be easily calculated, such as X per capita;
 - Includes country ISO codes in a column next to country names.
 """
 
-import json
+import argparse
 import os
 from datetime import datetime, date, timedelta
-from functools import reduce
-import yaml
+from functools import lru_cache, partial, reduce
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from cowidev.utils.columnar import to_columnar_json, to_compact_json
+from cowidev.utils.grapher_dates import days_to_dates
+from cowidev.utils.compression import (
+    open_with_variants,
+    stale_variant_paths,
+    variant_paths,
+)
+from cowidev.utils.annotations import AnnotatorInternal
+from cowidev.utils.latest import latest_snapshot
+from cowidev.utils.series import select_series
+from cowidev.utils.xlsx import to_xlsx
+from cowidev.megafile.export import ExportStage
+from cowidev.megafile.join import join_sources, broadcast_lookup
+from cowidev.megafile.incremental import SourceFingerprints, source_files
+from cowidev.megafile.cache import InputCache
+from cowidev.megafile.changelog import DatasetPatch
+from cowidev.megafile.shards import write_shards
+from cowidev.megafile.profiling import StageProfiler
 
 
 CURRENT_DIR = os.path.abspath(os.path.dirname(__file__))
@@ -24,6 +44,7 @@ DATA_VAX_COUNTRIES_DIR = os.path.abspath(
     os.path.join(DATA_DIR, "vaccinations", "country_data")
 )
 TIMESTAMP_DIR = os.path.abspath(os.path.join(DATA_DIR, "internal", "timestamp"))
+BUILD_REPORT_PATH = os.path.join(TIMESTAMP_DIR, "owid-covid-data-build-report.json")
 ANNOTATIONS_PATH = os.path.abspath(
     os.path.join(CURRENT_DIR, "annotations_internal.yaml")
 )
@@ -32,12 +53,15 @@ country_vax_data_partly = [
     os.path.join(DATA_VAX_COUNTRIES_DIR, f"{country}.csv")
     for country in COUNTRIES_WITH_PARTLY_VAX_METRIC
 ]
-# FOR README generation
+# Input files (also used for README generation)
 VACCINATIONS_CSV = os.path.join(DATA_DIR, "vaccinations", "vaccinations.csv")
 TESTING_CSV = os.path.join(DATA_DIR, "testing", "covid-testing-all-observations.csv")
 CASES_CSV = os.path.join(DATA_DIR, "jhu", "total_cases.csv")
 DEATHS_CSV = os.path.join(DATA_DIR, "jhu", "total_deaths.csv")
 HOSP_CSV = os.path.join(GRAPHER_DIR, "COVID-2019 - Hospital & ICU.csv")
+EXCESS_MORTALITY_CSV = os.path.join(
+    DATA_DIR, "excess_mortality", "excess_mortality.csv"
+)
 REPR_CSV = (
     "https://github.com/crondonm/TrackingR/raw/main/Estimates-Database/database.csv"
 )
@@ -45,40 +69,90 @@ POL_CSV = os.path.join(INPUT_DIR, "bsg", "latest.csv")
 CODEBOOK_CSV = os.path.join(DATA_DIR, "owid-covid-codebook.csv")
 README_TMP = os.path.join(CURRENT_DIR, "README.md.template")
 README_FILE = os.path.join(DATA_DIR, "README.md")
+# Parquet & Arrow IPC (Feather) exports
+ARROW_DICTIONARY_COLUMNS = ["iso_code", "continent", "location"]
+ARROW_COMPRESSION = "zstd"
+ARROW_ROW_GROUP_SIZE = 50000
+# Incremental builds
+FINGERPRINTS_PATH = os.path.abspath(
+    os.path.join(CURRENT_DIR, "..", "output", "megafile", "fingerprints.json")
+)
+COMPLETE_DATASET_PARQUET = os.path.join(DATA_DIR, "owid-covid-data.parquet")
+# Packages with the code used by the build: any change to them triggers a full rebuild and
+# invalidates the cached inputs
+BUILD_PACKAGES = ["cowidev.megafile", "cowidev.utils"]
+# Changes since the previous build
+PATCH_NAME = "owid-covid-data-patch"
+PATCH_KEYS = ["iso_code", "date"]
+# Export stages: number of workers (None: one per writer, up to the number of CPUs), and whether
+# they are processes (threads otherwise), see ExportStage
+EXPORT_MAX_WORKERS = None
+EXPORT_PROCESSES = True
+# Cache of parsed inputs
+INPUT_CACHE = InputCache(code_modules=BUILD_PACKAGES)
+# Macro variables
+# - the key is the name of the variable of interest
+# - the value is the path to the corresponding file
+MACRO_VARIABLES = {
+    "population": "un/population_2020.csv",
+    "population_density": "wb/population_density.csv",
+    "median_age": "un/median_age.csv",
+    "aged_65_older": "wb/aged_65_older.csv",
+    "aged_70_older": "un/aged_70_older.csv",
+    "gdp_per_capita": "wb/gdp_per_capita.csv",
+    "extreme_poverty": "wb/extreme_poverty.csv",
+    "cardiovasc_death_rate": "gbd/cardiovasc_death_rate.csv",
+    "diabetes_prevalence": "wb/diabetes_prevalence.csv",
+    "female_smokers": "wb/female_smokers.csv",
+    "male_smokers": "wb/male_smokers.csv",
+    "handwashing_facilities": "un/handwashing_facilities.csv",
+    "hospital_beds_per_thousand": "owid/hospital_beds.csv",
+    "life_expectancy": "owid/life_expectancy.csv",
+    "human_development_index": "un/human_development_index.csv",
+}
+
+
+JHU_VARIABLES = [
+    "total_cases",
+    "new_cases",
+    "weekly_cases",
+    "total_deaths",
+    "new_deaths",
+    "weekly_deaths",
+    "total_cases_per_million",
+    "new_cases_per_million",
+    "weekly_cases_per_million",
+    "total_deaths_per_million",
+    "new_deaths_per_million",
+    "weekly_deaths_per_million",
+]
+JHU_SMOOTHED_VARIABLES = {
+    "weekly_cases": "new_cases_smoothed",
+    "weekly_deaths": "new_deaths_smoothed",
+    "weekly_cases_per_million": "new_cases_smoothed_per_million",
+    "weekly_deaths_per_million": "new_deaths_smoothed_per_million",
+}
 
 
-def get_jhu():
+def get_jhu(jhu_table=None):
     """
     Reads each COVID-19 JHU dataset located in /public/data/jhu/
     Melts the dataframe to vertical format (1 row per country and date)
     Merges all JHU dataframes into one with outer joins
 
+    If `jhu_table` is given, it is used instead of the CSV files. See get_jhu_from_table.
+
     Returns:
         jhu {dataframe}
     """
-
-    jhu_variables = [
-        "total_cases",
-        "new_cases",
-        "weekly_cases",
-        "total_deaths",
-        "new_deaths",
-        "weekly_deaths",
-        "total_cases_per_million",
-        "new_cases_per_million",
-        "weekly_cases_per_million",
-        "total_deaths_per_million",
-        "new_deaths_per_million",
-        "weekly_deaths_per_million",
-    ]
+    if jhu_table is not None:
+        return get_jhu_from_table(jhu_table)
 
     data_frames = []
 
     # Process each file and melt it to vertical format
-    for jhu_var in jhu_variables:
-        tmp = pd.read_csv(
-            os.path.join(DATA_DIR, f"../../public/data/jhu/{jhu_var}.csv")
-        )
+    for jhu_var in JHU_VARIABLES:
+        tmp = pd.read_csv(os.path.join(DATA_DIR, "jhu", f"{jhu_var}.csv"))
         country_cols = list(tmp.columns)
         country_cols.remove("date")
 
@@ -98,15 +172,7 @@ def get_jhu():
 
         if jhu_var[:7] == "weekly_":
             tmp[jhu_var] = tmp[jhu_var].div(7).round(3)
-            tmp = tmp.rename(
-                errors="ignore",
-                columns={
-                    "weekly_cases": "new_cases_smoothed",
-                    "weekly_deaths": "new_deaths_smoothed",
-                    "weekly_cases_per_million": "new_cases_smoothed_per_million",
-                    "weekly_deaths_per_million": "new_deaths_smoothed_per_million",
-                },
-            )
+            tmp = tmp.rename(errors="ignore", columns=JHU_SMOOTHED_VARIABLES)
         else:
             tmp[jhu_var] = tmp[jhu_var].round(3)
         data_frames.append(tmp)
@@ -121,9 +187,53 @@ def get_jhu():
     return jhu
 
 
+def get_jhu_from_table(jhu_table):
+    """
+    Builds the JHU dataset from the long-format table (1 row per country and date) that is
+    exported by jhu.py into the wide CSV files of /public/data/jhu/, without reading them back.
+    Produces the same output as get_jhu() would after the export.
+
+    Returns:
+        jhu {dataframe}
+    """
+    jhu = jhu_table[["date", "location"] + JHU_VARIABLES].copy()
+    jhu["date"] = pd.to_datetime(jhu["date"]).dt.strftime("%Y-%m-%d")
+    jhu[JHU_VARIABLES] = jhu[JHU_VARIABLES].astype(float)
+
+    # Carrying last observation forward for International totals to avoid discrepancies
+    # In the wide files, International has a row for every date of the table
+    if (jhu.location == "International").any():
+        total_cols = [col for col in JHU_VARIABLES if col[:5] == "total"]
+        international = (
+            jhu[jhu.location == "International"]
+            .set_index("date")
+            .reindex(sorted(jhu["date"].unique()))
+            .rename_axis("date")
+            .reset_index()
+            .assign(location="International")
+        )
+        international[total_cols] = international[total_cols].ffill()
+        jhu = pd.concat(
+            [jhu[jhu.location != "International"], international], ignore_index=True
+        )
+
+    # Exclude entities from megafile
+    jhu = jhu[jhu.location != "2020 Summer Olympics athletes & staff"]
+
+    weekly_cols = [col for col in JHU_VARIABLES if col[:7] == "weekly_"]
+    jhu[weekly_cols] = jhu[weekly_cols].div(7)
+    jhu[JHU_VARIABLES] = jhu[JHU_VARIABLES].round(3)
+
+    return (
+        jhu.dropna(subset=JHU_VARIABLES, how="all")
+        .rename(columns=JHU_SMOOTHED_VARIABLES)
+        .reset_index(drop=True)
+    )
+
+
 def get_reprod():
     reprod = pd.read_csv(
-        "https://github.com/crondonm/TrackingR/raw/main/Estimates-Database/database.csv",
+        REPR_CSV,
         usecols=["Country/Region", "Date", "R", "days_infectious"],
     )
     reprod = (
@@ -145,8 +255,9 @@ def get_reprod():
     return reprod
 
 
+@INPUT_CACHE.cached(lambda: [HOSP_CSV])
 def get_hosp():
-    hosp = pd.read_csv(os.path.join(GRAPHER_DIR, "COVID-2019 - Hospital & ICU.csv"))
+    hosp = pd.read_csv(HOSP_CSV)
     hosp = hosp.rename(
         columns={
             "Country": "location",
@@ -161,16 +272,14 @@ def get_hosp():
             "Weekly new hospital admissions per million": "weekly_hosp_admissions_per_million",
         }
     ).round(3)
-    hosp.loc[:, "date"] = (
-        ([pd.to_datetime("2020-01-21")] * hosp.shape[0])
-        + hosp["date"].apply(pd.offsets.Day)
-    ).astype(str)
+    hosp.loc[:, "date"] = days_to_dates(hosp["date"], zero_day="2020-01-21")
     return hosp
 
 
+@INPUT_CACHE.cached(lambda: [VACCINATIONS_CSV])
 def get_vax():
     vax = pd.read_csv(
-        os.path.join(DATA_DIR, "vaccinations/vaccinations.csv"),
+        VACCINATIONS_CSV,
         usecols=[
             "location",
             "date",
@@ -210,12 +319,36 @@ def get_testing():
     Rearranges the Entity column to separate location from testing units
     Checks for duplicated location/date couples, as we can have more than 1 time series per country
 
+    The parsed dataset is kept in memory for as long as its input files don't change, so that
+    it's only loaded once by the JHU pipeline (inject_exemplars) and the megafile.
+
     Returns:
         testing {dataframe}
     """
 
+    testing = _read_testing_once(
+        tuple(INPUT_CACHE.file_key(path) for path in get_testing_files())
+    )
+
+    # Remove observations for current day to avoid rows with testing data but no case/deaths
+    testing = testing[testing["date"] < str(date.today())]
+
+    return testing
+
+
+def get_testing_files():
+    return [TESTING_CSV, os.path.join(INPUT_DIR, "owid/secondary_testing_series.csv")]
+
+
+@lru_cache(maxsize=1)
+def _read_testing_once(file_keys):
+    return read_testing()
+
+
+@INPUT_CACHE.cached(get_testing_files)
+def read_testing():
     testing = pd.read_csv(
-        os.path.join(DATA_DIR, "testing/covid-testing-all-observations.csv"),
+        TESTING_CSV,
         usecols=[
             "Entity",
             "Date",
@@ -265,29 +398,15 @@ def get_testing():
         3
     )
 
-    # Split the original entity into location and testing units
-    testing[["location", "tests_units"]] = testing.location.str.split(
-        " - ", expand=True
-    )
-
-    # For locations with >1 series, choose a series
-    to_remove = pd.read_csv(
-        os.path.join(INPUT_DIR, "owid/secondary_testing_series.csv")
+    # Split the original entity into location and testing units, and for locations with >1
+    # series, choose a series
+    testing = select_series(
+        testing,
+        "location",
+        secondary=pd.read_csv(
+            os.path.join(INPUT_DIR, "owid/secondary_testing_series.csv")
+        ),
     )
-    for loc, unit in to_remove.itertuples(index=False, name=None):
-        testing = testing[
-            -((testing["location"] == loc) & (testing["tests_units"] == unit))
-        ]
-
-    # Check for remaining duplicates of location/date
-    duplicates = testing.groupby(["location", "date"]).size().to_frame("n")
-    duplicates = duplicates[duplicates["n"] > 1]
-    if duplicates.shape[0] > 0:
-        print(duplicates)
-        raise Exception("Multiple rows for the same location and date")
-
-    # Remove observations for current day to avoid rows with testing data but no case/deaths
-    testing = testing[testing["date"] < str(date.today())]
 
     return testing
 
@@ -298,14 +417,17 @@ def add_macro_variables(complete_dataset, macro_variables):
     The data is denormalized, i.e. each yearly value (for example GDP per capita)
     is added to each row of the complete dataset. This is meant to facilitate the use
     of our dataset by non-experts.
+
+    All variables are first gathered in a small table indexed by ISO code, which is then
+    broadcast to the complete dataset with a single lookup.
     """
     original_shape = complete_dataset.shape
 
-    for var, file in macro_variables.items():
-        var_df = pd.read_csv(os.path.join(INPUT_DIR, file), usecols=["iso_code", var])
-        var_df = var_df[-var_df["iso_code"].isnull()]
-        var_df[var] = var_df[var].round(3)
-        complete_dataset = complete_dataset.merge(var_df, on="iso_code", how="left")
+    static_variables = get_macro_variables(macro_variables).set_index("iso_code")
+
+    complete_dataset = broadcast_lookup(
+        complete_dataset, static_variables, on="iso_code"
+    )
 
     assert complete_dataset.shape[0] == original_shape[0]
     assert complete_dataset.shape[1] == original_shape[1] + len(macro_variables)
@@ -313,6 +435,27 @@ def add_macro_variables(complete_dataset, macro_variables):
     return complete_dataset
 
 
+@INPUT_CACHE.cached(
+    lambda macro_variables: [
+        os.path.join(INPUT_DIR, file) for file in macro_variables.values()
+    ]
+)
+def get_macro_variables(macro_variables):
+    """
+    Gathers all macro variables in a table with 1 row per ISO code.
+    """
+    static_variables = []
+    for var, file in macro_variables.items():
+        var_df = pd.read_csv(os.path.join(INPUT_DIR, file), usecols=["iso_code", var])
+        var_df = var_df[-var_df["iso_code"].isnull()]
+        var_df[var] = var_df[var].round(3)
+        static_variables.append(var_df.set_index("iso_code")[var])
+    return pd.concat(static_variables, axis=1).rename_axis("iso_code").reset_index()
+
+
+@INPUT_CACHE.cached(
+    lambda: [POL_CSV, os.path.join(INPUT_DIR, "bsg/bsg_country_standardised.csv")]
+)
 def get_cgrt():
     """
     Downloads the latest OxCGRT dataset from BSG's GitHub repository
@@ -322,15 +465,21 @@ def get_cgrt():
         cgrt {dataframe}
     """
 
-    cgrt = pd.read_csv(os.path.join(INPUT_DIR, "bsg/latest.csv"), low_memory=False)
+    # Only parse the columns that are used (RegionCode is absent from older files)
+    cgrt = pd.read_csv(
+        POL_CSV,
+        usecols=lambda col: col
+        in ["CountryName", "RegionCode", "Date", "StringencyIndex"],
+        dtype={"CountryName": str, "RegionCode": str, "Date": str},
+    )
 
     if "RegionCode" in cgrt.columns:
         cgrt = cgrt[cgrt.RegionCode.isnull()]
 
     cgrt = cgrt[["CountryName", "Date", "StringencyIndex"]]
 
-    cgrt.loc[:, "Date"] = pd.to_datetime(cgrt["Date"], format="%Y%m%d").dt.date.astype(
-        str
+    cgrt.loc[:, "Date"] = pd.to_datetime(cgrt["Date"], format="%Y%m%d").dt.strftime(
+        "%Y-%m-%d"
     )
 
     country_mapping = pd.read_csv(
@@ -356,57 +505,161 @@ def get_cgrt():
     return cgrt
 
 
-def add_excess_mortality(df: pd.DataFrame) -> pd.DataFrame:
+@INPUT_CACHE.cached(lambda: [EXCESS_MORTALITY_CSV])
+def get_excess_mortality():
     xm = pd.read_csv(
-        os.path.join(DATA_DIR, "excess_mortality/excess_mortality.csv"),
+        EXCESS_MORTALITY_CSV,
         usecols=["location", "date", "p_scores_all_ages"],
     )
-    df = df.merge(xm, how="left", on=["location", "date"]).rename(
-        columns={"p_scores_all_ages": "excess_mortality"}
-    )
-    return df
+    return xm.rename(columns={"p_scores_all_ages": "excess_mortality"})
 
 
-def dict_to_compact_json(d: dict):
-    """
-    Encodes a Python dict into valid, minified JSON.
-    """
-    return json.dumps(
-        d,
-        # Use separators without any trailing whitespace to minimize file size.
-        # The defaults (", ", ": ") contain a trailing space.
-        separators=(",", ":"),
-        # The json library by default encodes NaNs in JSON, but this is invalid JSON.
-        # By having this False, an error will be thrown if a NaN exists in the data.
-        allow_nan=False,
+def add_excess_mortality(df: pd.DataFrame, xm: pd.DataFrame) -> pd.DataFrame:
+    return broadcast_lookup(
+        df, xm.set_index(["location", "date"]), on=["location", "date"]
     )
 
 
-def df_to_json(complete_dataset, output_path, static_columns):
+def df_to_json(complete_dataset, output_path, static_columns, compression=None):
     """
     Writes a JSON version of the complete dataset, with the ISO code at the root.
     NA values are dropped from the output.
     Macro variables are normalized by appearing only once, at the root of each ISO code.
-    """
-    megajson = {}
 
+    The dataset is grouped by ISO code in a single pass and each country object is written to
+    the file as soon as it is built, so only one country is held in memory at a time. The output
+    is identical to serializing the whole nested dictionary at once.
+
+    Compressed variants of the file (see cowidev.utils.compression) are written in the same pass
+    if `compression` is given. Returns the paths of all files written.
+    """
     static_columns = ["continent", "location"] + list(static_columns)
 
     complete_dataset = complete_dataset.dropna(axis="rows", subset=["iso_code"])
+    # sort=False keeps ISO codes in order of first appearance, as iso_code.unique() would
+    countries = complete_dataset.drop(columns=["iso_code"]).groupby(
+        complete_dataset["iso_code"], sort=False
+    )
+
+    with open_with_variants(output_path, compression) as file:
+        file.write("{")
+        for i, (iso, country_df) in enumerate(countries):
+            if i > 0:
+                file.write(",")
+            file.write(to_compact_json(iso))
+            file.write(":")
+            file.write(to_compact_json(_country_to_dict(country_df, static_columns)))
+        file.write("}")
+    return [output_path] + variant_paths(output_path, compression)
+
+
+def create_location_shards(complete_dataset, output_dir, static_columns):
+    """
+    Writes one CSV and one JSON file per ISO code to by-location/, with a manifest of the row
+    count, date range and content hash of each of them. The dataset must be sorted by location:
+    each shard is a slice of it. JSON shards hold the same object as the ISO code's entry in
+    owid-covid-data.json. Returns the paths of all files written.
+    """
+    static_columns = ["continent", "location"] + list(static_columns)
+    return write_shards(
+        complete_dataset,
+        os.path.join(output_dir, "by-location"),
+        by="iso_code",
+        writers={
+            "csv": lambda df: df.to_csv(index=False),
+            "json": lambda df: to_compact_json(
+                _country_to_dict(df.drop(columns=["iso_code"]), static_columns)
+            ),
+        },
+    )
+
+
+def df_to_csv(df, output_path, compression=None):
+    """
+    Writes a CSV version of the complete dataset (without index), along with its compressed
+    variants if `compression` is given. Returns the paths of all files written.
+    """
+    with open_with_variants(
+        output_path, compression, encoding="utf-8", newline=""
+    ) as file:
+        df.to_csv(file, index=False)
+    return [output_path] + variant_paths(output_path, compression)
 
-    for iso in complete_dataset.iso_code.unique():
-        country_df = complete_dataset[complete_dataset.iso_code == iso].drop(
-            columns=["iso_code"]
-        )
-        static_data = country_df.head(1)[static_columns].to_dict("records")[0]
-        megajson[iso] = {k: v for k, v in static_data.items() if pd.notnull(v)}
-        megajson[iso]["data"] = [
-            {k: v for k, v in r.items() if pd.notnull(v)}
-            for r in country_df.drop(columns=static_columns).to_dict("records")
-        ]
 
-    with open(output_path, "w") as file:
-        file.write(dict_to_compact_json(megajson))
+def _country_to_dict(country_df, static_columns):
+    """
+    Builds the JSON object of a single country: static columns at the root and one record per
+    date under "data". NA values are dropped.
+    """
+    static_data = country_df.head(1)[static_columns].to_dict("records")[0]
+    country = {k: v for k, v in static_data.items() if pd.notnull(v)}
+    country["data"] = [
+        {k: v for k, v in r.items() if pd.notnull(v)}
+        for r in country_df.drop(columns=static_columns).to_dict("records")
+    ]
+    return country
+
+
+def df_to_arrow_table(complete_dataset):
+    """
+    Converts the complete dataset into an Arrow table:
+    - `iso_code`, `continent` and `location` are dictionary-encoded;
+    - `date` is stored as a date (date32) instead of a string.
+    """
+    df = complete_dataset.reset_index(drop=True)
+    for col in ARROW_DICTIONARY_COLUMNS:
+        df[col] = df[col].astype("category")
+    table = pa.Table.from_pandas(df.drop(columns=["date"]), preserve_index=False)
+    dates = pa.array(pd.to_datetime(df["date"]).values).cast(pa.date32())
+    return table.add_column(list(df.columns).index("date"), "date", dates)
+
+
+def _location_slices(complete_dataset, max_rows):
+    """
+    Splits the rows of a dataset sorted by location into consecutive (offset, length) slices
+    of at most `max_rows` rows, never splitting a location across two slices (unless a single
+    location has more than `max_rows` rows).
+    """
+    locations = complete_dataset["location"].to_numpy()
+    if len(locations) == 0:
+        return []
+    starts = np.flatnonzero(np.r_[True, locations[1:] != locations[:-1]])
+    ends = np.r_[starts[1:], len(locations)]
+    slices = []
+    offset = 0
+    for start, end in zip(starts, ends):
+        # Close the current slice before this location if it would not fit
+        if start > offset and end - offset > max_rows:
+            slices.append((offset, start - offset))
+            offset = start
+    slices.append((offset, len(locations) - offset))
+    return slices
+
+
+def df_to_parquet(complete_dataset, output_path):
+    """
+    Writes a compressed Parquet version of the complete dataset.
+    The dataset must be sorted by location and date. Row groups are aligned to locations so
+    that readers can skip whole row groups when filtering by location.
+    """
+    table = df_to_arrow_table(complete_dataset)
+    with pq.ParquetWriter(
+        output_path, table.schema, compression=ARROW_COMPRESSION
+    ) as writer:
+        for offset, length in _location_slices(complete_dataset, ARROW_ROW_GROUP_SIZE):
+            writer.write_table(table.slice(offset, length), row_group_size=length)
+
+
+def df_to_feather(complete_dataset, output_path):
+    """
+    Writes an Arrow IPC (Feather v2) version of the complete dataset.
+    As with Parquet, record batches are aligned to locations.
+    """
+    table = df_to_arrow_table(complete_dataset)
+    options = pa.ipc.IpcWriteOptions(compression=ARROW_COMPRESSION)
+    with pa.ipc.new_file(output_path, table.schema, options=options) as writer:
+        for offset, length in _location_slices(complete_dataset, ARROW_ROW_GROUP_SIZE):
+            writer.write_table(table.slice(offset, length), max_chunksize=length)
 
 
 def df_to_columnar_json(complete_dataset, output_path):
@@ -422,38 +675,32 @@ def df_to_columnar_json(complete_dataset, output_path):
             "date": ["2020-03-01", "2020-03-02", ... ]
         }
     """
-    # Replace NaNs with None in order to be serializable to JSON.
-    # JSON doesn't support NaNs, but it does have null which is represented as None in Python.
-    columnar_dict = complete_dataset.to_dict(orient="list")
-    for k, v in columnar_dict.items():
-        columnar_dict[k] = [x if pd.notnull(x) else None for x in v]
-    with open(output_path, "w") as file:
-        file.write(dict_to_compact_json(columnar_dict))
+    # Each column is encoded from its NumPy buffer, with NaNs written as null (JSON doesn't support NaNs).
+    to_columnar_json(complete_dataset, output_path)
 
 
-def create_latest(df):
+def create_latest(df, output_dir=DATA_DIR):
 
     df = df[df.date >= str(date.today() - timedelta(weeks=2))]
-    df = df.sort_values("date")
 
-    latest = [
-        df[df.location == loc].ffill().tail(1).round(3) for loc in set(df.location)
-    ]
-    latest = pd.concat(latest)
-    latest = latest.sort_values("location").rename(
-        columns={"date": "last_updated_date"}
-    )
+    # Last non-null value of each column, per location, in one grouped pass
+    latest = latest_snapshot(df, by="location", order_by="date").round(3)
+    latest = latest.rename(columns={"date": "last_updated_date"})
 
     print("Writing latest version…")
-    latest.to_csv(os.path.join(DATA_DIR, "latest/owid-covid-latest.csv"), index=False)
-    latest.to_excel(
-        os.path.join(DATA_DIR, "latest/owid-covid-latest.xlsx"), index=False
-    )
+    os.makedirs(os.path.join(output_dir, "latest"), exist_ok=True)
+    latest.to_csv(os.path.join(output_dir, "latest/owid-covid-latest.csv"), index=False)
+    to_xlsx(latest, os.path.join(output_dir, "latest/owid-covid-latest.xlsx"))
     latest.dropna(subset=["iso_code"]).set_index("iso_code").to_json(
-        os.path.join(DATA_DIR, "latest/owid-covid-latest.json"), orient="index"
+        os.path.join(output_dir, "latest/owid-covid-latest.json"), orient="index"
     )
 
 
+# These are "key" or "attribute" columns of the internal files.
+# These columns are ignored when dropping rows with dropna().
+INTERNAL_NON_VALUE_COLUMNS = ["iso_code", "continent", "location", "date", "population"]
+# Derived columns that are rounded when they are encoded
+INTERNAL_DECIMALS = {"cfr": 3}
 internal_files_columns = {
     "cases-tests": {
         "columns": [
@@ -576,150 +823,6 @@ internal_files_columns = {
 }
 
 
-class AnnotatorInternal:
-    """Adds annotations column.
-
-    Uses attribute `config` to add annotations. Its format should be as:
-    ```
-    {
-        "vaccinations": [{
-            'annotation_text': 'Data for China added on Jun 10',
-            'location': ['World', 'Asia', 'Upper middle income'],
-            'date': '2020-06-10'
-        }],
-        "case-tests": [{
-            'annotation_text': 'something',
-            'location': ['World', 'Asia', 'Upper middle income'],
-            'date': '2020-06-11'
-        }],
-    }
-    ```
-
-    Keys in config should match those in `internal_files_columns`.
-    """
-
-    def __init__(self, config: dict):
-        self._config = config
-
-    @classmethod
-    def from_yaml(cls, path):
-        with open(path, "r") as f:
-            dix = yaml.safe_load(f)
-        return cls(dix)
-
-    @property
-    def config(self):
-        for stream in self._config.keys():
-            self._config[stream] = sorted(self._config[stream], key=lambda x: x["date"])
-        return self._config
-
-    @property
-    def streams(self):
-        return list(self._config.keys())
-
-    def config_nested_to_flat(self, config):
-        """Convert class attribute config to a flattened dataframe.
-
-        Each row in the dataframe contains [stream, annotation_text, location, date]. Essentially, what gets flattened
-        is the `location` field, which originally contains a list of locations.
-
-        Args:
-            config (dict): Dictionary with original class config.
-
-        Returns:
-            pd.DataFrame: Table with config in a flatten version.
-        """
-        data_flat = []
-        for stream, config_ in config.items():
-            for d in config_:
-                for loc in d["location"]:
-                    data_flat.append(
-                        {
-                            "stream": stream,
-                            "annotation_text": d["annotation_text"],
-                            "date": d["date"],
-                            "location": loc,
-                        }
-                    )
-        return pd.DataFrame(data_flat)
-
-    def config_flat_to_nested(self, df_config):
-        """Converts flattened config dataframe to class instance format.
-
-        Args:
-            df_config (pd.DataFrame): Flattened config.
-
-        Returns:
-            dict: Dictionary with original data.
-        """
-        config_nested = {}
-        streams = df_config.stream.unique()
-        for stream in streams:
-            df_ = df_config[df_config.stream == stream]
-            rec = (
-                df_.groupby(["annotation_text", "date"])
-                .location.apply(list)
-                .reset_index()
-                .to_dict(orient="records")
-            )
-            config_nested[stream] = rec
-        return config_nested
-
-    def _remove_config_duplicates(self):
-        df_config = self.config_nested_to_flat(self._config)
-        df_config = df_config.drop_duplicates()
-        return self.config_flat_to_nested(df_config)
-
-    def insert_annotation(self, stream: str, annotation: dict):
-        # Checks
-        if (
-            "annotation_text" not in annotation
-            or "location" not in annotation
-            or "date" not in annotation
-        ):
-            raise ValueError(
-                "annotation dictionary must contain fields `annotation_text`, `location` and `date`"
-            )
-        if not (
-            isinstance(annotation["annotation_text"], str)
-            and isinstance(annotation["location"], list)
-            and isinstance(annotation["annotation_text"], str)
-        ):
-            raise ValueError(
-                f"Check `annotation` field types. `annotation_text` (str), `location` (list) and `date` (str)"
-            )
-        # Add annotation
-        self._config[stream].append(annotation)
-        # Remove duplicates
-        self._config = self._remove_config_duplicates()
-
-    def to_yaml(self):
-        pass
-
-    def add_annotations(self, df: pd.DataFrame, stream: str) -> pd.DataFrame:
-        if stream in self.streams:
-            print(f"Adding annotation for {stream}")
-            return self._add_annotations(df, stream)
-        return df
-
-    def _add_annotations(self, df: pd.DataFrame, stream: str) -> pd.DataFrame:
-        df = df.assign(annotations=pd.NA)
-        conf = self.config[stream]
-        for c in conf:
-            if not ("location" in c and "annotation_text" in c):
-                raise ValueError(
-                    f"Missing field in {stream} (`location` and `annotation_text` are required)."
-                )
-            if isinstance(c["location"], str):
-                mask = df.location == c["location"]
-            elif isinstance(c["location"], list):
-                mask = df.location.isin(c["location"])
-            if "date" in c:
-                mask = mask & (df.date >= c["date"])
-            df.loc[mask, "annotations"] = c["annotation_text"]
-        return df
-
-
 def add_annotations_countries_100_percentage(df, annotator):
     threshold_perc = 100
     locations_exc = (
@@ -728,38 +831,30 @@ def add_annotations_countries_100_percentage(df, annotator):
         .date.min()
         .to_dict()
     )
-    for loc, dt in locations_exc.items():
-        annotator.insert_annotation(
-            "vaccinations",
+    annotator.insert_annotations(
+        "vaccinations",
+        [
             {
                 "annotation_text": "Exceeds 100% due to vaccination of non-residents",
                 "location": [loc],
                 "date": dt,
-            },
-        )
+            }
+            for loc, dt in locations_exc.items()
+        ],
+    )
     return annotator
 
 
-def create_internal(df):
-    dir_path = os.path.join(DATA_DIR, "internal")
-    # Ensure internal/ dir is created
-    os.makedirs(dir_path, exist_ok=True)
-
-    # These are "key" or "attribute" columns.
-    # These columns are ignored when dropping rows with dropna().
-    non_value_columns = ["iso_code", "continent", "location", "date", "population"]
-
-    # Load annotations
-    annotator = AnnotatorInternal.from_yaml(ANNOTATIONS_PATH)
-
-    # Copy df
-    df = df.copy()
-
-    # Add new annotations for countries having >100% per-capita metric values (runtime, not stored in ANNOTATIONS_PATH)
-    annotator = add_annotations_countries_100_percentage(df, annotator)
+def get_internal_derived_columns(df):
+    """
+    Computes the columns of the internal files that are not in the complete dataset. Columns
+    have the same index and row order as `df`, which must be sorted by location and date.
+    """
+    derived = {}
     # Insert CFR column to avoid calculating it on the client, and enable
     # splitting up into cases & deaths columns.
-    df["cfr"] = (df["total_deaths"] * 100 / df["total_cases"]).round(3)
+    # Rounded when encoded (INTERNAL_DECIMALS)
+    derived["cfr"] = df["total_deaths"] * 100 / df["total_cases"]
 
     # Insert short-term CFR
     cfr_day_shift = 10  # We compute number of deaths divided by number of cases `cfr_day_shift` days before.
@@ -767,8 +862,9 @@ def create_internal(df):
         df.sort_values("date")
         .groupby("location")["new_cases_smoothed"]
         .shift(cfr_day_shift)
+        .reindex(df.index)
     )
-    df["cfr_short_term"] = (
+    cfr_short_term = (
         df["new_deaths_smoothed"]
         .div(shifted_cases)
         .replace(np.inf, np.nan)
@@ -776,53 +872,271 @@ def create_internal(df):
         .mul(100)
         .round(4)
     )
-
-    df.loc[
-        (df.cfr_short_term < 0)
-        | (df.cfr_short_term > 10)
-        | (df.date.astype(str) < "2020-09-01"),
-        "cfr_short_term",
-    ] = pd.NA
+    derived["cfr_short_term"] = cfr_short_term.mask(
+        (cfr_short_term < 0)
+        | (cfr_short_term > 10)
+        | (df.date.astype(str) < "2020-09-01")
+    )
 
     # Add partly vaccinated
-    df_a = df[df.location.isin(COUNTRIES_WITH_PARTLY_VAX_METRIC)]
-    for filename in country_vax_data_partly:
-        if not os.path.isfile(filename):
-            raise ValueError(f"Invalid file path! {filename}")
-        try:
-            x = pd.read_csv(
-                filename, usecols=["location", "date", "people_partly_vaccinated"]
-            )
-        except ValueError as e:
-            raise ValueError(f"{filename}: {e}")
-        df_a = df_a.merge(x, on=["location", "date"], how="outer")
-    df_b = df[~df.location.isin(COUNTRIES_WITH_PARTLY_VAX_METRIC)]
-    df_b.loc[:, "people_partly_vaccinated"] = (
-        df_b.people_vaccinated - df_b.people_fully_vaccinated
+    people_partly_vaccinated = df.people_vaccinated - df.people_fully_vaccinated
+    if country_vax_data_partly:
+        partly = []
+        for filename in country_vax_data_partly:
+            if not os.path.isfile(filename):
+                raise ValueError(f"Invalid file path! {filename}")
+            try:
+                partly.append(
+                    pd.read_csv(
+                        filename,
+                        usecols=["location", "date", "people_partly_vaccinated"],
+                    )
+                )
+            except ValueError as e:
+                raise ValueError(f"{filename}: {e}")
+        # Countries with a partly vaccinated metric take it from their own file instead
+        partly = broadcast_lookup(
+            df[["location", "date"]],
+            pd.concat(partly).set_index(["location", "date"]),
+            on=["location", "date"],
+        )["people_partly_vaccinated"]
+        people_partly_vaccinated = people_partly_vaccinated.where(
+            ~df.location.isin(COUNTRIES_WITH_PARTLY_VAX_METRIC), partly
+        )
+    derived["people_partly_vaccinated"] = people_partly_vaccinated
+    derived["people_partly_vaccinated_per_hundred"] = (
+        people_partly_vaccinated / df["population"] * 100
     )
-    df = pd.concat([df_a, df_b], ignore_index=True).sort_values(["location", "date"])
-    df.loc[:, "people_partly_vaccinated_per_hundred"] = (
-        df["people_partly_vaccinated"] / df["population"] * 100
+    return derived
+
+
+def write_internal_file(output_dir, name, columns, notna, annotator):
+    """
+    Writes the internal file `name` from the shared columns of the internal files. Only the
+    columns of the file are encoded, and they are filtered by row one at a time, so the file
+    is never materialized as a DataFrame.
+
+    Returns:
+        str: Path to the internal file.
+    """
+    config = internal_files_columns[name]
+    output_path = os.path.join(output_dir, f"megafile--{name}.json")
+    # Same as dropna(subset=value_columns, how=config["dropna"])
+    masks = [
+        notna[col] for col in config["columns"] if col not in INTERNAL_NON_VALUE_COLUMNS
+    ]
+    if config["dropna"] == "all":
+        rows = np.logical_or.reduce(masks)
+    else:
+        rows = np.logical_and.reduce(masks)
+    projection = {col: columns[col] for col in config["columns"]}
+    if name in annotator.streams:
+        annotated = annotator.add_annotations(
+            pd.DataFrame(
+                {
+                    "location": columns["location"].to_numpy()[rows],
+                    "date": columns["date"].to_numpy()[rows],
+                }
+            ),
+            name,
+        )
+        annotations = np.full(len(rows), pd.NA, dtype=object)
+        annotations[rows] = annotated["annotations"].to_numpy()
+        projection["annotations"] = pd.Series(annotations)
+    to_columnar_json(projection, output_path, INTERNAL_DECIMALS, rows=rows)
+    return output_path
+
+
+def create_internal(df, output_dir=DATA_DIR, profiler=None):
+    """
+    Writes the internal files (megafile--{name}.json) concurrently. `df` must be sorted by
+    location and date.
+    """
+    dir_path = os.path.join(output_dir, "internal")
+
+    # Load annotations
+    annotator = AnnotatorInternal.from_yaml(ANNOTATIONS_PATH)
+
+    # Add new annotations for countries having >100% per-capita metric values (runtime, not stored in ANNOTATIONS_PATH)
+    annotator = add_annotations_countries_100_percentage(df, annotator)
+    # Compile annotations before they are shared by the writers
+    for name in internal_files_columns:
+        if name in annotator.streams:
+            annotator.lookup_table(name)
+
+    # Columns of the complete dataset (not copied) and derived columns, shared by all files
+    columns = {col: df[col] for col in df.columns}
+    columns.update(get_internal_derived_columns(df))
+    # Null masks of the value columns, also computed once for all files
+    notna = {
+        col: values.notna().to_numpy()
+        for col, values in columns.items()
+        if col not in INTERNAL_NON_VALUE_COLUMNS
+    }
+
+    stage = ExportStage(
+        dir_path,
+        max_workers=EXPORT_MAX_WORKERS,
+        profiler=profiler,
+        name="export/internal",
+        processes=EXPORT_PROCESSES,
     )
+    for name in internal_files_columns:
+        stage.add(
+            name,
+            partial(
+                write_internal_file,
+                name=name,
+                columns=columns,
+                notna=notna,
+                annotator=annotator,
+            ),
+        )
+    stage.run()
+
+
+def generate_megafile(
+    jhu_table=None,
+    incremental=False,
+    profiler=None,
+    compression=None,
+    changelog=False,
+    shards=False,
+):
+    """
+    Builds and exports the megafile.
+
+    Args:
+        jhu_table (pd.DataFrame, optional): Long-format JHU table (1 row per location and date), as
+            exported by jhu.py. When given, JHU data is taken from it instead of reading back the
+            CSV files in /public/data/jhu/. Defaults to None.
+        incremental (bool, optional): Set to True to only rebuild the locations whose input data
+            changed since the last build, and splice them into the previous complete dataset.
+            Everything is rebuilt if there is no previous build, or if anything shared by all
+            locations changed (columns of the sources, static inputs or this script). Defaults to
+            False.
+        profiler (StageProfiler, optional): Profiler recording each stage of the build. Its report
+            is written to BUILD_REPORT_PATH. Defaults to None (a profiler without tracemalloc or
+            cProfile).
+        compression (dict or list, optional): Compressed variants ("gz", "zst") to write along
+            with owid-covid-data.csv and owid-covid-data.json, in the same pass. Can be a dictionary
+            with the compression level of each variant, e.g. {"gz": 9, "zst": 19}. Defaults to None
+            (no compressed variants).
+        changelog (bool, optional): Set to True to compare the new complete dataset with the
+            previous build (by ISO code and date), and write the inserted, updated and deleted rows
+            to PATCH_NAME.csv/.parquet with a summary in PATCH_NAME-summary.json. The patch is empty
+            if no location changed. Patch files of previous builds are removed if no patch is
+            written (changelog is False, or there is no previous build). Defaults to False.
+        shards (bool, optional): Set to True to also write one CSV and JSON file per ISO code in
+            by-location/, with a manifest (see create_location_shards). Defaults to False.
+    """
+    if profiler is None:
+        profiler = StageProfiler()
 
-    # Export
-    for name, config in internal_files_columns.items():
-        output_path = os.path.join(dir_path, f"megafile--{name}.json")
-        value_columns = list(set(config["columns"]) - set(non_value_columns))
-        df_output = df[config["columns"]].dropna(
-            subset=value_columns, how=config["dropna"]
+    sources = get_sources(jhu_table, profiler)
+
+    # Fingerprint each source per location. Today's datapoints are removed from the dataset, so
+    # they are not fingerprinted either.
+    with profiler.stage("fingerprints", inputs=sources):
+        fingerprints = SourceFingerprints.compute(
+            {name: df[df["date"] < str(date.today())] for name, df in sources.items()},
+            files=get_static_files(),
         )
-        df_output = annotator.add_annotations(df_output, name)
-        df_to_columnar_json(df_output, output_path)
 
+    locations = None
+    if incremental:
+        locations = fingerprints.changed_locations(
+            SourceFingerprints.load(FINGERPRINTS_PATH)
+        )
+        if locations is None or not os.path.isfile(COMPLETE_DATASET_PARQUET):
+            print("\nNo compatible previous build, rebuilding all locations…")
+            locations = None
+        elif not locations:
+            print("\nNo location changed since the last build, nothing to do!")
+            # The patch of the previous build must not be mistaken for the changes of this one
+            if changelog:
+                metadata = pq.read_metadata(COMPLETE_DATASET_PARQUET)
+                DatasetPatch.unchanged(
+                    metadata.schema.names, metadata.num_rows, PATCH_KEYS
+                ).write(DATA_DIR, PATCH_NAME)
+            else:
+                DatasetPatch.remove(DATA_DIR, PATCH_NAME)
+            return
+        else:
+            print(f"\nRebuilding {len(locations)} location(s): {sorted(locations)}")
+
+    # Previous build, needed to splice rebuilt locations and to compute the changelog
+    previous = None
+    if locations is not None or (
+        changelog and os.path.isfile(COMPLETE_DATASET_PARQUET)
+    ):
+        with profiler.stage("read_previous") as stage:
+            previous = stage.set_output(read_complete_dataset(COMPLETE_DATASET_PARQUET))
+
+    if locations is None:
+        all_covid = build_complete_dataset(sources, profiler)
+    else:
+        all_covid = build_complete_dataset(
+            {name: df[df.location.isin(locations)] for name, df in sources.items()},
+            profiler,
+        )
+        with profiler.stage("splice", inputs=all_covid) as stage:
+            all_covid = stage.set_output(
+                splice_locations(previous, all_covid, locations)
+            )
 
-def generate_megafile():
+    # Write all output files concurrently (CSV, XLSX, JSON, Parquet, Feather, latest, internal
+    # files and README). Files are only published if every writer succeeds.
+    print("Exporting files…")
+    with profiler.stage("export", inputs=all_covid):
+        build_export_stage(
+            all_covid,
+            MACRO_VARIABLES.keys(),
+            output_dir=DATA_DIR,
+            profiler=profiler,
+            compression=compression,
+            previous=previous if changelog else None,
+            shards=shards,
+        ).run()
+
+    # Without a new patch, the patch of a previous build would be left next to this one's outputs
+    if not changelog or previous is None:
+        DatasetPatch.remove(DATA_DIR, PATCH_NAME)
+
+    # Fingerprints are only stored once the outputs they describe have been published
+    fingerprints.save(FINGERPRINTS_PATH)
+
+    # Store the last updated time
+    timestamp_filename = os.path.join(
+        DATA_DIR, "owid-covid-data-last-updated-timestamp.txt"
+    )  # @deprecate
+    export_timestamp(timestamp_filename)  # @deprecate
+    timestamp_filename = os.path.join(
+        TIMESTAMP_DIR, "owid-covid-data-last-updated-timestamp-root.txt"
+    )
+
+    # Export timestamp
+    export_timestamp(timestamp_filename)
+
+    # Export build report (time & memory used by each stage)
+    os.makedirs(os.path.dirname(BUILD_REPORT_PATH), exist_ok=True)
+    profiler.to_json(BUILD_REPORT_PATH)
+
+    print("All done!")
+
+
+def get_sources(jhu_table=None, profiler=None):
+    """
+    Loads all the sources of the megafile, by name. Each one has 1 row per location and date.
+    """
+    if profiler is None:
+        profiler = StageProfiler()
 
     print("\nFetching JHU dataset…")
-    jhu = get_jhu()
+    jhu = profiler.wrap("get_jhu", get_jhu)(jhu_table)
 
     print("\nFetching reproduction rate…")
-    reprod = get_reprod()
+    reprod = profiler.wrap("get_reprod", get_reprod)()
 
     location_mismatch = set(reprod.location).difference(set(jhu.location))
     for loc in location_mismatch:
@@ -831,21 +1145,21 @@ def generate_megafile():
         )
 
     print("\nFetching hospital dataset…")
-    hosp = get_hosp()
+    hosp = profiler.wrap("get_hosp", get_hosp)()
 
     location_mismatch = set(hosp.location).difference(set(jhu.location))
     for loc in location_mismatch:
         print(f"<!> Location '{loc}' has hospital data but is absent from JHU data")
 
     print("\nFetching testing dataset…")
-    testing = get_testing()
+    testing = profiler.wrap("get_testing", get_testing)()
 
     location_mismatch = set(testing.location).difference(set(jhu.location))
     for loc in location_mismatch:
         print(f"<!> Location '{loc}' has testing data but is absent from JHU data")
 
     print("\nFetching vaccination dataset…")
-    vax = get_vax()
+    vax = profiler.wrap("get_vax", get_vax)()
     vax = vax[
         -vax.location.isin(
             [
@@ -862,17 +1176,64 @@ def generate_megafile():
     ]
 
     print("\nFetching OxCGRT dataset…")
-    cgrt = get_cgrt()
-
-    all_covid = (
-        jhu.merge(reprod, on=["date", "location"], how="left")
-        .merge(hosp, on=["date", "location"], how="outer")
-        .merge(testing, on=["date", "location"], how="outer")
-        .merge(vax, on=["date", "location"], how="outer")
-        .merge(cgrt, on=["date", "location"], how="left")
-        .sort_values(["location", "date"])
+    cgrt = profiler.wrap("get_cgrt", get_cgrt)()
+
+    print("\nFetching excess mortality dataset…")
+    xm = profiler.wrap("get_excess_mortality", get_excess_mortality)()
+
+    return {
+        "JHU": jhu,
+        "reproduction rate": reprod,
+        "hospital": hosp,
+        "testing": testing,
+        "vaccinations": vax,
+        "OxCGRT": cgrt,
+        "excess mortality": xm,
+    }
+
+
+def get_static_files():
+    """
+    Files that affect all locations: any change to them triggers a full rebuild. This includes
+    the code of the build, in this script and in the packages of BUILD_PACKAGES.
+    """
+    return (
+        [
+            os.path.abspath(__file__),
+            os.path.join(INPUT_DIR, "iso/iso3166_1_alpha_3_codes.csv"),
+            os.path.join(INPUT_DIR, "owid/continents.csv"),
+        ]
+        + [os.path.join(INPUT_DIR, file) for file in MACRO_VARIABLES.values()]
+        + source_files(*BUILD_PACKAGES)
     )
 
+
+def build_complete_dataset(sources, profiler=None):
+    """
+    Builds the complete dataset from the sources loaded by get_sources.
+    Every step works row by row or location by location, so building the dataset from the
+    sources of a subset of locations gives the rows of these locations in the complete dataset.
+    """
+    if profiler is None:
+        profiler = StageProfiler()
+
+    # Same as chaining pairwise merges on location & date, in this order, but all sources are
+    # aligned on a shared (location, date) index at once
+    with profiler.stage("join", inputs=sources) as stage:
+        all_covid = stage.set_output(
+            join_sources(
+                [
+                    ("JHU", sources["JHU"], "outer"),
+                    ("reproduction rate", sources["reproduction rate"], "left"),
+                    ("hospital", sources["hospital"], "outer"),
+                    ("testing", sources["testing"], "outer"),
+                    ("vaccinations", sources["vaccinations"], "outer"),
+                    ("OxCGRT", sources["OxCGRT"], "left"),
+                ],
+                on=["location", "date"],
+            ).sort_values(["location", "date"])
+        )
+
     # Remove today's datapoint
     all_covid = all_covid[all_covid["date"] < str(date.today())]
 
@@ -885,8 +1246,6 @@ def generate_megafile():
         print(missing_iso)
         raise Exception("Missing ISO code for some locations")
 
-    all_covid = iso_codes.merge(all_covid, on="location")
-
     # Add continents
     print("Adding continents…")
     continents = pd.read_csv(
@@ -896,80 +1255,142 @@ def generate_megafile():
         header=0,
     )
 
-    all_covid = continents.merge(all_covid, on="iso_code", how="right")
+    # ISO codes and continents are looked up by location at once
+    with profiler.stage("add_location_codes", inputs=all_covid) as stage:
+        location_codes = iso_codes.merge(continents, on="iso_code", how="left")
+        all_covid = stage.set_output(
+            broadcast_lookup(
+                all_covid,
+                location_codes.set_index("location")[["iso_code", "continent"]],
+                on="location",
+                prepend=True,
+            )
+        )
 
     # Add macro variables
-    # - the key is the name of the variable of interest
-    # - the value is the path to the corresponding file
-    macro_variables = {
-        "population": "un/population_2020.csv",
-        "population_density": "wb/population_density.csv",
-        "median_age": "un/median_age.csv",
-        "aged_65_older": "wb/aged_65_older.csv",
-        "aged_70_older": "un/aged_70_older.csv",
-        "gdp_per_capita": "wb/gdp_per_capita.csv",
-        "extreme_poverty": "wb/extreme_poverty.csv",
-        "cardiovasc_death_rate": "gbd/cardiovasc_death_rate.csv",
-        "diabetes_prevalence": "wb/diabetes_prevalence.csv",
-        "female_smokers": "wb/female_smokers.csv",
-        "male_smokers": "wb/male_smokers.csv",
-        "handwashing_facilities": "un/handwashing_facilities.csv",
-        "hospital_beds_per_thousand": "owid/hospital_beds.csv",
-        "life_expectancy": "owid/life_expectancy.csv",
-        "human_development_index": "un/human_development_index.csv",
-    }
-    all_covid = add_macro_variables(all_covid, macro_variables)
+    with profiler.stage("add_macro_variables", inputs=all_covid) as stage:
+        all_covid = stage.set_output(add_macro_variables(all_covid, MACRO_VARIABLES))
 
     # Add excess mortality
-    all_covid = add_excess_mortality(all_covid)
+    with profiler.stage("add_excess_mortality", inputs=all_covid) as stage:
+        all_covid = stage.set_output(
+            add_excess_mortality(all_covid, sources["excess mortality"])
+        )
 
-    # Sort by location and date
-    all_covid = all_covid.sort_values(["location", "date"])
+    # Lookups above preserve row order, so the data is still sorted by location and date
 
     # Check that we only have 1 unique row for each location/date pair
-    assert (
-        all_covid.drop_duplicates(subset=["location", "date"]).shape == all_covid.shape
-    )
+    assert not all_covid.duplicated(subset=["location", "date"]).any()
 
-    # Create light versions of complete dataset with only the latest data point
-    create_latest(all_covid)
+    return all_covid
 
-    print("Writing to CSV…")
 
-    all_covid.to_csv(os.path.join(DATA_DIR, "owid-covid-data.csv"), index=False)
+def read_complete_dataset(path):
+    """
+    Reads back a complete dataset exported with df_to_parquet, with the same dtypes as the
+    dataset built by build_complete_dataset.
+    """
+    df = pq.read_table(path).to_pandas()
+    for col in ARROW_DICTIONARY_COLUMNS:
+        df[col] = df[col].astype(object)
+    df["date"] = pd.to_datetime(df["date"]).dt.strftime("%Y-%m-%d")
+    return df
 
-    print("Writing to XLSX…")
-    all_covid.to_excel(
-        os.path.join(DATA_DIR, "owid-covid-data.xlsx"), index=False, engine="xlsxwriter"
-    )
 
-    print("Writing to JSON…")
-    df_to_json(
-        all_covid,
-        os.path.join(DATA_DIR, "owid-covid-data.json"),
-        macro_variables.keys(),
+def splice_locations(previous, rebuilt, locations):
+    """
+    Replaces the rows of `locations` in a previous complete dataset by the rebuilt ones. Rows of
+    locations that are no longer in the sources are dropped.
+    """
+    if set(previous.columns) != set(rebuilt.columns):
+        raise ValueError(
+            "Previous complete dataset has different columns, run a full rebuild instead!"
+        )
+    previous = previous[~previous.location.isin(locations)]
+    return (
+        pd.concat([previous[rebuilt.columns], rebuilt], ignore_index=True)
+        .sort_values(["location", "date"], kind="mergesort")
+        .reset_index(drop=True)
     )
 
-    print("Creating internal files…")
 
-    create_internal(all_covid)
-
-    # Store the last updated time
-    timestamp_filename = os.path.join(
-        DATA_DIR, "owid-covid-data-last-updated-timestamp.txt"
-    )  # @deprecate
-    export_timestamp(timestamp_filename)  # @deprecate
-    timestamp_filename = os.path.join(
-        TIMESTAMP_DIR, "owid-covid-data-last-updated-timestamp-root.txt"
+def build_export_stage(
+    all_covid,
+    static_columns,
+    output_dir=DATA_DIR,
+    profiler=None,
+    compression=None,
+    previous=None,
+    shards=False,
+):
+    """
+    Builds the export stage of the megafile. All writers read the same complete dataset, which
+    is shared with the worker processes (or threads) without being copied, and must not modify it.
+    If `compression` is given, compressed variants of the CSV and JSON files are also written;
+    variants of earlier exports that aren't written this time are removed when publishing.
+    If the `previous` complete dataset is given, the changes since then are also written.
+    If `shards` is True, per-location files are also written, replacing those of the previous
+    export (by-location/ is removed otherwise, so that it doesn't go stale).
+    """
+    stage = ExportStage(
+        output_dir,
+        max_workers=EXPORT_MAX_WORKERS,
+        profiler=profiler,
+        processes=EXPORT_PROCESSES,
     )
-
-    print("Generating public/data/README.md")
-    generate_readme()
-
-    # Export timestamp
-    export_timestamp(timestamp_filename)
-
-    print("All done!")
+    # Light versions of complete dataset with only the latest data point
+    stage.add("latest", lambda out: create_latest(all_covid, out))
+    stage.add(
+        "csv",
+        lambda out: df_to_csv(
+            all_covid, os.path.join(out, "owid-covid-data.csv"), compression
+        ),
+    )
+    stage.add(
+        "xlsx",
+        lambda out: to_xlsx(all_covid, os.path.join(out, "owid-covid-data.xlsx")),
+    )
+    stage.add(
+        "json",
+        lambda out: df_to_json(
+            all_covid,
+            os.path.join(out, "owid-covid-data.json"),
+            static_columns,
+            compression,
+        ),
+    )
+    stage.add(
+        "parquet",
+        lambda out: df_to_parquet(
+            all_covid, os.path.join(out, "owid-covid-data.parquet")
+        ),
+    )
+    stage.add(
+        "feather",
+        lambda out: df_to_feather(
+            all_covid, os.path.join(out, "owid-covid-data.feather")
+        ),
+    )
+    stage.add("internal", lambda out: create_internal(all_covid, out, profiler))
+    stage.add("readme", lambda out: generate_readme(os.path.join(out, "README.md")))
+    for filename in ["owid-covid-data.csv", "owid-covid-data.json"]:
+        stage.remove(*stale_variant_paths(filename, compression))
+    if shards:
+        stage.add(
+            "shards",
+            lambda out: create_location_shards(all_covid, out, static_columns),
+        )
+        stage.replace_directory("by-location")
+    else:
+        stage.remove("by-location")
+    if previous is not None:
+        stage.add(
+            "changelog",
+            lambda out: DatasetPatch.compute(previous, all_covid, PATCH_KEYS).write(
+                out, PATCH_NAME
+            ),
+        )
+    return stage
 
 
 def export_timestamp(timestamp_filename):
@@ -1021,25 +1442,8 @@ def get_num_countries_jhu(csv_filepath):
 
 
 def load_macro_df():
-    macro_variables = {
-        "population": "un/population_2020.csv",
-        "population_density": "wb/population_density.csv",
-        "median_age": "un/median_age.csv",
-        "aged_65_older": "wb/aged_65_older.csv",
-        "aged_70_older": "un/aged_70_older.csv",
-        "gdp_per_capita": "wb/gdp_per_capita.csv",
-        "extreme_poverty": "wb/extreme_poverty.csv",
-        "cardiovasc_death_rate": "gbd/cardiovasc_death_rate.csv",
-        "diabetes_prevalence": "wb/diabetes_prevalence.csv",
-        "female_smokers": "wb/female_smokers.csv",
-        "male_smokers": "wb/male_smokers.csv",
-        "handwashing_facilities": "un/handwashing_facilities.csv",
-        "hospital_beds_per_thousand": "owid/hospital_beds.csv",
-        "life_expectancy": "owid/life_expectancy.csv",
-        "human_development_index": "un/human_development_index.csv",
-    }
     dfs = []
-    for var, file in macro_variables.items():
+    for var, file in MACRO_VARIABLES.items():
         dfs.append(
             pd.read_csv(os.path.join(INPUT_DIR, file), usecols=["iso_code", var])
         )
@@ -1091,13 +1495,67 @@ def get_placeholder():
     return placeholders
 
 
-def generate_readme():
+def generate_readme(output_path=README_FILE):
     placeholders = get_placeholder()
     with open(README_TMP, "r") as fr:
         s = fr.read().format(**placeholders)
-        with open(README_FILE, "w") as fw:
+        with open(output_path, "w") as fw:
             fw.write(s)
 
 
 if __name__ == "__main__":
-    generate_megafile()
+    parser = argparse.ArgumentParser(description="Build the megafile")
+    parser.add_argument(
+        "--clear-cache",
+        action="store_true",
+        help="Clear the cache of parsed inputs and exit",
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="Only rebuild the locations whose input data changed since the last build",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Record the top memory allocators of each stage in the build report (slower)",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        help="Directory where to dump a cProfile profile of each stage",
+    )
+    parser.add_argument(
+        "--changelog",
+        action="store_true",
+        help="Write the rows inserted, updated and deleted since the previous build",
+    )
+    parser.add_argument(
+        "--shards",
+        action="store_true",
+        help="Also write one CSV and JSON file per location in by-location/",
+    )
+    parser.add_argument(
+        "--compress",
+        nargs="+",
+        choices=["gz", "zst"],
+        help="Also write compressed variants of the CSV and JSON files",
+    )
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        help="Compression level of the variants (defaults to 6 for gz, 3 for zst)",
+    )
+    args = parser.parse_args()
+    if args.clear_cache:
+        INPUT_CACHE.clear()
+    else:
+        generate_megafile(
+            incremental=args.incremental,
+            profiler=StageProfiler(
+                trace_memory=args.trace_memory, profile_dir=args.profile_dir
+            ),
+            compression=dict.fromkeys(args.compress or [], args.compression_level),
+            changelog=args.changelog,
+            shards=args.shards,
+        )
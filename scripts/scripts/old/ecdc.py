@@ -9,11 +9,13 @@ from termcolor import colored
 CURRENT_DIR = os.path.dirname(__file__)
 sys.path.append(CURRENT_DIR)
 
+from cowidev.utils.rolling import GroupedWindows
+
 import megafile
 from shared import load_population, load_owid_continents, inject_total_daily_cols, \
     inject_owid_aggregates, inject_per_million, inject_days_since, inject_cfr, inject_population, \
-    inject_rolling_avg, inject_exemplars, inject_doubling_days, inject_weekly_growth, \
-    inject_biweekly_growth, standard_export, ZERO_DAY
+    inject_rolling_avg, inject_exemplars, inject_doubling_days, blank_zero_totals, \
+    inject_weekly_growth, inject_biweekly_growth, standard_export, ZERO_DAY
 
 from utils.slack_client import send_warning, send_success
 from utils.db_imports import import_dataset
@@ -209,7 +211,7 @@ def discard_rows(df):
 
 # Must output columns:
 # date, location, new_cases, new_deaths, total_cases, total_deaths
-def load_standardized(filename):
+def load_standardized(filename, testing_locations):
     df = _load_merged(filename) \
         .drop(columns=[
             'countriesAndTerritories', 'geoId',
@@ -224,9 +226,12 @@ def load_standardized(filename):
     df = inject_owid_aggregates(df)
     df = discard_rows(df)
     df = inject_total_daily_cols(df, ['cases', 'deaths'])
-    df = inject_weekly_growth(df)
-    df = inject_biweekly_growth(df)
-    df = inject_doubling_days(df)
+    # The next steps keep the rows (and their order), so they share the same windows
+    windows = GroupedWindows(df, by='location', order_by='date')
+    df = inject_weekly_growth(df, windows)
+    df = inject_biweekly_growth(df, windows)
+    df = inject_doubling_days(df, windows)
+    df = blank_zero_totals(df)
     df = inject_per_million(df, [
         'new_cases',
         'new_deaths',
@@ -237,10 +242,10 @@ def load_standardized(filename):
         'biweekly_cases',
         'biweekly_deaths'
     ])
-    df = inject_rolling_avg(df)
+    df = inject_rolling_avg(df, windows)
     df = inject_cfr(df)
     df = inject_days_since(df)
-    df = inject_exemplars(df)
+    df = inject_exemplars(df, testing_locations)
     return df.sort_values(by=['location', 'date'])
 
 def export(filename):
@@ -259,8 +264,9 @@ def export(filename):
     df_loc['population'] = df_loc['population'].round().astype('Int64')
     df_loc.to_csv(os.path.join(OUTPUT_PATH, 'locations.csv'), index=False)
     # The rest of the CSVs
+    testing_locations = set(megafile.get_testing()['location'])
     return standard_export(
-        load_standardized(filename),
+        load_standardized(filename, testing_locations),
         OUTPUT_PATH,
         DATASET_NAME
     )
@@ -4,6 +4,8 @@ import pandas as pd
 import pytz
 from datetime import datetime
 
+from cowidev.utils.grapher_dates import dates_to_days
+
 CURRENT_DIR = os.path.dirname(__file__)
 sys.path.append(CURRENT_DIR)
 
@@ -18,7 +20,6 @@ INPUT_CSV_PATH = os.path.join(INPUT_PATH, "latest.csv")
 OUTPUT_CSV_PATH = os.path.join(OUTPUT_PATH, f"{DATASET_NAME}.csv")
 
 ZERO_DAY = "2020-01-01"
-zero_day = datetime.strptime(ZERO_DAY, "%Y-%m-%d")
 
 
 def download_csv():
@@ -63,9 +64,7 @@ def export_grapher():
 
     cgrt = cgrt[cols]
 
-    cgrt.loc[:, "Date"] = pd.to_datetime(cgrt["Date"], format="%Y%m%d").map(
-        lambda date: (date - zero_day).days
-    )
+    cgrt.loc[:, "Date"] = dates_to_days(cgrt["Date"], ZERO_DAY, format="%Y%m%d")
 
     rows_before = cgrt.shape[0]
 
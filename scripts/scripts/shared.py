@@ -2,12 +2,14 @@ import sys
 import pandas as pd
 import numpy as np
 import os
-from datetime import datetime
 
 CURRENT_DIR = os.path.dirname(__file__)
 sys.path.append(CURRENT_DIR)
 
-import megafile
+from cowidev.utils.aggregates import sum_aggregates
+from cowidev.utils.compression import open_with_variants, remove_stale_variants
+from cowidev.utils.grapher_dates import dates_to_days, to_datetime64
+from cowidev.utils.rolling import GroupedWindows
 
 POPULATION_CSV_PATH = os.path.join(CURRENT_DIR, "../input/un/population_2020.csv")
 CONTINENTS_CSV_PATH = os.path.join(CURRENT_DIR, "../input/owid/continents.csv")
@@ -15,7 +17,6 @@ WB_INCOME_GROUPS_CSV_PATH = os.path.join(CURRENT_DIR, "../input/wb/income_groups
 EU_COUNTRIES_CSV_PATH = os.path.join(CURRENT_DIR, "../input/owid/eu_countries.csv")
 
 ZERO_DAY = "2020-01-21"
-zero_day = datetime.strptime(ZERO_DAY, "%Y-%m-%d")
 
 # =========
 # Utilities
@@ -145,26 +146,9 @@ aggregates_spec = {
 }
 
 
-def _sum_aggregate(df, name, include=None, exclude=None):
-    df = df.copy()
-    if include:
-        df = df[df["location"].isin(include)]
-    if exclude:
-        df = df[~df["location"].isin(exclude)]
-    df = df.groupby("date").sum().reset_index()
-    df["location"] = name
-    return df
-
-
 def inject_owid_aggregates(df):
     return pd.concat(
-        [
-            df,
-            *[
-                _sum_aggregate(df, name, **params)
-                for name, params in aggregates_spec.items()
-            ],
-        ],
+        [df, sum_aggregates(df, aggregates_spec)],
         sort=True,
         ignore_index=True,
     )
@@ -266,42 +250,82 @@ days_since_spec = {
 }
 
 
-def _get_date_of_threshold(df, col, threshold):
-    try:
-        return df["date"][df[col] >= threshold].iloc[0]
-    except:
-        return None
+def _first_dates_of_threshold(codes, n_groups, dates, values, threshold):
+    """Date of the first row of each group where `values` reach `threshold` (NaT if they never do)."""
+    first_dates = np.full(n_groups + 1, np.datetime64("NaT"), dtype="datetime64[D]")
+    positions = np.flatnonzero((values >= threshold) & (codes >= 0))
+    groups, first = np.unique(codes[positions], return_index=True)
+    first_dates[groups] = dates[positions[first]]
+    return first_dates
 
 
-def _date_diff(a, b, positive_only=False):
-    if pd.isnull(a) or pd.isnull(b):
-        return None
-    diff = (a - b).days
-    if positive_only and diff < 0:
-        return None
-    return diff
+def inject_days_since(df):
+    """Adds the columns of `days_since_spec`, computed for all locations at once.
 
+    The reference date of each location is the date of its first row (in the order of `df`) where the value
+    reaches the threshold. Days are missing before that date if `positive_only`, and for all rows of locations
+    that never reach the threshold.
+    """
+    df = df.copy()
+    codes, locations = pd.factorize(df["location"])
+    dates = to_datetime64(df["date"])
+    for col, spec in days_since_spec.items():
+        values = df[spec["value_col"]].to_numpy(dtype=np.float64, na_value=np.nan)
+        # Rows with a missing location (code -1) get the last entry, NaT
+        ref_dates = _first_dates_of_threshold(
+            codes, len(locations), dates, values, spec["value_threshold"]
+        )[codes]
+        days = dates - ref_dates
+        missing = np.isnat(days)
+        days = np.where(missing, 0, days.astype(np.int64))
+        if spec["positive_only"]:
+            missing |= days < 0
+        df[col] = pd.arrays.IntegerArray(days, missing)
+    return df
 
-def _days_since(df, spec):
-    ref_date = pd.to_datetime(
-        _get_date_of_threshold(df, spec["value_col"], spec["value_threshold"])
-    )
-    return (
-        pd.to_datetime(df["date"])
-        .map(lambda date: _date_diff(date, ref_date, spec["positive_only"]))
-        .astype("Int64")
-    )
 
+# ===============
+# Derived columns
+# ===============
 
-def inject_days_since(df):
-    df = df.copy()
-    for col, spec in days_since_spec.items():
-        df[col] = (
-            df[["date", "location", spec["value_col"]]]
-            .groupby("location")
-            .apply(lambda df_group: _days_since(df_group, spec))
-            .reset_index(level=0, drop=True)
-        )
+# Each derived column takes `value` (a column, or a constant) in the rows where every column of `min_values` is at
+# least its minimum (missing values never are), and `otherwise` (missing by default) in the other rows. With
+# `with_testing`, rows must also be of a location with testing data.
+cfr_derived_spec = {
+    "cfr_100_cases": {
+        "value": "cfr",
+        "min_values": {"total_cases": 100},
+    },
+}
+
+exemplars_spec = {
+    "days_since_100_total_cases_and_5m_pop": {
+        "value": "days_since_100_total_cases",
+        "min_values": {"population": 5e6},
+    },
+    # Use int because the Grapher doesn't handle non-ints very well
+    "5m_pop_and_21_days_since_100_cases_and_testing": {
+        "value": 1,
+        "otherwise": 0,
+        "min_values": {"days_since_100_total_cases": 21, "population": 5e6},
+        "with_testing": True,
+    },
+}
+
+
+def inject_derived_columns(df, spec, testing_locations=None):
+    """Adds the columns of `spec` (see above), computed with masks over whole columns."""
+    for col, derived in spec.items():
+        mask = np.ones(len(df), dtype=bool)
+        for min_col, min_value in derived["min_values"].items():
+            mask &= (df[min_col] >= min_value).fillna(False).to_numpy(dtype=bool)
+        if derived.get("with_testing"):
+            mask &= df["location"].isin(testing_locations).to_numpy()
+        value = derived["value"]
+        if isinstance(value, str):
+            df[col] = df[value].where(mask)
+        else:
+            df[col] = np.where(mask, value, derived.get("otherwise", np.nan))
     return df
 
 
@@ -310,16 +334,10 @@ def inject_days_since(df):
 # ===================
 
 
-def _apply_row_cfr_100(row):
-    if pd.notnull(row["total_cases"]) and row["total_cases"] >= 100:
-        return row["cfr"]
-    return pd.NA
-
-
 def inject_cfr(df):
     cfr_series = (df["total_deaths"] / df["total_cases"]) * 100
     df["cfr"] = cfr_series.round(decimals=3)
-    df["cfr_100_cases"] = df.apply(_apply_row_cfr_100, axis=1)
+    df = inject_derived_columns(df, cfr_derived_spec)
 
     shifted_cases = (
         df.sort_values("date").groupby("location")["new_cases_7_day_avg_right"].shift(9)
@@ -398,21 +416,24 @@ rolling_avg_spec = {
 }
 
 
-def inject_rolling_avg(df):
-    df = df.copy().sort_values(by="date")
+def _location_windows(df, windows=None):
+    """Rolling windows over the rows of `df` by location and date. Steps that compute windows take them as
+    `windows`, so that callers running several of them on the same rows sort the rows only once."""
+    if windows is None:
+        windows = GroupedWindows(df, by="location", order_by="date")
+    return windows
+
+
+def inject_rolling_avg(df, windows=None):
+    df = df.copy()
+    windows = _location_windows(df, windows)
     for col, spec in rolling_avg_spec.items():
-        df[col] = df[spec["col"]].astype("float")
-        df[col] = (
-            df.groupby("location")[col]
-            .rolling(
-                window=spec["window"],
-                min_periods=spec["min_periods"],
-                center=spec["center"],
-            )
-            .mean()
-            .round(decimals=5)
-            .reset_index(level=0, drop=True)
-        )
+        df[col] = windows.mean(
+            df[spec["col"]],
+            window=spec["window"],
+            min_periods=spec["min_periods"],
+            center=spec["center"],
+        ).round(decimals=5)
     return df
 
 
@@ -421,34 +442,13 @@ def inject_rolling_avg(df):
 # ===========================
 
 
-def inject_exemplars(df):
-    df = inject_population(df)
-
-    # Inject days since 100th case IF population ≥ 5M
-    def mapper_days_since(row):
-        if pd.notnull(row["population"]) and row["population"] >= 5e6:
-            return row["days_since_100_total_cases"]
-        return pd.NA
-
-    df["days_since_100_total_cases_and_5m_pop"] = df.apply(mapper_days_since, axis=1)
-
-    # Inject boolean when all exenplar conditions hold
-    # Use int because the Grapher doesn't handle non-ints very well
-    countries_with_testing_data = set(megafile.get_testing()["location"])
-
-    def mapper_bool(row):
-        if (
-            pd.notnull(row["days_since_100_total_cases"])
-            and pd.notnull(row["population"])
-            and row["days_since_100_total_cases"] >= 21
-            and row["population"] >= 5e6
-            and row["location"] in countries_with_testing_data
-        ):
-            return 1
-        return 0
-
-    df["5m_pop_and_21_days_since_100_cases_and_testing"] = df.apply(mapper_bool, axis=1)
+def inject_exemplars(df, testing_locations):
+    """Adds the columns of `exemplars_spec`.
 
+    `testing_locations` are the locations with testing data (e.g. `set(megafile.get_testing()["location"])`).
+    """
+    df = inject_population(df)
+    df = inject_derived_columns(df, exemplars_spec, testing_locations)
     return drop_population(df)
 
 
@@ -477,22 +477,56 @@ doubling_days_spec = {
 
 
 def pct_change_to_doubling_days(pct_change, periods):
-    if pd.notnull(pct_change) and pct_change != 0:
-        doubling_days = periods * np.log(2) / np.log(1 + pct_change)
-        return np.round(doubling_days, decimals=2)
-    return pd.NA
+    """Doubling days of (arrays of) growth rates over `periods` days. Missing and zero rates give NaN."""
+    pct_change = np.asarray(pct_change, dtype=np.float64)
+    valid = ~np.isnan(pct_change) & (pct_change != 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        doubling_days = periods * np.log(2) / np.log(1 + np.where(valid, pct_change, 1))
+    return np.where(valid, np.round(doubling_days, decimals=2), np.nan)
+
+
+def doubling_days(values, windows, periods):
+    """Doubling days of `values` at their growth rate over each of `periods` (rows before, in the same group).
 
+    Zero values are treated as missing. `values` are not modified.
 
-def inject_doubling_days(df):
+    Args:
+        values (pd.Series or np.ndarray): Cumulative values (e.g. total cases).
+        windows (GroupedWindows): Groups and order of the rows of `values`.
+        periods (list): Periods to compute doubling days over.
+
+    Returns:
+        dict: Doubling days over each period.
+    """
+    values = pd.Series(values).to_numpy(dtype=np.float64, na_value=np.nan)
+    values = np.where(values == 0, np.nan, values)
+    return {
+        period: pct_change_to_doubling_days(windows.pct_change(values, period), period)
+        for period in periods
+    }
+
+
+def inject_doubling_days(df, windows=None):
+    df = df.copy()
+    windows = _location_windows(df, windows)
+    periods = {}
+    for spec in doubling_days_spec.values():
+        periods.setdefault(spec["value_col"], []).append(spec["periods"])
+    results = {
+        value_col: doubling_days(df[value_col], windows, value_periods)
+        for value_col, value_periods in periods.items()
+    }
     for col, spec in doubling_days_spec.items():
-        value_col = spec["value_col"]
-        periods = spec["periods"]
-        df.loc[df[value_col] == 0, value_col] = np.nan
-        df[col] = (
-            df.groupby("location", as_index=False)[value_col]
-            .pct_change(periods=periods, fill_method=None)[value_col]
-            .map(lambda pct: pct_change_to_doubling_days(pct, periods))
-        )
+        df[col] = results[spec["value_col"]][spec["periods"]]
+    return df
+
+
+def blank_zero_totals(df, columns=("total_cases", "total_deaths")):
+    """Replaces zero totals by missing values (so e.g. `cfr` and per-million totals are missing rather than 0
+    before the first case or death)."""
+    df = df.copy()
+    for col in columns:
+        df[col] = df[col].mask(df[col] == 0)
     return df
 
 
@@ -501,37 +535,31 @@ def inject_doubling_days(df):
 # ====================================
 
 
-def _inject_growth(df, prefix, periods):
+def _inject_growth(df, prefix, periods, windows=None):
     cases_colname = "%s_cases" % prefix
     deaths_colname = "%s_deaths" % prefix
     cases_growth_colname = "%s_pct_growth_cases" % prefix
     deaths_growth_colname = "%s_pct_growth_deaths" % prefix
 
-    df[[cases_colname, deaths_colname]] = (
-        df[["location", "new_cases", "new_deaths"]]
-        .fillna(0)
-        .groupby("location")[["new_cases", "new_deaths"]]
-        .rolling(window=periods, min_periods=periods, center=False)
-        .sum()
-        .reset_index(level=0, drop=True)
-    )
-    df[[cases_growth_colname, deaths_growth_colname]] = (
-        df[["location", cases_colname, deaths_colname]]
-        .groupby("location")[[cases_colname, deaths_colname]]
-        .pct_change(periods=periods, fill_method=None)
-        .replace([np.inf, -np.inf], pd.NA)
-        * 100
-    )
+    windows = _location_windows(df, windows)
+    df[cases_colname] = windows.sum(df["new_cases"].fillna(0), window=periods)
+    df[deaths_colname] = windows.sum(df["new_deaths"].fillna(0), window=periods)
+    for sum_col, growth_col in [
+        (cases_colname, cases_growth_colname),
+        (deaths_colname, deaths_growth_colname),
+    ]:
+        growth = windows.pct_change(df[sum_col], periods=periods)
+        df[growth_col] = np.where(np.isinf(growth), np.nan, growth) * 100
 
     return df
 
 
-def inject_weekly_growth(df):
-    return _inject_growth(df, "weekly", 7)
+def inject_weekly_growth(df, windows=None):
+    return _inject_growth(df, "weekly", 7, windows)
 
 
-def inject_biweekly_growth(df):
-    return _inject_growth(df, "biweekly", 14)
+def inject_biweekly_growth(df, windows=None):
+    return _inject_growth(df, "biweekly", 14, windows)
 
 
 # ============
@@ -631,20 +659,9 @@ def existsin(l1, l2):
     return [x for x in l1 if x in l2]
 
 
-def standard_export(df, output_path, grapher_name):
-    # Grapher
-    df_grapher = df.copy()
-    df_grapher["date"] = pd.to_datetime(df_grapher["date"]).map(
-        lambda date: (date - zero_day).days
-    )
-    df_grapher = (
-        df_grapher[GRAPHER_COL_NAMES.keys()]
-        .rename(columns=GRAPHER_COL_NAMES)
-        .to_csv(os.path.join(output_path, "%s.csv" % grapher_name), index=False)
-    )
-
-    # Table & public extracts for external users
-    # Excludes aggregates
+def exclude_custom_aggregates(df):
+    """Removes the aggregates that are only published in the grapher file (e.g. 'World excl. China',
+    income groups). The remaining table is the one published as CSV files for external users."""
     excluded_aggregates = list(
         set(aggregates_spec.keys())
         - set(
@@ -660,11 +677,41 @@ def standard_export(df, output_path, grapher_name):
             ]
         )
     )
-    df_table = df[~df["location"].isin(excluded_aggregates)]
+    return df[~df["location"].isin(excluded_aggregates)]
+
+
+def _to_csv(df, path, compression=None, **kwargs):
+    with open_with_variants(path, compression, encoding="utf-8", newline="") as f:
+        df.to_csv(f, **kwargs)
+    remove_stale_variants(path, compression)
+
+
+def standard_export(df, output_path, grapher_name, compression=None):
+    """Exports the grapher file, full_data.csv and one wide CSV per variable to `output_path`.
+
+    If `compression` is given (e.g. ["gz", "zst"] or {"gz": 9}), compressed variants of every
+    CSV are written in the same pass (see cowidev.utils.compression). Variants left over from
+    earlier exports with another compression are removed."""
+    # Grapher
+    df_grapher = df.copy()
+    df_grapher["date"] = dates_to_days(df_grapher["date"], ZERO_DAY)
+    _to_csv(
+        df_grapher[GRAPHER_COL_NAMES.keys()].rename(columns=GRAPHER_COL_NAMES),
+        os.path.join(output_path, "%s.csv" % grapher_name),
+        compression,
+        index=False,
+    )
+
+    # Table & public extracts for external users
+    # Excludes aggregates
+    df_table = exclude_custom_aggregates(df)
     # full_data.csv
     full_data_cols = existsin(FULL_DATA_COLS, df_table.columns)
-    df_table[full_data_cols].dropna(subset=BASE_MEASURES, how="all").to_csv(
-        os.path.join(output_path, "full_data.csv"), index=False
+    _to_csv(
+        df_table[full_data_cols].dropna(subset=BASE_MEASURES, how="all"),
+        os.path.join(output_path, "full_data.csv"),
+        compression,
+        index=False,
     )
     # Pivot variables (wide format)
     for col_name in [*BASE_MEASURES, *PER_MILLION_MEASURES]:
@@ -672,5 +719,7 @@ def standard_export(df, output_path, grapher_name):
         # move World to first column
         cols = df_pivot.columns.tolist()
         cols.insert(0, cols.pop(cols.index("World")))
-        df_pivot[cols].to_csv(os.path.join(output_path, "%s.csv" % col_name))
+        _to_csv(
+            df_pivot[cols], os.path.join(output_path, "%s.csv" % col_name), compression
+        )
     return True
@@ -1,22 +1,19 @@
 import os
-from datetime import datetime
 import pandas as pd
 
 from cowidev.grapher.db.base import GrapherBaseUpdater
+from cowidev.utils.grapher_dates import dates_to_days
 from cowidev.utils.utils import time_str_grapher, get_filename
 
 
 ZERO_DAY = "2020-01-01"
-zero_day = datetime.strptime(ZERO_DAY, "%Y-%m-%d")
 
 
 def run_grapheriser(input_path: str, input_path_country_std: str, output_path: str):
     mobility = pd.read_csv(input_path, low_memory=False)
 
     # Convert date column to days since zero_day
-    mobility["date"] = pd.to_datetime(mobility["date"], format="%Y/%m/%d").map(
-        lambda date: (date - zero_day).days
-    )
+    mobility["date"] = dates_to_days(mobility["date"], ZERO_DAY, format="%Y/%m/%d")
 
     # Standardise country names to OWID country names
     country_mapping = pd.read_csv(input_path_country_std)
@@ -1,7 +1,6 @@
-import json
-
 import pandas as pd
-import numpy as np
+
+from cowidev.utils.columnar import to_columnar_json
 
 
 class Exploriser:
@@ -26,31 +25,12 @@ class Exploriser:
             ).reset_index()
         return df
 
-    def pipe_nan_to_none(self, df: pd.DataFrame) -> pd.DataFrame:
-        return df.replace({np.nan: None})
-
-    def pipe_to_dict(self, df: pd.DataFrame) -> pd.DataFrame:
-        return df.to_dict(orient="list")
-
-    def pipeline(self, input_path: str) -> dict:
+    def pipeline(self, input_path: str) -> pd.DataFrame:
         df = pd.read_csv(input_path)
-        df = (
-            df.pipe(self.pipe_pivot).pipe(self.pipe_nan_to_none).pipe(self.pipe_to_dict)
-        )
+        df = df.pipe(self.pipe_pivot)
         return df
 
-    def to_json(self, obj):
-        return json.dumps(
-            obj,
-            # Use separators without any trailing whitespace to minimize file size.
-            # The defaults (", ", ": ") contain a trailing space.
-            separators=(",", ":"),
-            # The json library by default encodes NaNs in JSON, but this is invalid JSON.
-            # By having this False, an error will be thrown if a NaN exists in the data.
-            allow_nan=False,
-        )
-
     def run(self, input_path: str, output_path: str):
-        data = self.pipeline(input_path)
-        with open(output_path, "w") as f:
-            f.write(self.to_json(data))
+        df = self.pipeline(input_path)
+        # NaNs are written as null, columns are encoded straight from their NumPy buffers
+        to_columnar_json(df, output_path)
@@ -2,6 +2,8 @@ from datetime import datetime
 
 import pandas as pd
 
+from cowidev.utils.grapher_dates import dates_to_days
+
 
 class Grapheriser:
     def __init__(
@@ -45,7 +47,7 @@ class Grapheriser:
                     self.location: "Country",
                 }
             )
-            .assign(date=(df[self.date] - self.date_ref).dt.days)
+            .assign(date=dates_to_days(df[self.date], self.date_ref))
             .rename(columns={"date": "Year"})
         ).copy()
         return df
@@ -0,0 +1,3 @@
+"""
+Helpers for the megafile pipeline (scripts/scripts/megafile.py).
+"""
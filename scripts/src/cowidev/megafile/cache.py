@@ -0,0 +1,204 @@
+import functools
+import glob
+import hashlib
+import inspect
+import json
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from cowidev.megafile.incremental import code_version
+
+
+# Bump to invalidate all cached entries when the cache format changes
+CACHE_VERSION = 1
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+    "cowidev",
+    "megafile",
+)
+CACHE_MAX_SIZE = 1024**3  # 1 GiB
+
+
+class InputCache:
+    """Cache of the post-processed frames returned by source loaders.
+
+    Each entry is stored in Arrow IPC (Feather) format and keyed by the loader (name and arguments), its code and
+    the files it reads (size, modification time and content hash). The code covers the whole module of the loader
+    and the `code_modules` (e.g. packages of helpers it calls), so that a change to any helper invalidates the
+    entries. Content hashes are remembered by size and modification time, so unchanged inputs are not re-read. When
+    the total size of the entries exceeds `max_size`, least recently used entries are evicted.
+
+    Example:
+
+    ```python
+    >>> cache = InputCache()
+    >>> @cache.cached([VACCINATIONS_CSV])
+    ... def get_vax():
+    ...     return pd.read_csv(VACCINATIONS_CSV)
+    ```
+
+    Loaders must only depend on their arguments, on the files they declare and on the code of their module and of
+    `code_modules`.
+    """
+
+    index_file = "index.json"
+
+    def __init__(
+        self,
+        cache_dir: str = CACHE_DIR,
+        max_size: int = CACHE_MAX_SIZE,
+        code_modules: list = None,
+    ):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.code_modules = list(code_modules or [])
+
+    @property
+    def cache_dir(self) -> str:
+        return self._cache_dir
+
+    @cache_dir.setter
+    def cache_dir(self, cache_dir: str):
+        # File hashes are stored in the cache directory, so they are reloaded from the new one
+        self._cache_dir = cache_dir
+        self._index = None
+
+    @property
+    def index(self) -> dict:
+        """Content hash of each file read so far, with the size and modification time it was computed for."""
+        if self._index is None:
+            try:
+                with open(os.path.join(self.cache_dir, self.index_file), "r") as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _save_index(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, self.index_file), "w") as f:
+            json.dump(self.index, f, indent=1, sort_keys=True)
+
+    def file_key(self, path: str) -> str:
+        """Get the key of a file, from its size, modification time and content hash."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self.index.get(path)
+        if (
+            entry is None
+            or entry["size"] != stat.st_size
+            or entry["mtime_ns"] != stat.st_mtime_ns
+        ):
+            h = hashlib.sha1()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+            entry = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "sha1": h.hexdigest(),
+            }
+            self.index[path] = entry
+            self._save_index()
+        return f"{path}:{entry['size']}:{entry['mtime_ns']}:{entry['sha1']}"
+
+    def key(self, func, files: list, args: tuple = (), kwargs: dict = None) -> str:
+        """Get the key of a call to a loader."""
+        try:
+            code = inspect.getsource(func)
+        except (OSError, TypeError):
+            code = func.__code__.co_code.hex()
+        h = hashlib.sha1(f"version:{CACHE_VERSION}".encode())
+        h.update(f"{func.__module__}.{func.__qualname__}".encode())
+        h.update(code.encode())
+        # Helpers called by the loader, in its module or in other modules
+        h.update(code_version(func.__module__, *self.code_modules).encode())
+        h.update(repr((args, sorted((kwargs or {}).items()))).encode())
+        for path in files:
+            h.update(self.file_key(path).encode())
+        return h.hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.feather")
+
+    def get(self, key: str):
+        """Load a cached frame, or None if there is no entry for `key`."""
+        path = self._entry_path(key)
+        try:
+            df = feather.read_table(path, memory_map=True).to_pandas()
+        except (OSError, pa.ArrowInvalid):
+            return None
+        # Mark the entry as recently used
+        os.utime(path)
+        # Arrow reads missing strings back as None, while read_csv gives NaN
+        for col in df.columns[df.dtypes == object]:
+            df[col] = df[col].where(df[col].notna(), np.nan)
+        return df
+
+    def put(self, key: str, df):
+        """Store a frame under `key`. Frames that can't be converted to Arrow are not cached."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._entry_path(key)
+        tmp_path = f"{path}.tmp"
+        try:
+            feather.write_feather(df, tmp_path, compression="uncompressed")
+        except (ValueError, TypeError) as e:
+            print(f"<!> Could not cache input ({e})")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def entries(self) -> list:
+        """List cached entries as (path, size, last use) tuples, least recently used first."""
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, "*.feather")):
+            stat = os.stat(path)
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda x: x[2])
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in `max_size`."""
+        entries = self.entries()
+        total_size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total_size <= self.max_size:
+                break
+            os.remove(path)
+            total_size -= size
+
+    def clear(self):
+        """Remove all cached entries and file hashes."""
+        for path, _, _ in self.entries():
+            os.remove(path)
+        index_path = os.path.join(self.cache_dir, self.index_file)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        self._index = None
+
+    def cached(self, files):
+        """Decorator caching the frame returned by a loader.
+
+        Args:
+            files (list or callable): Paths to the files read by the loader. Can be a callable, which receives the
+                                      same arguments as the loader and returns the paths.
+        """
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                paths = files(*args, **kwargs) if callable(files) else files
+                key = self.key(func, paths, args, kwargs)
+                df = self.get(key)
+                if df is None:
+                    df = func(*args, **kwargs)
+                    self.put(key, df)
+                return df
+
+            return wrapper
+
+        return decorator
@@ -0,0 +1,199 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+CHANGE_COLUMN = "change"
+
+
+def _differs(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Element-wise difference of two arrays, where missing values are equal to each other."""
+    na_a, na_b = pd.isna(a), pd.isna(b)
+    both = ~(na_a | na_b)
+    differs = na_a != na_b
+    differs[both] = a[both] != b[both]
+    return differs
+
+
+class DatasetPatch:
+    """Row-level changes between two versions of a dataset, keyed by `keys`.
+
+    Rows are matched by key with a single merge, and each column is then compared at once over all matched rows.
+    Inserted and updated rows hold all the values of the new version; deleted rows only hold their key.
+
+    Example:
+
+    ```python
+    >>> patch = DatasetPatch.compute(previous, all_covid, keys=["iso_code", "date"])
+    >>> patch.summary()
+    {'inserted': 231, 'updated': 12, 'deleted': 0, ...}
+    >>> patch.write(DATA_DIR, "owid-covid-data-patch")
+    ```
+
+    To apply a patch, consumers drop the rows of `deleted` and `updated` from their copy (by key), append the rows
+    of `inserted` and `updated`, and drop `columns_removed`.
+    """
+
+    def __init__(
+        self,
+        keys: list,
+        inserted: pd.DataFrame,
+        updated: pd.DataFrame,
+        deleted: pd.DataFrame,
+        stats: dict,
+    ):
+        self.keys = keys
+        self.inserted = inserted
+        self.updated = updated
+        self.deleted = deleted
+        self.stats = stats
+
+    @classmethod
+    def compute(
+        cls, previous: pd.DataFrame, current: pd.DataFrame, keys=("iso_code", "date")
+    ):
+        """Compare two versions of a dataset.
+
+        Args:
+            previous (pd.DataFrame): Previous version.
+            current (pd.DataFrame): New version.
+            keys (list, optional): Columns identifying a row, unique in both versions. Defaults to
+                                   ("iso_code", "date").
+        """
+        keys = list(keys)
+        positions = (
+            previous[keys]
+            .assign(_previous=np.arange(len(previous)))
+            .merge(
+                current[keys].assign(_current=np.arange(len(current))),
+                on=keys,
+                how="outer",
+                validate="one_to_one",
+            )
+        )
+        in_previous = positions["_previous"].notna().to_numpy()
+        in_current = positions["_current"].notna().to_numpy()
+        matched = positions[in_previous & in_current].sort_values("_current")
+        previous_pos = matched["_previous"].to_numpy(dtype=np.int64)
+        current_pos = matched["_current"].to_numpy(dtype=np.int64)
+
+        columns = [col for col in current.columns if col not in keys]
+        updated = np.zeros(len(matched), dtype=bool)
+        updated_cells = {}
+        for col in columns:
+            new = current[col].to_numpy()[current_pos]
+            if col in previous.columns:
+                differs = _differs(previous[col].to_numpy()[previous_pos], new)
+            else:
+                differs = ~pd.isna(new)
+            if differs.any():
+                updated_cells[col] = int(differs.sum())
+                updated |= differs
+
+        inserted_pos = np.sort(
+            positions.loc[~in_previous, "_current"].to_numpy(dtype=np.int64)
+        )
+        deleted_pos = np.sort(
+            positions.loc[~in_current, "_previous"].to_numpy(dtype=np.int64)
+        )
+        stats = {
+            "previous_rows": len(previous),
+            "current_rows": len(current),
+            "unchanged": int(len(matched) - updated.sum()),
+            "columns_added": [col for col in columns if col not in previous.columns],
+            "columns_removed": [
+                col for col in previous.columns if col not in current.columns
+            ],
+            "updated_cells": updated_cells,
+        }
+        return cls(
+            keys=keys,
+            inserted=current.iloc[inserted_pos],
+            updated=current.iloc[current_pos[updated]],
+            deleted=previous[keys].iloc[deleted_pos],
+            stats=stats,
+        )
+
+    @classmethod
+    def unchanged(cls, columns: list, num_rows: int, keys=("iso_code", "date")):
+        """Get the (empty) patch of a dataset that did not change.
+
+        Args:
+            columns (list): Columns of the dataset, including `keys`.
+            num_rows (int): Number of rows of the dataset.
+            keys (list, optional): Columns identifying a row. Defaults to ("iso_code", "date").
+        """
+        keys = list(keys)
+        empty = pd.DataFrame(columns=list(columns))
+        stats = {
+            "previous_rows": num_rows,
+            "current_rows": num_rows,
+            "unchanged": num_rows,
+            "columns_added": [],
+            "columns_removed": [],
+            "updated_cells": {},
+        }
+        return cls(
+            keys=keys, inserted=empty, updated=empty, deleted=empty[keys], stats=stats
+        )
+
+    def summary(self) -> dict:
+        return {
+            "keys": self.keys,
+            "inserted": len(self.inserted),
+            "updated": len(self.updated),
+            "deleted": len(self.deleted),
+            **self.stats,
+        }
+
+    def to_frame(self) -> pd.DataFrame:
+        """Get all changes in a single table, with the type of change (insert, update, delete) as first column."""
+        frames = [
+            df.assign(**{CHANGE_COLUMN: change})
+            for change, df in [
+                ("insert", self.inserted),
+                ("update", self.updated),
+                ("delete", self.deleted),
+            ]
+        ]
+        columns = [CHANGE_COLUMN] + list(self.inserted.columns)
+        return pd.concat(frames, ignore_index=True)[columns]
+
+    def write(self, output_dir: str, name: str) -> list:
+        """Write the patch as CSV and Parquet (`{name}.csv`, `{name}.parquet`), and its summary as JSON
+        (`{name}-summary.json`).
+
+        Returns:
+            list: Paths of the files written.
+        """
+        df = self.to_frame()
+        paths = self.paths(output_dir, name)
+        df.to_csv(paths[0], index=False)
+        pq.write_table(
+            pa.Table.from_pandas(df, preserve_index=False),
+            paths[1],
+            compression="zstd",
+        )
+        with open(paths[2], "w") as f:
+            json.dump(self.summary(), f, indent=2)
+        return paths
+
+    @staticmethod
+    def paths(output_dir: str, name: str) -> list:
+        """Get the paths of the files of a patch written with `write`."""
+        return [
+            os.path.join(output_dir, f"{name}.csv"),
+            os.path.join(output_dir, f"{name}.parquet"),
+            os.path.join(output_dir, f"{name}-summary.json"),
+        ]
+
+    @classmethod
+    def remove(cls, output_dir: str, name: str):
+        """Remove the files of a patch written with `write`, if any (e.g. when they describe an older build)."""
+        for path in cls.paths(output_dir, name):
+            if os.path.exists(path):
+                os.remove(path)
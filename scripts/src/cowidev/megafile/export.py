@@ -0,0 +1,243 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from cowidev.utils.memory import get_peak_rss
+
+
+# Stages being run in worker processes, by id. Workers are forked, so they inherit the stage (and the data its
+# writers read) instead of receiving a pickled copy.
+_STAGES = {}
+# Set in worker processes: stages nested in a writer (e.g. the internal files) run their writers in threads
+_IN_WORKER = False
+
+
+def _fork_available() -> bool:
+    return "fork" in multiprocessing.get_all_start_methods()
+
+
+def _run_forked_writer(stage_id: int, name: str, staging_dir: str):
+    """Run a writer of the stage `stage_id` in a worker process. Returns its time, size and profiler records."""
+    global _IN_WORKER
+    _IN_WORKER = True
+    stage = _STAGES[stage_id]
+    num_records = len(stage.profiler.records) if stage.profiler is not None else 0
+    seconds = stage._run_writer(name, staging_dir)
+    records = stage.profiler.records[num_records:] if stage.profiler is not None else []
+    return seconds, stage.sizes.get(name), records
+
+
+class ExportStage:
+    """Runs a set of file writers concurrently and publishes their outputs once all of them have succeeded.
+
+    Writers are mostly pure Python (CSV, XLSX and JSON encoding), so they are run in worker processes, where they
+    don't contend for the GIL. Workers are forked, so they read the in-memory DataFrame of the parent process (shared
+    copy-on-write) without copying or serializing it, and each worker has its own view of it: pandas' lazily built
+    caches are never shared between concurrent writers. Where fork is not available (e.g. Windows), or with
+    `processes=False`, writers run in a thread pool instead and share the same objects. With a single worker (e.g. on
+    a single CPU), writers run one after the other in the current process.
+
+    Each writer is a callable that receives a single argument, `output_dir`, and must write its files under that
+    directory (using the same relative paths it would use under the final directory). Writers may return the path
+    (or list of paths) of the files they wrote, in which case their size is reported along with the time taken by
+    the writer.
+
+    Outputs are first written to a staging directory; they are only moved into `output_dir` once every writer has
+    succeeded. If any writer fails, the staging directory is removed and the first error is raised, leaving
+    `output_dir` untouched. Each file is then moved with an atomic rename, so readers never see a partially written
+    file. Publishing is atomic per file only: `output_dir` also holds files from other pipelines, so it can't be
+    swapped as a whole, and an error while moving files (e.g. a permission error) can leave some files from the new
+    export next to others from the previous one.
+
+    Example:
+
+    ```python
+    >>> stage = ExportStage(DATA_DIR)
+    >>> stage.add("csv", lambda output_dir: df.to_csv(os.path.join(output_dir, "data.csv"), index=False))
+    >>> stage.add("json", lambda output_dir: df_to_json(df, os.path.join(output_dir, "data.json")))
+    >>> timings = stage.run()
+    ```
+
+    Writers must not modify the shared data, and must only communicate through the files they write. If a
+    `profiler` (`StageProfiler`) is given, each writer is recorded as a stage named `{name}/{writer name}`.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        max_workers: int = None,
+        profiler=None,
+        name: str = "export",
+        processes: bool = True,
+    ):
+        self.output_dir = output_dir
+        self.max_workers = max_workers
+        self.processes = processes
+        self.profiler = profiler
+        self.name = name
+        self.writers = {}
+        self.removed = []
+        self.replaced = []
+        self.timings = {}
+        self.sizes = {}
+
+    def add(self, name: str, writer):
+        if name in self.writers:
+            raise ValueError(f"Writer {name} already added to the export stage!")
+        self.writers[name] = writer
+        return self
+
+    def remove(self, *paths):
+        """Remove `paths` (files or directories, relative to `output_dir`) when the outputs are published.
+
+        Use it for files of previous exports that this export no longer writes (e.g. compressed variants or optional
+        outputs that are turned off), so that they don't outlive the files they were derived from. Nothing is removed
+        if any writer fails.
+        """
+        self.removed.extend(paths)
+        return self
+
+    def replace_directory(self, path: str):
+        """Replace the contents of directory `path` (relative to `output_dir`) with the files written to it.
+
+        When the outputs are published, files of previous exports under `path` that this export didn't write are
+        removed (e.g. the shard of a location that is no longer in the data).
+        """
+        self.replaced.append(path)
+        return self
+
+    def _run_writer(self, name: str, staging_dir: str):
+        t0 = time.perf_counter()
+        writer = self.writers[name]
+        if self.profiler is not None:
+            writer = self.profiler.wrap(f"{self.name}/{name}", writer)
+        paths = writer(staging_dir)
+        seconds = time.perf_counter() - t0
+        if isinstance(paths, str):
+            paths = [paths]
+        if isinstance(paths, (list, tuple)):
+            self.sizes[name] = sum(os.path.getsize(path) for path in paths)
+        return seconds
+
+    def _run_threads(self, staging_dir: str, max_workers: int) -> dict:
+        """Run all writers in a thread pool. Returns the errors raised, by writer."""
+        errors = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                name: executor.submit(self._run_writer, name, staging_dir)
+                for name in self.writers
+            }
+            for name, future in futures.items():
+                try:
+                    self.timings[name] = future.result()
+                except Exception as e:
+                    errors[name] = e
+        return errors
+
+    def _run_processes(self, staging_dir: str, max_workers: int) -> dict:
+        """Run all writers in forked worker processes. Returns the errors raised, by writer."""
+        errors = {}
+        _STAGES[id(self)] = self
+        try:
+            with ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=multiprocessing.get_context("fork")
+            ) as executor:
+                futures = {
+                    name: executor.submit(
+                        _run_forked_writer, id(self), name, staging_dir
+                    )
+                    for name in self.writers
+                }
+                for name, future in futures.items():
+                    try:
+                        seconds, size, records = future.result()
+                    except Exception as e:
+                        errors[name] = e
+                        continue
+                    self.timings[name] = seconds
+                    if size is not None:
+                        self.sizes[name] = size
+                    if self.profiler is not None:
+                        self.profiler.records.extend(records)
+        finally:
+            del _STAGES[id(self)]
+        return errors
+
+    def _publish(self, staging_dir: str):
+        """Move all files from the staging directory to the output directory, one atomic rename per file.
+
+        Paths registered with `remove`, and files of directories registered with `replace_directory` that were not
+        published, are then removed from the output directory.
+        """
+        published = set()
+        for root, _, files in os.walk(staging_dir):
+            relative_dir = os.path.relpath(root, staging_dir)
+            target_dir = os.path.normpath(os.path.join(self.output_dir, relative_dir))
+            os.makedirs(target_dir, exist_ok=True)
+            for filename in files:
+                target_path = os.path.join(target_dir, filename)
+                os.replace(os.path.join(root, filename), target_path)
+                published.add(target_path)
+        for directory in self.replaced:
+            for root, _, files in os.walk(os.path.join(self.output_dir, directory)):
+                for filename in files:
+                    path = os.path.normpath(os.path.join(root, filename))
+                    if path not in published:
+                        os.remove(path)
+        for path in self.removed:
+            path = os.path.join(self.output_dir, path)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def run(self) -> dict:
+        """Run all writers and publish their outputs.
+
+        Returns:
+            dict: Wall time, in seconds, taken by each writer.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        # Staging directory lives in the output directory so that files can be moved with an atomic rename
+        staging_dir = tempfile.mkdtemp(prefix=".export-", dir=self.output_dir)
+        max_workers = self.max_workers or min(len(self.writers), os.cpu_count() or 1)
+        max_workers = max(max_workers, 1)
+        try:
+            # A single worker runs the writers in this process (through a one-thread pool)
+            if (
+                max_workers > 1
+                and self.processes
+                and _fork_available()
+                and not _IN_WORKER
+            ):
+                errors = self._run_processes(staging_dir, max_workers)
+            else:
+                errors = self._run_threads(staging_dir, max_workers)
+            if errors:
+                raise RuntimeError(
+                    f"Export failed for writer(s) {list(errors)}, no file was published."
+                ) from next(iter(errors.values()))
+            self._publish(staging_dir)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        self.print_timings()
+        return self.timings
+
+    def print_timings(self):
+        for name, seconds in sorted(
+            self.timings.items(), key=lambda x: x[1], reverse=True
+        ):
+            if name in self.sizes:
+                print(f"{name}: {seconds:.2f}s, {self.sizes[name] / 1024**2:.2f} MiB")
+            else:
+                print(f"{name}: {seconds:.2f}s")
+        peak_rss_children = get_peak_rss(children=True)
+        if peak_rss_children:
+            print(
+                f"Peak RSS: {get_peak_rss():.0f} MiB (workers: {peak_rss_children:.0f} MiB)"
+            )
+        else:
+            print(f"Peak RSS: {get_peak_rss():.0f} MiB")
@@ -0,0 +1,178 @@
+import glob
+import hashlib
+import importlib
+import json
+import os
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+
+# Bump to force a full rebuild when the fingerprinting logic itself changes
+FINGERPRINTS_VERSION = 1
+
+
+def fingerprint_locations(
+    df: pd.DataFrame, by: str = "location", order_by: str = "date"
+) -> dict:
+    """Compute a content fingerprint of each location of a source.
+
+    Rows are hashed in one vectorized pass (`pd.util.hash_pandas_object`), then the row hashes of each location
+    (ordered by `order_by`) are digested together. Two locations only get the same fingerprint if they have the same
+    rows, in the same columns.
+
+    Args:
+        df (pd.DataFrame): Source data, in long format.
+        by (str, optional): Column to group by. Defaults to "location".
+        order_by (str, optional): Column to sort each group by. Defaults to "date".
+
+    Returns:
+        dict: Fingerprint (hex digest) of each location.
+    """
+    if df.empty:
+        return {}
+    df = df.sort_values([by, order_by], kind="mergesort")
+    hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    groups = df[by].to_numpy()
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    ends = np.r_[starts[1:], len(groups)]
+    return {
+        str(groups[start]): hashlib.sha1(hashes[start:end].tobytes()).hexdigest()
+        for start, end in zip(starts, ends)
+    }
+
+
+def source_files(*modules) -> list:
+    """Get the paths to the source files of `modules`, including all submodules of packages.
+
+    Args:
+        modules (str or module): Modules or packages, by name (e.g. "cowidev.utils") or as module objects. Modules
+                                 without a source file (e.g. an interactive `__main__`) are skipped.
+    """
+    paths = []
+    for module in modules:
+        if isinstance(module, str):
+            module = importlib.import_module(module)
+        if hasattr(module, "__path__"):
+            for directory in module.__path__:
+                paths += sorted(
+                    glob.glob(os.path.join(directory, "**", "*.py"), recursive=True)
+                )
+        elif getattr(module, "__file__", None):
+            paths.append(os.path.abspath(module.__file__))
+    return paths
+
+
+@lru_cache(maxsize=None)
+def code_version(*modules) -> str:
+    """Compute a hash of the source code of `modules` (see `source_files`).
+
+    The hash is computed once per process and set of modules: the code that runs doesn't change once imported.
+    """
+    h = hashlib.sha1()
+    for path in source_files(*modules):
+        with open(path, "rb") as f:
+            h.update(os.path.basename(path).encode())
+            h.update(hashlib.sha1(f.read()).digest())
+    return h.hexdigest()
+
+
+def fingerprint_schema(sources: dict, files: list) -> str:
+    """Compute a fingerprint of everything that is not specific to a location.
+
+    This covers the version of the fingerprints, the name, columns and dtypes of each source, and the content of
+    `files` (static inputs and code shared by all locations).
+    """
+    h = hashlib.sha1(f"version:{FINGERPRINTS_VERSION}".encode())
+    for name, df in sources.items():
+        h.update(f"source:{name}".encode())
+        for column, dtype in df.dtypes.items():
+            h.update(f"column:{column}:{dtype}".encode())
+    for path in files:
+        with open(path, "rb") as f:
+            h.update(hashlib.sha1(f.read()).digest())
+    return h.hexdigest()
+
+
+class SourceFingerprints:
+    """Per-location fingerprints of the inputs of a build, used to only rebuild the locations whose data changed.
+
+    Example:
+
+    ```python
+    >>> fingerprints = SourceFingerprints.compute({"testing": testing, "vaccinations": vax}, files=[ISO_CSV])
+    >>> locations = fingerprints.changed_locations(SourceFingerprints.load(FINGERPRINTS_PATH))
+    >>> # locations is None if a full rebuild is needed, otherwise the set of locations to rebuild
+    >>> fingerprints.save(FINGERPRINTS_PATH)
+    ```
+    """
+
+    def __init__(self, schema: str, locations: dict):
+        self.schema = schema
+        self.locations = locations
+
+    @classmethod
+    def compute(
+        cls,
+        sources: dict,
+        files: list = None,
+        by: str = "location",
+        order_by: str = "date",
+    ):
+        """Fingerprint the sources of a build.
+
+        Args:
+            sources (dict): Source DataFrames, by name.
+            files (list, optional): Paths to files that affect all locations. Defaults to None.
+            by (str, optional): Location column. Defaults to "location".
+            order_by (str, optional): Date column. Defaults to "date".
+        """
+        return cls(
+            schema=fingerprint_schema(sources, files or []),
+            locations={
+                name: fingerprint_locations(df, by, order_by)
+                for name, df in sources.items()
+            },
+        )
+
+    @classmethod
+    def load(cls, path: str):
+        """Load fingerprints saved by a previous build, or None if there are none."""
+        if not os.path.isfile(path):
+            return None
+        with open(path, "r") as f:
+            fingerprints = json.load(f)
+        return cls(schema=fingerprints["schema"], locations=fingerprints["locations"])
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(
+                {"schema": self.schema, "locations": self.locations},
+                f,
+                indent=1,
+                sort_keys=True,
+            )
+
+    def changed_locations(self, previous):
+        """Get the locations whose inputs differ from those of a previous build.
+
+        Args:
+            previous (SourceFingerprints): Fingerprints of the previous build, or None.
+
+        Returns:
+            set: Locations that were added, removed or modified in any source. None if there are no previous
+                 fingerprints or the schema changed, in which case everything must be rebuilt.
+        """
+        if previous is None or previous.schema != self.schema:
+            return None
+        if set(previous.locations) != set(self.locations):
+            return None
+        changed = set()
+        for name, current in self.locations.items():
+            before = previous.locations[name]
+            for location in set(current).union(before):
+                if current.get(location) != before.get(location):
+                    changed.add(location)
+        return changed
@@ -0,0 +1,75 @@
+import pandas as pd
+
+
+def join_sources(sources: list, on: list) -> pd.DataFrame:
+    """Join several sources on shared keys with a single index-aligned concatenation.
+
+    Sources are given as a list of `(name, df, how)` tuples, where `how` is either "outer" or "left". The result is
+    the same as chaining pairwise merges, i.e. `df_0.merge(df_1, on=on, how=how_1).merge(df_2, on=on, how=how_2)...`:
+
+    - The first source is the base of the join (its `how` is ignored).
+    - "outer" sources add their keys to the joined keys.
+    - "left" sources only contribute rows whose keys are already present at that point of the chain.
+
+    Instead of creating one full-size intermediate frame per merge, each source is indexed by `on` once and all of
+    them are aligned with one outer `pd.concat`.
+
+    Args:
+        sources (list): List of `(name, df, how)` tuples. `name` is only used in error messages.
+        on (list): Key columns, shared by all sources.
+
+    Returns:
+        pd.DataFrame: Joined data, with the key columns first (in the order given by `on`), followed by the value
+                      columns of each source, in order.
+    """
+    frames = []
+    keys = None
+    columns = set()
+    for name, df, how in sources:
+        df = df.set_index(on)
+        if df.index.has_duplicates:
+            raise ValueError(f"Source {name} has more than one row for some {on}!")
+        overlap = columns.intersection(df.columns)
+        if overlap:
+            raise ValueError(f"Columns {overlap} of source {name} already joined!")
+        columns.update(df.columns)
+        if keys is None:
+            keys = df.index
+        elif how == "outer":
+            keys = keys.union(df.index)
+        elif how == "left":
+            df = df[df.index.isin(keys)]
+        else:
+            raise ValueError(f"Invalid join type {how} for source {name}!")
+        frames.append(df)
+    return pd.concat(frames, axis=1, join="outer").rename_axis(on).reset_index()
+
+
+def broadcast_lookup(
+    df: pd.DataFrame, table: pd.DataFrame, on, prepend: bool = False
+) -> pd.DataFrame:
+    """Attach static variables to each row of `df` with one vectorized lookup.
+
+    Equivalent to `df.merge(table.reset_index(), on=on, how="left")` when `table` has unique keys, but the columns
+    of `table` are looked up by reindexing, and the index and row order of `df` are preserved.
+
+    Args:
+        df (pd.DataFrame): Input data.
+        table (pd.DataFrame): Static variables, indexed by the key(s) in `on`.
+        on (str or list): Column(s) of `df` to look up in the index of `table`.
+        prepend (bool, optional): Set to True to place the columns of `table` before those of `df`. Defaults to
+                                  False.
+
+    Returns:
+        pd.DataFrame: `df` with the columns of `table`.
+    """
+    if table.index.has_duplicates:
+        raise ValueError(f"Lookup table has more than one row for some {on}!")
+    if isinstance(on, str):
+        keys = df[on]
+    else:
+        keys = pd.MultiIndex.from_frame(df[on])
+    values = table.reindex(keys).set_axis(df.index, axis=0)
+    if prepend:
+        return pd.concat([values, df], axis=1)
+    return pd.concat([df, values], axis=1)
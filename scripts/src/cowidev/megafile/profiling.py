@@ -0,0 +1,195 @@
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+
+from cowidev.utils.memory import get_current_rss, get_peak_rss
+
+
+def _shape(data):
+    """Get the total number of rows and columns of a DataFrame, or of a list or dict of DataFrames."""
+    if data is None:
+        return None, None
+    if isinstance(data, dict):
+        data = list(data.values())
+    if not isinstance(data, (list, tuple)):
+        data = [data]
+    frames = [df for df in data if isinstance(df, (pd.DataFrame, pd.Series))]
+    if not frames:
+        return None, None
+    rows = sum(df.shape[0] for df in frames)
+    columns = sum(df.shape[1] if df.ndim > 1 else 1 for df in frames)
+    return rows, columns
+
+
+class StageRecord:
+    """Measurements of a stage. The output of the stage can be set with `set_output`."""
+
+    def __init__(self, name: str, inputs=None):
+        self.name = name
+        self.rows_in, self.columns_in = _shape(inputs)
+        self.rows_out, self.columns_out = None, None
+        self.start = None
+        self.wall_time = None
+        self.cpu_time = None
+        self.rss_delta = None
+        self.peak_rss_increase = None
+        self.tracemalloc = None
+        self.profile = None
+
+    def set_output(self, output):
+        self.rows_out, self.columns_out = _shape(output)
+        return output
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "start": self.start,
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "rss_delta": self.rss_delta,
+            "peak_rss_increase": self.peak_rss_increase,
+            "rows_in": self.rows_in,
+            "columns_in": self.columns_in,
+            "rows_out": self.rows_out,
+            "columns_out": self.columns_out,
+            "tracemalloc": self.tracemalloc,
+            "profile": self.profile,
+        }
+
+
+class StageProfiler:
+    """Records the wall time, CPU time, RSS growth and input/output shapes of each stage of a build.
+
+    Optionally, it also records the top allocators of each stage (with tracemalloc) and dumps a cProfile profile of
+    each stage. Stages can be nested and can run in different threads.
+
+    Example:
+
+    ```python
+    >>> profiler = StageProfiler(trace_memory=True, profile_dir="profiles")
+    >>> with profiler.stage("join", inputs=[jhu, testing]) as stage:
+    ...     df = stage.set_output(jhu.merge(testing))
+    >>> writer = profiler.wrap("csv", lambda output_dir: df.to_csv(...))
+    >>> profiler.to_json("report.json")
+    ```
+
+    Notes:
+        - CPU time is that of the whole process, so it includes other threads running at the same time.
+        - RSS is measured for the whole process too (in MiB): `rss_delta` is the change in current RSS over the stage
+          (Linux only) and `peak_rss_increase` is how much the stage raised the peak RSS of the process, which is 0 if
+          it stayed under an earlier peak. The peak RSS of the process (and of its forked workers) is reported once,
+          in `to_dict`. With `trace_memory`, the peak of memory allocated by Python during the stage is also
+          recorded, but tracing slows down the build.
+        - tracemalloc peaks are reset when a stage starts, so with nested or concurrent stages they cover the time
+          since the last stage started.
+        - cProfile only profiles the thread the stage runs in. Stages nested in a profiled stage are not profiled
+          separately (they are included in the outer profile).
+    """
+
+    def __init__(
+        self, trace_memory: bool = False, profile_dir: str = None, top: int = 10
+    ):
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.top = top
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._started = datetime.utcnow().replace(microsecond=0).isoformat()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name: str, inputs=None):
+        """Measure the code run in the context as stage `name`.
+
+        Args:
+            name (str): Name of the stage.
+            inputs (optional): Input DataFrame(s) of the stage, used to report the number of rows and columns in.
+        """
+        record = StageRecord(name, inputs)
+        record.start = datetime.utcnow().isoformat()
+        profile = None
+        if self.profile_dir and not getattr(self._local, "profiling", False):
+            profile = cProfile.Profile()
+        if self.trace_memory:
+            snapshot_start = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+        rss_start, peak_rss_start = get_current_rss(), get_peak_rss()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        if profile:
+            try:
+                profile.enable()
+                self._local.profiling = True
+            except ValueError:
+                # Another profiler is already active (profilers are global since Python 3.12)
+                profile = None
+        try:
+            yield record
+        finally:
+            if profile:
+                profile.disable()
+                self._local.profiling = False
+            record.wall_time = round(time.perf_counter() - wall_start, 4)
+            record.cpu_time = round(time.process_time() - cpu_start, 4)
+            rss_end = get_current_rss()
+            if rss_start is not None and rss_end is not None:
+                record.rss_delta = round(rss_end - rss_start, 1)
+            record.peak_rss_increase = round(get_peak_rss() - peak_rss_start, 1)
+            if self.trace_memory:
+                record.tracemalloc = self._tracemalloc_stats(snapshot_start)
+            if profile:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                record.profile = os.path.join(
+                    self.profile_dir, f"{name.replace('/', '--')}.prof"
+                )
+                profile.dump_stats(record.profile)
+            with self._lock:
+                self.records.append(record)
+
+    def _tracemalloc_stats(self, snapshot_start) -> dict:
+        _, peak = tracemalloc.get_traced_memory()
+        stats = tracemalloc.take_snapshot().compare_to(snapshot_start, "lineno")
+        return {
+            "peak": peak,
+            "top": [
+                {
+                    "location": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                    "size_diff": stat.size_diff,
+                    "count_diff": stat.count_diff,
+                }
+                for stat in stats[: self.top]
+            ],
+        }
+
+    def wrap(self, name: str, func):
+        """Wrap `func` so that each call is measured as stage `name`. Its return value is reported as output."""
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.stage(name) as record:
+                return record.set_output(func(*args, **kwargs))
+
+        return wrapper
+
+    def to_dict(self) -> dict:
+        return {
+            "started": self._started,
+            "trace_memory": self.trace_memory,
+            "peak_rss": round(get_peak_rss(), 1),
+            "peak_rss_children": round(get_peak_rss(children=True), 1),
+            "stages": [record.to_dict() for record in self.records],
+        }
+
+    def to_json(self, output_path: str):
+        """Write all stage records to a JSON report."""
+        with open(output_path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
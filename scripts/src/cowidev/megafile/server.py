@@ -0,0 +1,354 @@
+"""Read-only query service over the megafile, on localhost.
+
+The complete dataset (owid-covid-data.parquet) is held in memory, sorted by location and date, along with the offsets
+of the rows of each location. A query only touches the rows it returns: each location is a slice of the table, and
+its date range is found by binary search on the dates of the slice. Finding the rows of a query thus takes
+microseconds (`MegafileIndex.ranges`); the rest of the time of a query is spent building the response, in
+proportion to the rows and columns returned (about 1-5 ms for one location, including the JSON encoding).
+
+    python -m cowidev.megafile.server --port 8050
+
+Endpoints (GET, JSON responses):
+- /query: rows of some locations, in columnar JSON (see cowidev.utils.columnar). Parameters:
+    - `location` and/or `iso_code`: comma-separated, defaults to all locations;
+    - `columns`: comma-separated, defaults to all columns (`location` and `date` are always included);
+    - `start`, `end`: date range (YYYY-MM-DD, inclusive);
+    - `latest`: if set (e.g. `latest=1`), only the latest non-missing value of each column, by location.
+  e.g. /query?iso_code=FRA,ITA&columns=people_vaccinated,people_fully_vaccinated&latest=1
+- /locations: number of rows and date range of each location.
+- /status: source file, build time and size of the data loaded.
+
+The source file is checked for changes every `reload_interval` seconds. New builds are published by replacing the
+file (see ExportStage), so a new version is always read whole. It is indexed in the background and then swapped in
+at once: queries are answered by either the previous or the new version, never by a mix of both.
+"""
+import argparse
+import json
+import os
+import threading
+import traceback
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from cowidev.megafile.shards import group_slices
+from cowidev.utils.columnar import iter_columnar_json
+from cowidev.utils.grapher_dates import to_datetime64
+from cowidev.utils.latest import latest_snapshot
+
+
+DATA_DIR = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "..", "..", "..", "public", "data")
+)
+SOURCE_PATH = os.path.join(DATA_DIR, "owid-covid-data.parquet")
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8050
+# Seconds between checks of the source file
+RELOAD_INTERVAL = 5
+
+
+def _split(values: list) -> list:
+    """Split comma-separated query parameters (which can also be repeated)."""
+    return [value for values_ in values for value in values_.split(",") if value]
+
+
+class MegafileIndex:
+    """Complete dataset sorted by location and date, with the row offsets of each location.
+
+    Example:
+
+    ```python
+    >>> index = MegafileIndex.from_parquet("public/data/owid-covid-data.parquet")
+    >>> index.query(locations=["France"], columns=["icu_patients"], start="2021-01-01", end="2021-01-31")
+    ```
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        if not df.empty:
+            df = df.sort_values(["location", "date"], kind="mergesort")
+        df = df.reset_index(drop=True)
+        for col in df.columns:
+            # Dictionary-encoded columns are read as categories
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype(object)
+        self.dates = to_datetime64(df["date"])
+        df["date"] = np.datetime_as_string(self.dates, unit="D")
+        self.columns = {col: df[col] for col in df.columns}
+        self.offsets = {}
+        self.iso_codes = {}
+        iso_codes = df["iso_code"].to_numpy()
+        for location, start, end in group_slices(df, "location"):
+            self.offsets[location] = (start, end)
+            self.iso_codes[iso_codes[start]] = location
+
+    @classmethod
+    def from_parquet(cls, path: str):
+        df = pq.read_table(path).to_pandas(date_as_object=False)
+        return cls(df)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def resolve_locations(self, locations: list = None, iso_codes: list = None) -> list:
+        """Get the names of the locations queried (all of them if none is given).
+
+        Raises:
+            KeyError: If any location or ISO code is unknown.
+        """
+        if not locations and not iso_codes:
+            return list(self.offsets)
+        unknown = [
+            location for location in locations or [] if location not in self.offsets
+        ]
+        unknown += [iso for iso in iso_codes or [] if iso not in self.iso_codes]
+        if unknown:
+            raise KeyError(f"Unknown location(s) {unknown}")
+        names = list(locations or []) + [self.iso_codes[iso] for iso in iso_codes or []]
+        return list(dict.fromkeys(names))
+
+    def ranges(self, locations: list, start: str = None, end: str = None) -> list:
+        """Get the (start, end) offsets of the rows of each of `locations` between `start` and `end` (inclusive)."""
+        start = None if start is None else np.datetime64(start, "D")
+        end = None if end is None else np.datetime64(end, "D")
+        ranges = []
+        for location in locations:
+            lo, hi = self.offsets[location]
+            dates = self.dates[lo:hi]
+            ranges.append(
+                (
+                    lo if start is None else lo + dates.searchsorted(start, "left"),
+                    hi if end is None else lo + dates.searchsorted(end, "right"),
+                )
+            )
+        return ranges
+
+    def rows(self, locations: list, start: str = None, end: str = None) -> np.ndarray:
+        """Get the positions of the rows of `locations` between `start` and `end` (inclusive)."""
+        ranges = [np.arange(lo, hi) for lo, hi in self.ranges(locations, start, end)]
+        return np.concatenate(ranges) if ranges else np.array([], dtype=np.int64)
+
+    def _take(self, column: str, ranges: list) -> np.ndarray:
+        """Get the values of `column` in `ranges` by slicing (a view of the column for a single range)."""
+        values = self.columns[column].to_numpy()
+        if len(ranges) == 1:
+            return values[ranges[0][0] : ranges[0][1]]
+        if not ranges:
+            return values[:0]
+        return np.concatenate([values[lo:hi] for lo, hi in ranges])
+
+    def query(
+        self,
+        locations: list = None,
+        iso_codes: list = None,
+        columns: list = None,
+        start: str = None,
+        end: str = None,
+        latest: bool = False,
+    ) -> pd.DataFrame:
+        """Get some columns of the rows of some locations, within a date range.
+
+        Args:
+            locations (list, optional): Location names. Defaults to None (all locations, unless `iso_codes` is given).
+            iso_codes (list, optional): ISO codes of the locations. Defaults to None.
+            columns (list, optional): Columns to return, besides `location` and `date`. Defaults to None (all).
+            start (str, optional): First date (YYYY-MM-DD). Defaults to None.
+            end (str, optional): Last date (YYYY-MM-DD). Defaults to None.
+            latest (bool, optional): Only return the latest non-missing value of each column, by location (see
+                                     latest_snapshot). Defaults to False.
+
+        Raises:
+            KeyError: If any location or column is unknown.
+        """
+        if columns is None:
+            columns = list(self.columns)
+        unknown = [col for col in columns if col not in self.columns]
+        if unknown:
+            raise KeyError(f"Unknown column(s) {unknown}")
+        columns = list(dict.fromkeys(["location", "date"] + list(columns)))
+        ranges = self.ranges(self.resolve_locations(locations, iso_codes), start, end)
+        df = pd.DataFrame(
+            {col: self._take(col, ranges) for col in columns}, columns=columns
+        )
+        if latest:
+            df = latest_snapshot(df, by="location", order_by="date")
+        return df
+
+    def summary(self) -> dict:
+        """Number of rows and date range of each location."""
+        return {
+            location: {
+                "rows": int(end - start),
+                "min_date": str(self.dates[start]),
+                "max_date": str(self.dates[end - 1]),
+            }
+            for location, (start, end) in self.offsets.items()
+        }
+
+
+class MegafileService:
+    """Current version of the index over `path`, reloaded whenever the file changes."""
+
+    def __init__(
+        self, path: str = SOURCE_PATH, reload_interval: float = RELOAD_INTERVAL
+    ):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.index = None
+        self.signature = None
+        self.loaded_at = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.reload()
+
+    def _signature(self) -> tuple:
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def reload(self) -> bool:
+        """Load the source file if it changed since the last load.
+
+        Returns:
+            bool: True if a new version was loaded.
+        """
+        with self._lock:
+            signature = self._signature()
+            if signature == self.signature:
+                return False
+            index = MegafileIndex.from_parquet(self.path)
+            # Readers get the index in a single attribute lookup, so swapping it is atomic
+            self.index, self.signature = index, signature
+            self.loaded_at = datetime.utcnow().replace(microsecond=0).isoformat()
+            print(f"Loaded {self.path} ({len(index)} rows)")
+            return True
+
+    def watch(self):
+        """Check the source file for changes every `reload_interval` seconds, until `stop` is called."""
+        while not self._stopped.wait(self.reload_interval):
+            try:
+                self.reload()
+            except Exception:
+                # Keep serving the previous version (e.g. if the file is being replaced)
+                traceback.print_exc()
+
+    def start_watching(self) -> threading.Thread:
+        thread = threading.Thread(target=self.watch, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stopped.set()
+
+    def status(self) -> dict:
+        index = self.index
+        return {
+            "path": self.path,
+            "modified": datetime.utcfromtimestamp(self.signature[0] / 1e9)
+            .replace(microsecond=0)
+            .isoformat(),
+            "loaded": self.loaded_at,
+            "rows": len(index),
+            "locations": len(index.offsets),
+            "columns": list(index.columns),
+        }
+
+
+def make_handler(service: MegafileService):
+    """Get the request handler class of an HTTP server answering queries with `service`."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            try:
+                if url.path == "/query":
+                    body = self._query(params)
+                elif url.path == "/locations":
+                    body = json.dumps(service.index.summary())
+                elif url.path == "/status":
+                    body = json.dumps(service.status())
+                else:
+                    return self._send(
+                        404, json.dumps({"error": f"Unknown path {url.path}"})
+                    )
+            except (KeyError, ValueError) as e:
+                message = e.args[0] if e.args else str(e)
+                return self._send(400, json.dumps({"error": str(message)}))
+            except Exception as e:
+                # Keep serving other requests, and answer this one with an error instead of dropping the connection
+                traceback.print_exc()
+                return self._send(
+                    500, json.dumps({"error": f"Internal error: {type(e).__name__}"})
+                )
+            self._send(200, body)
+
+        def _query(self, params: dict) -> str:
+            df = service.index.query(
+                locations=_split(params.get("location", [])),
+                iso_codes=_split(params.get("iso_code", [])),
+                columns=_split(params["columns"]) if "columns" in params else None,
+                start=params.get("start", [None])[0],
+                end=params.get("end", [None])[0],
+                latest=params.get("latest", ["0"])[0] not in ("0", "false", ""),
+            )
+            return "".join(iter_columnar_json(df))
+
+        def _send(self, code: int, body: str):
+            content = body.encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(
+    path: str = SOURCE_PATH,
+    host: str = DEFAULT_HOST,
+    port: int = DEFAULT_PORT,
+    reload_interval: float = RELOAD_INTERVAL,
+):
+    """Serve queries over the complete dataset at `path` until interrupted."""
+    service = MegafileService(path, reload_interval)
+    service.start_watching()
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    print(f"Serving {path} on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+        server.server_close()
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description="Serve read-only queries over the megafile on localhost.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--path", default=SOURCE_PATH, help="Complete dataset (Parquet) to serve"
+    )
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        "--reload-interval",
+        type=float,
+        default=RELOAD_INTERVAL,
+        help="Seconds between checks of the dataset for new builds",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    serve(args.path, args.host, args.port, args.reload_interval)
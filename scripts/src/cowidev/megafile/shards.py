@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+MANIFEST_FILE = "manifest.json"
+
+
+def group_slices(df: pd.DataFrame, by: str) -> list:
+    """Get the offsets of the groups of consecutive rows with the same value of `by`.
+
+    Rows must be grouped by `by` (e.g. sorted by it). Rows where `by` is missing are skipped.
+
+    Returns:
+        list: (key, start, end) tuples, in order of appearance.
+    """
+    values = df[by].to_numpy()
+    if len(values) == 0:
+        return []
+    starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+    ends = np.r_[starts[1:], len(values)]
+    keys = values[starts]
+    valid = ~pd.isna(keys)
+    if len(set(keys[valid])) != valid.sum():
+        raise ValueError(f"Rows are not grouped by {by}!")
+    return [
+        (key, start, end)
+        for key, start, end, is_valid in zip(keys, starts, ends, valid)
+        if is_valid
+    ]
+
+
+def write_shards(
+    df: pd.DataFrame,
+    output_dir: str,
+    by: str,
+    writers: dict,
+    date_column: str = "date",
+) -> list:
+    """Write one file per group of rows (and per format) in a single pass over `df`, along with a manifest.
+
+    Groups are sliced by offset (see `group_slices`), so `df` must be grouped by `by`. The manifest
+    (`manifest.json`) lists the number of rows and the date range of each shard, and the size and SHA-256 hash of
+    each of its files, so that clients can only download the shards that changed.
+
+    Example:
+
+    ```python
+    >>> write_shards(df, "by-location", by="iso_code", writers={"csv": lambda part: part.to_csv(index=False)})
+    >>> # Writes by-location/AFG.csv, by-location/ALB.csv, ..., by-location/manifest.json
+    ```
+
+    Args:
+        df (pd.DataFrame): Data, grouped by `by`.
+        output_dir (str): Directory of the shards.
+        by (str): Column to shard by. Its values are used as file names.
+        writers (dict): Function returning the content (str) of a shard from its rows, by file extension.
+        date_column (str, optional): Column with the date of each row. Defaults to "date".
+
+    Returns:
+        list: Paths of the files written, manifest included.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    dates = df[date_column].to_numpy()
+    shards = {}
+    paths = []
+    for key, start, end in group_slices(df, by):
+        part = df.iloc[start:end]
+        files = {}
+        for ext, writer in writers.items():
+            content = writer(part).encode("utf-8")
+            filename = f"{key}.{ext}"
+            with open(os.path.join(output_dir, filename), "wb") as f:
+                f.write(content)
+            files[ext] = {
+                "path": filename,
+                "size": len(content),
+                "sha256": hashlib.sha256(content).hexdigest(),
+            }
+            paths.append(os.path.join(output_dir, filename))
+        shards[str(key)] = {
+            "rows": int(end - start),
+            "min_date": str(dates[start:end].min()),
+            "max_date": str(dates[start:end].max()),
+            "files": files,
+        }
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    with open(manifest_path, "w") as f:
+        json.dump({"by": by, "shards": shards}, f, indent=1)
+    return paths + [manifest_path]
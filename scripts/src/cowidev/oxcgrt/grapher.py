@@ -1,12 +1,10 @@
-from datetime import datetime
-
 import pandas as pd
 from cowidev.grapher.db.base import GrapherBaseUpdater
+from cowidev.utils.grapher_dates import dates_to_days
 from cowidev.utils.utils import time_str_grapher, get_filename
 
 
 ZERO_DAY = "2020-01-01"
-zero_day = datetime.strptime(ZERO_DAY, "%Y-%m-%d")
 
 
 def run_grapheriser(input_path: str, input_path_country_std: str, output_path: str):
@@ -43,9 +41,7 @@ def run_grapheriser(input_path: str, input_path_country_std: str, output_path: s
 
     cgrt = cgrt[usecols]
 
-    cgrt.loc[:, "Date"] = pd.to_datetime(cgrt["Date"], format="%Y%m%d").map(
-        lambda date: (date - zero_day).days
-    )
+    cgrt.loc[:, "Date"] = dates_to_days(cgrt["Date"], ZERO_DAY, format="%Y%m%d")
     cgrt = country_mapping.merge(cgrt, on="CountryName", how="right")
 
     missing_from_mapping = cgrt[cgrt["Country"].isna()]["CountryName"].unique()
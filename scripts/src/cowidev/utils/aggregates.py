@@ -0,0 +1,129 @@
+"""Sums of locations into aggregates (World, continents, income groups…).
+
+Aggregates are specified as a dictionary of locations to include and exclude:
+
+```python
+{
+    "World": {"include": None, "exclude": None},
+    "World excl. China": {"include": None, "exclude": ["China"]},
+    "European Union": {"include": ["Austria", "Belgium", ...], "exclude": None},
+}
+```
+
+`include=None` stands for all locations. The specification is compiled into a membership matrix (location ×
+aggregate), and each column of the data is pivoted once into a date × location matrix, so that all aggregates are
+computed with a single matrix product, instead of filtering and grouping the data once per aggregate.
+"""
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_integer_dtype, is_numeric_dtype
+
+
+def membership_matrix(locations, spec: dict) -> np.ndarray:
+    """Get the matrix (location × aggregate) with 1 where a location is part of an aggregate, 0 elsewhere.
+
+    Args:
+        locations (array-like): Locations (rows of the matrix).
+        spec (dict): Locations to include and exclude of each aggregate (columns of the matrix), see above.
+    """
+    locations = pd.Index(locations)
+    membership = np.zeros((len(locations), len(spec)))
+    for i, params in enumerate(spec.values()):
+        include, exclude = params.get("include"), params.get("exclude")
+        is_member = np.ones(len(locations), dtype=bool)
+        if include is not None:
+            is_member &= locations.isin(include)
+        if exclude is not None:
+            is_member &= ~locations.isin(exclude)
+        membership[:, i] = is_member
+    return membership
+
+
+def _forward_fill(grid: np.ndarray) -> np.ndarray:
+    """Forward-fill the missing values of each column of `grid`."""
+    rows = np.where(np.isnan(grid), 0, np.arange(len(grid))[:, None])
+    rows = np.maximum.accumulate(rows, axis=0)
+    return grid[rows, np.arange(grid.shape[1])]
+
+
+def sum_aggregates(
+    df: pd.DataFrame,
+    spec: dict,
+    columns: list = None,
+    ffill_columns: list = None,
+    by: str = "location",
+    on: str = "date",
+) -> pd.DataFrame:
+    """Sum the values of the locations of each aggregate, by date.
+
+    An aggregate has a row for each date where any of its locations has a row. Missing values count as 0, as in
+    `df.groupby(on).sum()`.
+
+    Example:
+
+    ```python
+    >>> sum_aggregates(df, {"World excl. China": {"exclude": ["China"]}}, columns=["new_cases", "new_deaths"])
+    ```
+
+    Args:
+        df (pd.DataFrame): Data, with one row per location and date.
+        spec (dict): Locations to include and exclude of each aggregate, see above.
+        columns (list, optional): Columns to sum. Defaults to None (all numeric columns).
+        ffill_columns (list, optional): Columns (e.g. cumulative counts) that are forward-filled over the dates of
+                                        each location before being summed, so that locations count with their
+                                        last value on the dates they have no data for. Defaults to None.
+        by (str, optional): Location column. Defaults to "location".
+        on (str, optional): Date column. Defaults to "date".
+
+    Returns:
+        pd.DataFrame: Rows of each aggregate (in the order of `spec`), sorted by date, with columns `on`, `by` and
+                      `columns`.
+    """
+    if columns is None:
+        columns = [
+            col
+            for col in df.columns
+            if col not in (by, on) and is_numeric_dtype(df[col])
+        ]
+    ffill_columns = set(ffill_columns or [])
+    location_codes, locations = pd.factorize(df[by])
+    date_codes, dates = pd.factorize(df[on], sort=True)
+    # Rows with a missing location or date are left out
+    valid = (location_codes >= 0) & (date_codes >= 0)
+    cells = date_codes[valid] * len(locations) + location_codes[valid]
+    shape = (len(dates), len(locations))
+
+    def pivot(weights=None):
+        return np.bincount(cells, weights, minlength=shape[0] * shape[1]).reshape(shape)
+
+    grids = [np.zeros((0, len(locations)))]
+    for col in columns:
+        values = df[col].to_numpy(dtype=np.float64, na_value=np.nan)[valid]
+        is_value = ~np.isnan(values)
+        grid = pivot(np.where(is_value, values, 0))
+        if col in ffill_columns:
+            grid[pivot(is_value) == 0] = np.nan
+            grid = np.nan_to_num(_forward_fill(grid))
+        grids.append(grid)
+
+    membership = membership_matrix(locations, spec)
+    # (column × date) × location @ location × aggregate
+    sums = (np.concatenate(grids) @ membership).reshape(
+        len(columns), len(dates), len(spec)
+    )
+    has_rows = (pivot() > 0) @ membership > 0
+    aggregate_idx, date_idx = np.nonzero(has_rows.T)
+
+    aggregates = pd.DataFrame(
+        {
+            on: dates.take(date_idx),
+            by: np.array(list(spec), dtype=object)[aggregate_idx],
+        }
+    )
+    for i, col in enumerate(columns):
+        values = sums[i, date_idx, aggregate_idx]
+        # Integer columns stay integers, unless they have been forward-filled (as missing values)
+        if is_integer_dtype(df[col]) and col not in ffill_columns:
+            values = values.round().astype(df[col].dtype)
+        aggregates[col] = values
+    return aggregates
@@ -1,4 +1,5 @@
 import yaml
+import numpy as np
 import pandas as pd
 
 
@@ -22,10 +23,16 @@ class AnnotatorInternal:
     ```
 
     Keys in config should match those in `internal_files_columns`.
+
+    An annotation applies to its locations from its date onwards (or to all dates if it has no date). When several
+    annotations apply to the same row, the one with the latest date is used. For each stream, the config is compiled
+    once into a lookup table with the annotation starting at each (location, date), which is then joined to the
+    data with `pd.merge_asof`.
     """
 
     def __init__(self, config: dict):
-        self.config = config
+        self._config = config
+        self._lookup_tables = {}
 
     @classmethod
     def from_yaml(cls, path):
@@ -33,9 +40,132 @@ class AnnotatorInternal:
             dix = yaml.safe_load(f)
         return cls(dix)
 
+    @property
+    def config(self):
+        for stream in self._config.keys():
+            self._config[stream] = sorted(
+                self._config[stream], key=lambda x: x.get("date", "")
+            )
+        return self._config
+
     @property
     def streams(self):
-        return list(self.config.keys())
+        return list(self._config.keys())
+
+    def config_nested_to_flat(self, config):
+        """Convert class attribute config to a flattened dataframe.
+
+        Each row in the dataframe contains [stream, annotation_text, location, date]. Essentially, what gets flattened
+        is the `location` field, which originally contains a list of locations.
+
+        Args:
+            config (dict): Dictionary with original class config.
+
+        Returns:
+            pd.DataFrame: Table with config in a flatten version.
+        """
+        data_flat = []
+        for stream, config_ in config.items():
+            for d in config_:
+                for loc in d["location"]:
+                    data_flat.append(
+                        {
+                            "stream": stream,
+                            "annotation_text": d["annotation_text"],
+                            "date": d["date"],
+                            "location": loc,
+                        }
+                    )
+        return pd.DataFrame(data_flat)
+
+    def config_flat_to_nested(self, df_config):
+        """Converts flattened config dataframe to class instance format.
+
+        Args:
+            df_config (pd.DataFrame): Flattened config.
+
+        Returns:
+            dict: Dictionary with original data.
+        """
+        config_nested = {}
+        streams = df_config.stream.unique()
+        for stream in streams:
+            df_ = df_config[df_config.stream == stream]
+            rec = (
+                df_.groupby(["annotation_text", "date"])
+                .location.apply(list)
+                .reset_index()
+                .to_dict(orient="records")
+            )
+            config_nested[stream] = rec
+        return config_nested
+
+    def _remove_config_duplicates(self):
+        df_config = self.config_nested_to_flat(self._config)
+        df_config = df_config.drop_duplicates()
+        return self.config_flat_to_nested(df_config)
+
+    def insert_annotation(self, stream: str, annotation: dict):
+        self.insert_annotations(stream, [annotation])
+
+    def insert_annotations(self, stream: str, annotations: list):
+        """Insert several annotations to a stream, removing duplicates once all of them have been added."""
+        for annotation in annotations:
+            # Checks
+            if (
+                "annotation_text" not in annotation
+                or "location" not in annotation
+                or "date" not in annotation
+            ):
+                raise ValueError(
+                    "annotation dictionary must contain fields `annotation_text`, `location` and `date`"
+                )
+            if not (
+                isinstance(annotation["annotation_text"], str)
+                and isinstance(annotation["location"], list)
+                and isinstance(annotation["date"], str)
+            ):
+                raise ValueError(
+                    f"Check `annotation` field types. `annotation_text` (str), `location` (list) and `date` (str)"
+                )
+        if not annotations:
+            return
+        # Add annotations
+        self._config.setdefault(stream, []).extend(annotations)
+        # Remove duplicates
+        self._config = self._remove_config_duplicates()
+        self._lookup_tables = {}
+
+    def to_yaml(self):
+        pass
+
+    def lookup_table(self, stream: str) -> pd.DataFrame:
+        """Get the annotation starting at each location and date of a stream.
+
+        Returns:
+            pd.DataFrame: Table with columns [location, date, annotations], sorted by date. Annotations without a date
+                          start at the earliest representable date.
+        """
+        if stream not in self._lookup_tables:
+            records = []
+            for c in self.config[stream]:
+                if not ("location" in c and "annotation_text" in c):
+                    raise ValueError(
+                        f"Missing field in {stream} (`location` and `annotation_text` are required)."
+                    )
+                locations = c["location"]
+                if isinstance(locations, str):
+                    locations = [locations]
+                records.extend(
+                    (loc, c.get("date"), c["annotation_text"]) for loc in locations
+                )
+            table = pd.DataFrame(records, columns=["location", "date", "annotations"])
+            table["date"] = pd.to_datetime(table["date"]).fillna(pd.Timestamp.min)
+            # Config is sorted by date: for the same location and date, later annotations take precedence
+            self._lookup_tables[stream] = table.drop_duplicates(
+                subset=["location", "date"], keep="last"
+            ).sort_values("date", kind="mergesort", ignore_index=True)
+        return self._lookup_tables[stream]
 
     def add_annotations(self, df: pd.DataFrame, stream: str) -> pd.DataFrame:
         if stream in self.streams:
@@ -44,18 +174,22 @@ class AnnotatorInternal:
         return df
 
     def _add_annotations(self, df: pd.DataFrame, stream: str) -> pd.DataFrame:
-        df = df.assign(annotations=pd.NA)
-        conf = self.config[stream]
-        for c in conf:
-            if not ("location" in c and "annotation_text" in c):
-                raise ValueError(
-                    f"Missing field in {stream} (`location` and `annotation_text` are required)."
-                )
-            if isinstance(c["location"], str):
-                mask = df.location == c["location"]
-            elif isinstance(c["location"], list):
-                mask = df.location.isin(c["location"])
-            if "date" in c:
-                mask = mask & (df.date >= c["date"])
-            df.loc[mask, "annotations"] = c["annotation_text"]
-        return df
+        table = self.lookup_table(stream)
+        annotations = np.full(len(df), pd.NA, dtype=object)
+        if not table.empty and not df.empty:
+            keys = pd.DataFrame(
+                {
+                    "location": df.location.to_numpy(dtype=object),
+                    "date": pd.to_datetime(df.date).to_numpy(),
+                    "row": np.arange(len(df)),
+                }
+            ).sort_values("date", kind="mergesort")
+            # Each row gets the latest annotation of its location starting on or before its date
+            matched = pd.merge_asof(
+                keys, table, on="date", by="location", direction="backward"
+            )
+            found = matched.annotations.notna().to_numpy()
+            annotations[matched.row.to_numpy()[found]] = matched.annotations.to_numpy()[
+                found
+            ]
+        return df.assign(annotations=annotations)
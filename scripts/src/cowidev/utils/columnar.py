@@ -0,0 +1,135 @@
+"""Columnar JSON encoding of DataFrames.
+
+Columnar JSON has the table headers as keys and, as values, the list of all cells of each column:
+
+```
+{
+    "iso_code": ["AFG", "AFG", ... ],
+    "date": ["2020-03-01", "2020-03-02", ... ]
+}
+```
+
+Missing values are encoded as `null`. Each column is encoded straight from its NumPy buffer using a
+null mask, so no Python-level check is run per cell. String columns (e.g. locations and dates) are encoded once
+per distinct value, and their cells are then joined from the encoded values. The output is the same as
+`json.dumps(df.to_dict(orient="list"), separators=(",", ":"), allow_nan=False)` once NaNs have been
+replaced by `None`.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import (
+    infer_dtype,
+    is_bool_dtype,
+    is_extension_array_dtype,
+    is_float_dtype,
+    is_integer_dtype,
+    is_string_dtype,
+)
+
+
+def to_compact_json(obj) -> str:
+    """Encode a Python object into valid, minified JSON."""
+    return json.dumps(
+        obj,
+        # Use separators without any trailing whitespace to minimize file size.
+        # The defaults (", ", ": ") contain a trailing space.
+        separators=(",", ":"),
+        # The json library by default encodes NaNs in JSON, but this is invalid JSON.
+        # By having this False, an error will be thrown if a NaN exists in the data.
+        allow_nan=False,
+    )
+
+
+def _column_to_list(series: pd.Series, decimals: int = None) -> list:
+    """Convert a column into a list of native Python values, with `None` for missing values."""
+    dtype = series.dtype
+    if not is_extension_array_dtype(dtype):
+        values = series.to_numpy()
+        if is_bool_dtype(dtype) or is_integer_dtype(dtype):
+            # NumPy integer and boolean columns can't hold missing values
+            return values.tolist()
+        if is_float_dtype(dtype):
+            mask = np.isnan(values)
+            if decimals is not None:
+                values = values.round(decimals)
+            if not mask.any():
+                return values.tolist()
+            values = values.astype(object)
+            values[mask] = None
+            return values.tolist()
+    mask = series.isna().to_numpy()
+    if is_extension_array_dtype(dtype) and is_integer_dtype(dtype):
+        # Nullable integers (e.g. Int64): cast the filled buffer so that cells become Python ints
+        values = series.fillna(0).to_numpy(dtype="int64").astype(object)
+    elif is_extension_array_dtype(dtype) and is_float_dtype(dtype):
+        values = series.to_numpy(dtype="float64", na_value=0)
+        if decimals is not None:
+            values = values.round(decimals)
+        values = values.astype(object)
+    else:
+        values = series.to_numpy(dtype=object, copy=True)
+    values[mask] = None
+    return values.tolist()
+
+
+def _is_string_column(series: pd.Series) -> bool:
+    """Whether all non-missing cells of `series` are strings."""
+    return (
+        is_string_dtype(series.dtype) and infer_dtype(series, skipna=True) == "string"
+    )
+
+
+def _string_column_to_json(series: pd.Series) -> str:
+    """Encode a column of strings, with each distinct value encoded only once."""
+    codes, uniques = pd.factorize(series)
+    # Missing values have code -1, i.e. the last item
+    encoded = np.array(
+        [to_compact_json(value) for value in uniques] + ["null"], dtype=object
+    )
+    return "[" + ",".join(encoded[codes]) + "]"
+
+
+def _column_to_json(series: pd.Series, decimals: int = None) -> str:
+    """Encode a column as a JSON list, rounding floats to `decimals` if given."""
+    if _is_string_column(series):
+        return _string_column_to_json(series)
+    return to_compact_json(_column_to_list(series, decimals))
+
+
+def iter_columnar_json(df, decimals: dict = None, rows=None):
+    """Yield the columnar JSON encoding of `df` in chunks, one column at a time.
+
+    Args:
+        df (pd.DataFrame or dict): Data to encode. Can also be a dictionary mapping column names to Series (e.g. a
+                                   projection of some columns of a DataFrame, without copying them).
+        decimals (dict, optional): Number of decimals to round float columns to, by column name. Columns not in
+                                   the dictionary are not rounded. Defaults to None.
+        rows (np.ndarray, optional): Boolean mask of the rows to encode. Each column is only filtered when it is
+                                     encoded. Defaults to None (all rows).
+    """
+    decimals = decimals or {}
+    yield "{"
+    for i, column in enumerate(df):
+        if i > 0:
+            yield ","
+        series = df[column] if rows is None else df[column][rows]
+        yield to_compact_json(column)
+        yield ":"
+        yield _column_to_json(series, decimals.get(column))
+    yield "}"
+
+
+def to_columnar_json(df, output_path: str, decimals: dict = None, rows=None):
+    """Write `df` as columnar JSON to `output_path`, one column at a time.
+
+    Args:
+        df (pd.DataFrame or dict): Data to export, or a dictionary mapping column names to Series.
+        output_path (str): Path to the output JSON file.
+        decimals (dict, optional): Number of decimals to round float columns to, by column name. Defaults to None.
+        rows (np.ndarray, optional): Boolean mask of the rows to export. Defaults to None (all rows).
+    """
+    with open(output_path, "w") as f:
+        for chunk in iter_columnar_json(df, decimals, rows):
+            f.write(chunk)
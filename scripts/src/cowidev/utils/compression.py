@@ -0,0 +1,167 @@
+"""Compressed variants of exported files, written in the same pass as the plain file.
+
+`open_with_variants` returns a file object that writes each chunk to the plain file and, at the same time, to a
+gzip (`.gz`) and/or Zstandard (`.zst`) stream. Compressed variants are thus produced without reading the plain file
+back once it has been written.
+
+Variants that an export doesn't write are left as they were: remove them with `remove_stale_variants` (or, in an
+`ExportStage`, register `stale_variant_paths` for removal) so that they don't outlive the plain file.
+
+Zstandard variants are compressed with pyarrow in independent frames of `ZSTD_FRAME_SIZE` bytes of input. A
+sequence of frames is a valid Zstandard stream, which any decoder reads as a whole (`zstd -d`, `zstdcat`, etc.).
+"""
+import gzip
+import io
+import os
+from contextlib import contextmanager
+
+import pyarrow as pa
+
+
+# Compression level of each variant (by extension) when none is given
+DEFAULT_LEVELS = {"gz": 6, "zst": 3}
+# Bytes of input compressed in each Zstandard frame
+ZSTD_FRAME_SIZE = 4 * 1024**2
+# Buffer between the writer and the plain/compressed streams
+BUFFER_SIZE = 1024**2
+
+
+def get_compression_levels(compression) -> dict:
+    """Normalize a compression specification to a dictionary {extension: level}.
+
+    Args:
+        compression (dict, list or str): Extension(s) of the compressed variants ("gz", "zst"). Can be a dictionary
+                                         with the level of each extension (None for the default level).
+
+    Returns:
+        dict: Level of each compressed variant. Empty if `compression` is None.
+    """
+    if not compression:
+        return {}
+    if isinstance(compression, str):
+        compression = [compression]
+    if not isinstance(compression, dict):
+        compression = dict.fromkeys(compression)
+    unknown = set(compression) - set(DEFAULT_LEVELS)
+    if unknown:
+        raise ValueError(
+            f"Unknown compression(s) {sorted(unknown)}, use any of {list(DEFAULT_LEVELS)}"
+        )
+    return {
+        ext: DEFAULT_LEVELS[ext] if level is None else level
+        for ext, level in compression.items()
+    }
+
+
+def variant_paths(path: str, compression=None) -> list:
+    """Get the paths of the compressed variants of `path`."""
+    return [f"{path}.{ext}" for ext in get_compression_levels(compression)]
+
+
+def stale_variant_paths(path: str, compression=None) -> list:
+    """Get the paths of the compressed variants of `path` that are not written with `compression`.
+
+    These are left over from earlier exports with other (or any) compression, and no longer match the plain file.
+    """
+    levels = get_compression_levels(compression)
+    return [f"{path}.{ext}" for ext in DEFAULT_LEVELS if ext not in levels]
+
+
+def remove_stale_variants(path: str, compression=None):
+    """Remove the compressed variants of `path` that are not written with `compression` (see `stale_variant_paths`)."""
+    for stale_path in stale_variant_paths(path, compression):
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+
+
+class _ZstdWriter:
+    """Binary stream writing Zstandard frames of `frame_size` bytes of input to a file."""
+
+    def __init__(self, path: str, level: int, frame_size: int = ZSTD_FRAME_SIZE):
+        self._codec = pa.Codec("zstd", compression_level=level)
+        self._file = open(path, "wb")
+        self._buffer = bytearray()
+        self._frames = 0
+        self.frame_size = frame_size
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self.frame_size:
+            self._write_frame()
+
+    def _write_frame(self):
+        self._file.write(self._codec.compress(bytes(self._buffer), asbytes=True))
+        self._buffer.clear()
+        self._frames += 1
+
+    def close(self):
+        # Empty inputs still get a (empty) frame, so that the output is a valid stream
+        if self._buffer or not self._frames:
+            self._write_frame()
+        self._file.close()
+
+
+class _TeeStream(io.RawIOBase):
+    """Raw binary stream writing everything to several streams."""
+
+    def __init__(self, streams: list):
+        self._streams = streams
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        for stream in self._streams:
+            stream.write(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            for stream in self._streams:
+                stream.close()
+        super().close()
+
+
+@contextmanager
+def open_with_variants(
+    path: str, compression=None, mode: str = "w", encoding=None, newline=None
+):
+    """Open `path` for writing, along with its compressed variants, which get the same content in the same pass.
+
+    Example:
+
+    ```python
+    >>> with open_with_variants("data.csv", {"gz": 9, "zst": 19}, newline="") as f:
+    ...     df.to_csv(f, index=False)
+    >>> # Writes data.csv, data.csv.gz and data.csv.zst
+    ```
+
+    Args:
+        path (str): Path to the plain file.
+        compression (dict, list or str, optional): Compressed variants, see `get_compression_levels`. Defaults to
+                                                   None (only the plain file is written).
+        mode (str, optional): "w" (text) or "wb" (binary). Defaults to "w".
+        encoding (str, optional): Text encoding, as in `open`. Defaults to None.
+        newline (str, optional): Newline translation, as in `open`. Defaults to None.
+    """
+    if mode not in ("w", "wb"):
+        raise ValueError(f"Invalid mode {mode}, only 'w' and 'wb' are supported")
+    streams = [open(path, "wb")]
+    try:
+        for ext, level in get_compression_levels(compression).items():
+            if ext == "gz":
+                # mtime=0 so that the same content always gives the same file
+                streams.append(
+                    gzip.GzipFile(f"{path}.gz", mode="wb", compresslevel=level, mtime=0)
+                )
+            else:
+                streams.append(_ZstdWriter(f"{path}.zst", level))
+    except Exception:
+        for stream in streams:
+            stream.close()
+        raise
+    f = io.BufferedWriter(_TeeStream(streams), buffer_size=BUFFER_SIZE)
+    if mode == "w":
+        f = io.TextIOWrapper(f, encoding=encoding, newline=newline)
+    with f:
+        yield f
@@ -0,0 +1,106 @@
+"""Conversion between dates and Grapher day offsets.
+
+Grapher stores daily variables (`yearIsDay`) as the number of days since a zero day (e.g. 2020-01-21), in the
+"Year" column. `dates_to_days` and `days_to_dates` convert whole columns at once, as datetime64[D] arithmetic:
+
+```python
+>>> dates_to_days(["2020-01-21", "2020-02-01"])
+array([ 0, 11])
+>>> days_to_dates([0, 11])
+array(['2020-01-21', '2020-02-01'], dtype='<U10')
+```
+
+Strings are only parsed once per distinct value (dates repeat for every location), with NumPy's ISO 8601 parser
+when no other format is given.
+"""
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+
+DEFAULT_ZERO_DAY = "2020-01-21"
+ISO_FORMAT = "%Y-%m-%d"
+
+
+@lru_cache(maxsize=None)
+def get_zero_day(zero_day=DEFAULT_ZERO_DAY) -> np.datetime64:
+    """Get the zero day (str, date or datetime) as a datetime64[D] constant."""
+    return pd.Timestamp(zero_day).to_datetime64().astype("datetime64[D]")
+
+
+def _parse_strings(values: np.ndarray, format: str = None) -> np.ndarray:
+    if format in (None, ISO_FORMAT):
+        try:
+            return values.astype("datetime64[D]")
+        except ValueError:
+            # Missing values or timestamps with a time, left to pandas
+            pass
+    return pd.to_datetime(values, format=format).to_numpy().astype("datetime64[D]")
+
+
+def to_datetime64(dates, format: str = None) -> np.ndarray:
+    """Convert dates (datetime64, Timestamps, date objects or strings) to a datetime64[D] array.
+
+    Args:
+        dates (array-like): Dates.
+        format (str, optional): Format of dates given as strings or integers (e.g. "%Y%m%d"), as in
+                                `pd.to_datetime`. Defaults to None (ISO 8601).
+
+    Returns:
+        np.ndarray: Dates, with NaT for missing values.
+    """
+    values = dates.to_numpy() if isinstance(dates, (pd.Series, pd.Index)) else dates
+    values = np.asarray(values)
+    if values.dtype.kind == "M":
+        return values.astype("datetime64[D]")
+    if values.dtype.kind in "OUS":
+        codes, uniques = pd.factorize(values)
+        parsed = _parse_strings(np.asarray(uniques, dtype=object), format)
+        return np.append(parsed, np.datetime64("NaT", "D"))[codes]
+    return pd.to_datetime(values, format=format).to_numpy().astype("datetime64[D]")
+
+
+def dates_to_days(dates, zero_day=DEFAULT_ZERO_DAY, format: str = None) -> np.ndarray:
+    """Convert dates to days since `zero_day`.
+
+    Args:
+        dates (array-like): Dates, see `to_datetime64`.
+        zero_day (str, date or datetime, optional): Zero day. Defaults to "2020-01-21".
+        format (str, optional): Format of dates given as strings, see `to_datetime64`. Defaults to None.
+
+    Returns:
+        np.ndarray: Days since `zero_day`, as integers (floats with NaN if any date is missing).
+    """
+    days = to_datetime64(dates, format) - get_zero_day(zero_day)
+    missing = np.isnat(days)
+    if missing.any():
+        days = days.astype(np.float64)
+        days[missing] = np.nan
+        return days
+    return days.astype(np.int64)
+
+
+def days_to_dates(days, zero_day=DEFAULT_ZERO_DAY, as_str: bool = True) -> np.ndarray:
+    """Convert days since `zero_day` to dates.
+
+    Args:
+        days (array-like): Days since `zero_day`. Missing values give missing dates.
+        zero_day (str, date or datetime, optional): Zero day. Defaults to "2020-01-21".
+        as_str (bool, optional): Return ISO 8601 strings ("YYYY-MM-DD", "NaT" if missing) instead of datetime64[D].
+                                 Defaults to True.
+
+    Returns:
+        np.ndarray: Dates.
+    """
+    days = np.asarray(days)
+    if days.dtype.kind == "f":
+        offsets = np.full(days.shape, np.timedelta64("NaT", "D"))
+        valid = ~np.isnan(days)
+        offsets[valid] = days[valid].astype(np.int64)
+    else:
+        offsets = days.astype("timedelta64[D]")
+    dates = get_zero_day(zero_day) + offsets
+    if as_str:
+        return np.datetime_as_string(dates, unit="D")
+    return dates
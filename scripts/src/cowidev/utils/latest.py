@@ -0,0 +1,32 @@
+import pandas as pd
+
+
+def latest_snapshot(
+    df: pd.DataFrame, by: str = "location", order_by: str = "date"
+) -> pd.DataFrame:
+    """Get the latest snapshot of each group.
+
+    For each group in `by`, the rows are ordered by `order_by`, forward-filled and only the last one is kept. That
+    is, each column holds the last non-missing value of the group. This is done in one grouped pass over the whole
+    frame, instead of filtering it once per group.
+
+    Example:
+
+    ```python
+    >>> latest_snapshot(df[df.date >= "2021-08-01"], by="location", order_by="date")
+    ```
+
+    Args:
+        df (pd.DataFrame): Input data, in long format.
+        by (str, optional): Column to group by. Defaults to "location".
+        order_by (str, optional): Column to sort each group by before forward-filling. Defaults to "date".
+
+    Returns:
+        pd.DataFrame: One row per group, sorted by `by` and with the same columns as `df`.
+    """
+    latest = (
+        df.sort_values(order_by, kind="mergesort")
+        .groupby(by, sort=True, as_index=False)
+        .last()
+    )
+    return latest[df.columns]
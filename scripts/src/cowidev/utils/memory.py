@@ -0,0 +1,30 @@
+import os
+import resource
+import sys
+
+
+def get_peak_rss(children: bool = False) -> float:
+    """Get the peak resident set size (RSS) of the current process, in MiB.
+
+    With `children`, get the largest peak of its terminated child processes instead (e.g. forked workers).
+    """
+    peak = resource.getrusage(
+        resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    ).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kibibytes on Linux
+    if sys.platform == "darwin":
+        return peak / 1024**2
+    return peak / 1024
+
+
+def get_current_rss() -> float:
+    """Get the current resident set size (RSS) of the current process, in MiB, or None if it can't be read.
+
+    It is read from /proc, so it is only available on Linux.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1024**2
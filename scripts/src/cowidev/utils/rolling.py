@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+
+
+class GroupedWindows:
+    """Rolling windows over the rows of each group, ordered by `order_by`, computed for all groups at once.
+
+    Rows are sorted by group and order once, when the object is created. Each window is then computed over the
+    sorted values with array operations, using the position of each row in its group to keep windows within
+    groups. Results are returned in the order of the rows of `df`.
+
+    Example:
+
+    ```python
+    >>> windows = GroupedWindows(df, by="location", order_by="date")
+    >>> df["new_cases_7_day_avg_right"] = windows.mean(df["new_cases"], window=7, min_periods=3)
+    ```
+
+    The results are those of `df.sort_values(order_by).groupby(by)[col].rolling(...)` and `.pct_change(...)`:
+    missing values are skipped, and windows with fewer than `min_periods` values are missing. Rows with a missing
+    group get missing values.
+    """
+
+    def __init__(self, df: pd.DataFrame, by: str = "location", order_by: str = "date"):
+        codes, _ = pd.factorize(df[by])
+        order_codes, _ = pd.factorize(df[order_by], sort=True)
+        # Sort by group, then order (rows with a missing group, code -1, come first)
+        self.order = np.lexsort((order_codes, codes))
+        self.codes = codes[self.order]
+        starts = np.r_[True, self.codes[1:] != self.codes[:-1]]
+        group_start = np.maximum.accumulate(np.where(starts, np.arange(len(codes)), 0))
+        self.positions = np.arange(len(codes)) - group_start
+        # Number of rows after each row in its group
+        ends = np.r_[self.codes[1:] != self.codes[:-1], True]
+        group_end = np.minimum.accumulate(
+            np.where(ends, np.arange(len(codes)), len(codes))[::-1]
+        )[::-1]
+        self.remaining = group_end - np.arange(len(codes))
+        self.valid_group = self.codes >= 0
+
+    def _sorted(self, values) -> np.ndarray:
+        values = pd.Series(values).to_numpy(dtype=np.float64, na_value=np.nan)
+        if len(values) != len(self.order):
+            raise ValueError(
+                f"Expected {len(self.order)} values, got {len(values)}, create a new GroupedWindows instead!"
+            )
+        return values[self.order]
+
+    def _unsorted(self, values: np.ndarray) -> np.ndarray:
+        values = np.where(self.valid_group, values, np.nan)
+        result = np.empty_like(values)
+        result[self.order] = values
+        return result
+
+    def _lag(self, values: np.ndarray, lag: int, fill) -> np.ndarray:
+        """Value `lag` rows before in the same group, or `-lag` rows after if `lag` is negative (`fill` if there is
+        none)."""
+        lagged = np.full_like(values, fill)
+        if 0 <= lag < len(values):
+            in_group = self.positions[lag:] >= lag
+            lagged[lag:][in_group] = values[: -lag or None][in_group]
+        elif 0 < -lag < len(values):
+            in_group = self.remaining[:lag] >= -lag
+            lagged[:lag][in_group] = values[-lag:][in_group]
+        return lagged
+
+    def _sum_count(self, values, window: int, center: bool = False):
+        """Sum and number of the non-missing values in each window, in sorted order."""
+        values = self._sorted(values)
+        valid = ~np.isnan(values)
+        filled = np.where(valid, values, 0)
+        # Centered windows end (window - 1) // 2 rows after the current row, as in pandas
+        leads = (window - 1) // 2 if center else 0
+        # Windows are summed lag by lag rather than as differences of cumulative sums, whose rounding errors grow
+        # with the total of the group and would show in rounded averages
+        sums = filled.copy()
+        valid = valid.astype(np.int64)
+        counts = valid.copy()
+        for lag in range(-leads, window - leads):
+            if lag != 0:
+                sums += self._lag(filled, lag, 0)
+                counts += self._lag(valid, lag, 0)
+        return sums, counts
+
+    def sum(
+        self, values, window: int, min_periods: int = None, center: bool = False
+    ) -> np.ndarray:
+        """Rolling sum of `values` (aligned to the right, or centered), as
+        `.rolling(window, min_periods, center).sum()`."""
+        sums, counts = self._sum_count(values, window, center)
+        min_periods = window if min_periods is None else min_periods
+        return self._unsorted(np.where(counts >= min_periods, sums, np.nan))
+
+    def mean(
+        self, values, window: int, min_periods: int = None, center: bool = False
+    ) -> np.ndarray:
+        """Rolling mean of `values` (aligned to the right, or centered), as
+        `.rolling(window, min_periods, center).mean()`."""
+        sums, counts = self._sum_count(values, window, center)
+        min_periods = window if min_periods is None else min_periods
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = sums / counts
+        return self._unsorted(np.where(counts >= min_periods, means, np.nan))
+
+    def pct_change(self, values, periods: int) -> np.ndarray:
+        """Change from `periods` rows before, as `.pct_change(periods, fill_method=None)`."""
+        values = self._sorted(values)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            changes = values / self._lag(values, periods, np.nan) - 1
+        return self._unsorted(changes)
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+
+def _take(values: np.ndarray, codes: np.ndarray, fill=np.nan) -> np.ndarray:
+    """Broadcast values of unique entities to rows (codes of -1, i.e. missing entities, get `fill`)."""
+    return np.append(np.asarray(values, dtype=object), fill)[codes]
+
+
+def select_series(
+    df: pd.DataFrame,
+    entity_column: str,
+    secondary: pd.DataFrame = None,
+    separator: str = " - ",
+    names: list = ("location", "tests_units"),
+    keys: list = ("location", "date"),
+) -> pd.DataFrame:
+    """Split entities into their location and series name, remove secondary series and check that there's a
+    single series left per location and date.
+
+    Entities are named `{location}{separator}{series name}` (e.g. "Italy - people tested"). Entities are only split
+    once each, and the split is then broadcast to all rows. Secondary series are removed with an anti-join on
+    (location, series name), and duplicates are found with a hash of the keys, so the whole selection is done in a
+    single vectorized pass.
+
+    Args:
+        df (pd.DataFrame): Data, with one row per entity and date.
+        entity_column (str): Column with the entity names.
+        secondary (pd.DataFrame, optional): Series to remove, with columns `names`. Defaults to None.
+        separator (str, optional): Separator between location and series name. Defaults to " - ".
+        names (list, optional): Names of the location and series name columns. Defaults to ("location",
+                                "tests_units").
+        keys (list, optional): Columns that must be unique once secondary series are removed. Defaults to
+                               ("location", "date").
+
+    Returns:
+        pd.DataFrame: Rows of the selected series, with columns `names` (`entity_column` is replaced if it is one of
+                      them).
+    """
+    names, keys = list(names), list(keys)
+    codes, entities = pd.factorize(df[entity_column])
+    parts = (
+        pd.Series(entities, dtype=object)
+        .str.split(separator, n=1, expand=True)
+        .reindex(columns=[0, 1])
+    )
+    locations, series = parts[0].to_numpy(), parts[1].to_numpy()
+
+    if secondary is not None and not secondary.empty:
+        is_secondary = pd.MultiIndex.from_arrays([locations, series]).isin(
+            pd.MultiIndex.from_frame(secondary[names])
+        )
+        keep = ~_take(is_secondary, codes, fill=False).astype(bool)
+    else:
+        keep = np.ones(len(df), dtype=bool)
+
+    df = df[keep].copy()
+    codes = codes[keep]
+    df[names[0]] = _take(locations, codes)
+    df[names[1]] = _take(series, codes)
+
+    duplicated = df.duplicated(subset=keys, keep=False)
+    if duplicated.any():
+        print(df[duplicated].groupby(keys).size().to_frame("n"))
+        raise ValueError(f"Multiple rows for the same {' and '.join(keys)}")
+    return df
@@ -0,0 +1,89 @@
+"""Streaming XLSX export of DataFrames.
+
+`df.to_excel(..., engine="xlsxwriter")` keeps the whole workbook in memory before saving it. Instead, `to_xlsx`
+uses xlsxwriter's `constant_memory` mode, in which each row is flushed to disk as soon as the next one is started,
+so memory usage does not grow with the number of rows.
+
+Cells are written straight from the column arrays of the DataFrame: each column gets a typed writer
+(`write_number`, `write_string`, `write_boolean`, `write_datetime`) chosen once, and missing cells are dropped
+beforehand with a vectorized null mask. The output has the same content as `df.to_excel(output_path, index=False)`,
+with pandas' header style.
+"""
+import numpy as np
+import pandas as pd
+import xlsxwriter
+from pandas.api.types import (
+    infer_dtype,
+    is_bool_dtype,
+    is_datetime64_any_dtype,
+    is_numeric_dtype,
+)
+
+
+# Same style as the header written by pandas
+HEADER_FORMAT = {"bold": True, "border": 1, "align": "center", "valign": "top"}
+DATETIME_FORMAT = "yyyy-mm-dd hh:mm:ss"
+# Rows converted to Python values at once
+CHUNK_SIZE = 10000
+
+
+def _column_writer(worksheet, series: pd.Series, formats: dict):
+    """Get the values of a column (as an array) and the worksheet method used to write them."""
+    dtype = series.dtype
+    if is_bool_dtype(dtype) and not series.hasnans:
+        return series.to_numpy(dtype=bool), worksheet.write_boolean
+    if is_datetime64_any_dtype(dtype):
+        if series.dt.tz is not None:
+            series = series.dt.tz_localize(None)
+        datetime_format = formats["datetime"]
+        return series.dt.to_pydatetime(), lambda row, col, value: (
+            worksheet.write_datetime(row, col, value, datetime_format)
+        )
+    if is_numeric_dtype(dtype) and not is_bool_dtype(dtype):
+        values = series.to_numpy(dtype="float64", na_value=np.nan)
+        infinite = np.isinf(values)
+        if infinite.any():
+            # Infinite values are written as text, as pandas does ("inf", "-inf")
+            values = values.astype(object)
+            values[infinite] = np.where(values[infinite] > 0, "inf", "-inf")
+            return values, worksheet.write
+        return values, worksheet.write_number
+    values = series.to_numpy(dtype=object)
+    if infer_dtype(values, skipna=True) == "string":
+        return values, worksheet.write_string
+    # Mixed types: let xlsxwriter pick the type of each cell
+    return values, worksheet.write
+
+
+def to_xlsx(df: pd.DataFrame, output_path: str, sheet_name: str = "Sheet1"):
+    """Write `df` (without its index) to an XLSX file, streaming rows in constant memory.
+
+    Args:
+        df (pd.DataFrame): Data to export.
+        output_path (str): Path to the output XLSX file.
+        sheet_name (str, optional): Name of the worksheet. Defaults to "Sheet1".
+    """
+    workbook = xlsxwriter.Workbook(output_path, {"constant_memory": True})
+    try:
+        worksheet = workbook.add_worksheet(sheet_name)
+        formats = {"datetime": workbook.add_format({"num_format": DATETIME_FORMAT})}
+        header_format = workbook.add_format(HEADER_FORMAT)
+        for col, name in enumerate(df.columns):
+            worksheet.write_string(0, col, str(name), header_format)
+
+        arrays = []
+        writers = []
+        for col in range(df.shape[1]):
+            values, writer = _column_writer(worksheet, df.iloc[:, col], formats)
+            arrays.append(values)
+            writers.append(writer)
+
+        for start in range(0, df.shape[0], CHUNK_SIZE):
+            end = start + CHUNK_SIZE
+            columns = [values[start:end].tolist() for values in arrays]
+            # Non-missing cells, in row-major order (as required by constant_memory mode)
+            rows, cols = np.nonzero(df.iloc[start:end].notna().to_numpy())
+            for row, col in zip(rows.tolist(), cols.tolist()):
+                writers[col](start + row + 1, col, columns[col][row])
+    finally:
+        workbook.close()
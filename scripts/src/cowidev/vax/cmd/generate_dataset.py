@@ -1,5 +1,4 @@
 import os
-import itertools
 from datetime import datetime
 from collections import ChainMap
 from math import isnan
@@ -11,6 +10,8 @@ from shutil import copyfile
 import pandas as pd
 from pandas.api.types import is_numeric_dtype
 
+from cowidev.utils.aggregates import sum_aggregates
+from cowidev.utils.grapher_dates import dates_to_days
 from cowidev.vax.cmd.utils import get_logger
 from cowidev.vax.utils.checks import VACCINES_ACCEPTED
 from cowidev.vax.utils.dates import clean_date
@@ -72,10 +73,10 @@ class DatasetGenerator:
 
         aggregates = {
             "World": {
-                "excluded_locs": ["England", "Northern Ireland", "Scotland", "Wales"],
-                "included_locs": None,
+                "exclude": ["England", "Northern Ireland", "Scotland", "Wales"],
+                "include": None,
             },
-            "European Union": {"excluded_locs": None, "included_locs": eu_countries},
+            "European Union": {"exclude": None, "include": eu_countries},
         }
         for continent in [
             "Asia",
@@ -86,8 +87,8 @@ class DatasetGenerator:
             "South America",
         ]:
             aggregates[continent] = {
-                "excluded_locs": None,
-                "included_locs": (
+                "exclude": None,
+                "include": (
                     continent_countries.loc[
                         continent_countries["Unnamed: 3"] == continent, "Entity"
                     ].tolist()
@@ -95,8 +96,8 @@ class DatasetGenerator:
             }
         for group in income_groups["Income group"].unique():
             aggregates[group] = {
-                "excluded_locs": None,
-                "included_locs": (
+                "exclude": None,
+                "include": (
                     income_groups.loc[
                         income_groups["Income group"] == group, "Country"
                     ].tolist()
@@ -149,55 +150,23 @@ class DatasetGenerator:
             ]
         ]
 
-    def _get_aggregate(self, df, agg_name, included_locs, excluded_locs):
-        # Take rows that matter
-        agg = df[~df.location.isin(self.aggregates.keys())]  # remove aggregated rows
-        if excluded_locs is not None:
-            agg = agg[~agg.location.isin(excluded_locs)]
-        elif included_locs is not None:
-            agg = agg[agg.location.isin(included_locs)]
-
-        # Get full location-date grid
-        agg = (
-            pd.DataFrame(
-                itertools.product(agg.location.unique(), agg.date.unique()),
-                columns=[agg.location.name, agg.date.name],
-            )
-            .merge(agg, on=["date", "location"], how="outer")
-            .sort_values(by=["location", "date"])
-        )
-
-        # NaN: Forward filling + Zero-filling if all metric is NaN
+    def pipe_aggregates(self, df: pd.DataFrame) -> pd.DataFrame:
+        logger.info(f"Building aggregate regions {list(self.aggregates.keys())}")
+        # Cumulative metrics are forward-filled, so that locations count with their last figures on the dates they
+        # didn't report
         cols = [
             "total_vaccinations",
             "people_vaccinated",
             "people_fully_vaccinated",
             "total_boosters",
         ]
-        grouper = agg.groupby("location")
-        for col in cols:
-            agg[col] = grouper[col].apply(
-                lambda x: x.fillna(0) if x.isnull().all() else x.fillna(method="ffill")
-            )
-
-        # Aggregate
-        agg = agg.groupby("date").sum().reset_index().assign(location=agg_name)
-        agg = agg[agg.date.dt.date < datetime.now().date()]
-        return agg
-
-    def pipe_aggregates(self, df: pd.DataFrame) -> pd.DataFrame:
-        logger.info(f"Building aggregate regions {list(self.aggregates.keys())}")
-        aggs = []
-        for agg_name, _ in self.aggregates.items():
-            aggs.append(
-                self._get_aggregate(
-                    df=df,
-                    agg_name=agg_name,
-                    included_locs=self.aggregates[agg_name]["included_locs"],
-                    excluded_locs=self.aggregates[agg_name]["excluded_locs"],
-                )
-            )
-        return pd.concat([df] + aggs, ignore_index=True)
+        aggs = sum_aggregates(
+            df[~df.location.isin(self.aggregates.keys())],  # remove aggregated rows
+            self.aggregates,
+            ffill_columns=cols,
+        )
+        aggs = aggs[aggs.date.dt.date < datetime.now().date()]
+        return pd.concat([df, aggs], ignore_index=True)
 
     def pipe_daily(self, df: pd.DataFrame) -> pd.DataFrame:
         logger.info("Adding daily metrics")
@@ -503,7 +472,7 @@ class DatasetGenerator:
                     "date": "Year",
                     "location": "Country",
                 }
-            ).assign(Year=(df.date - date_ref).dt.days)
+            ).assign(Year=dates_to_days(df.date, date_ref))
         ).copy()
         columns_first = ["Country", "Year"]
         columns_rest = [col for col in df.columns if col not in columns_first]
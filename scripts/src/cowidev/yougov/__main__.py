@@ -7,6 +7,7 @@ from tqdm import tqdm
 import numpy as np
 import pandas as pd
 
+from cowidev.utils.grapher_dates import dates_to_days
 from cowidev.utils.utils import get_project_dir
 
 
@@ -335,9 +336,7 @@ def _aggregate(df):
     df_agg.rename(columns={"date_mid": "date"}, inplace=True)
 
     # constructs date variable for internal Grapher usage.
-    df_agg.loc[:, "date_internal_use"] = (
-        df_agg["date"] - datetime.datetime.strptime(ZERO_DAY, "%Y-%m-%d").date()
-    ).dt.days
+    df_agg.loc[:, "date_internal_use"] = dates_to_days(df_agg["date"], ZERO_DAY)
     df_agg.drop("date", axis=1, inplace=True)
 
     return df_agg